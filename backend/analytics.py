@@ -0,0 +1,196 @@
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+REBUILD_JOB = "analytics.rebuild"
+BOOKED_STATUSES = ("approved", "completed")
+STATUS_COUNTERS = ("pending", "approved", "declined", "completed")
+MAX_BOOKED_SPAN_DAYS = 366
+REBUILD_BATCH_SIZE = 500
+
+
+def day_key(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d")
+
+
+def rental_days(start: datetime, end: datetime) -> List[str]:
+    days = min((end.date() - start.date()).days + 1, MAX_BOOKED_SPAN_DAYS)
+    return [day_key(start + timedelta(days=offset)) for offset in range(max(days, 0))]
+
+
+def transition_counters(request: Dict[str, Any], old_status: Optional[str], new_status: str) -> Tuple[Dict[str, float], int]:
+    """Counter increments for one request status change.
+
+    Returns the ``$inc`` document for the request's creation-day rollup and
+    the change in booked state (+1, 0 or -1) for its rental days.
+    """
+    inc: Dict[str, float] = defaultdict(float)
+    if old_status is None:
+        inc["requests"] += 1
+    else:
+        inc[old_status] -= 1
+    inc[new_status] += 1
+    booked_change = int(new_status in BOOKED_STATUSES) - int(old_status in BOOKED_STATUSES)
+    if booked_change:
+        inc["earnings"] += booked_change * request["total_price"]
+    return {key: value for key, value in inc.items() if value}, booked_change
+
+
+class OwnerAnalytics:
+    """Daily rollups of rental activity per owner and per equipment.
+
+    Request counts, status counts and earnings are bucketed by the day the
+    request was created. Equipment rollups additionally count ``booked_days``
+    on every calendar day covered by an approved or completed rental, which
+    gives utilization per item. Rollups are kept current by
+    ``record_transition`` and can be rebuilt from ``rental_requests``.
+    """
+
+    def __init__(self, db, enabled: bool = True):
+        self.db = db
+        self.enabled = enabled
+
+    @property
+    def owner_daily(self):
+        return self.db.owner_daily_stats
+
+    @property
+    def equipment_daily(self):
+        return self.db.equipment_daily_stats
+
+    async def ensure_indexes(self):
+        await self.owner_daily.create_index([("owner_id", ASCENDING), ("day", ASCENDING)], unique=True)
+        await self.equipment_daily.create_index([("equipment_id", ASCENDING), ("day", ASCENDING)], unique=True)
+        await self.equipment_daily.create_index([("owner_id", ASCENDING), ("day", ASCENDING)])
+
+    def _operations(self, request: Dict[str, Any], old_status: Optional[str], new_status: str):
+        inc, booked_change = transition_counters(request, old_status, new_status)
+        day = day_key(request["created_at"])
+        owner_ops = [UpdateOne(
+            {"owner_id": request["owner_id"], "day": day},
+            {"$inc": inc},
+            upsert=True
+        )] if inc else []
+        equipment_ops = [UpdateOne(
+            {"equipment_id": request["equipment_id"], "day": day},
+            {"$inc": inc, "$setOnInsert": {"owner_id": request["owner_id"]}},
+            upsert=True
+        )] if inc else []
+        if booked_change:
+            equipment_ops += [
+                UpdateOne(
+                    {"equipment_id": request["equipment_id"], "day": booked_day},
+                    {"$inc": {"booked_days": booked_change}, "$setOnInsert": {"owner_id": request["owner_id"]}},
+                    upsert=True
+                )
+                for booked_day in rental_days(request["start_date"], request["end_date"])
+            ]
+        return owner_ops, equipment_ops
+
+    async def record_transition(self, request: Dict[str, Any], old_status: Optional[str], new_status: str):
+        if not self.enabled or old_status == new_status:
+            return
+        owner_ops, equipment_ops = self._operations(request, old_status, new_status)
+        if owner_ops:
+            await self.owner_daily.bulk_write(owner_ops, ordered=False)
+        if equipment_ops:
+            await self.equipment_daily.bulk_write(equipment_ops, ordered=False)
+
+    async def rebuild(self, owner_id: Optional[str] = None) -> Dict[str, int]:
+        """Recompute rollups from rental_requests for one owner or everyone."""
+        scope = {"owner_id": owner_id} if owner_id else {}
+        await self.owner_daily.delete_many(scope)
+        await self.equipment_daily.delete_many(scope)
+
+        processed = 0
+        owner_ops: List[UpdateOne] = []
+        equipment_ops: List[UpdateOne] = []
+        async for request in self._requests(scope):
+            # Replaying pending -> current status yields the same counters as live updates
+            for old_status, new_status in ((None, "pending"), ("pending", request["status"])):
+                if old_status != new_status:
+                    owner, equipment = self._operations(request, old_status, new_status)
+                    owner_ops += owner
+                    equipment_ops += equipment
+            processed += 1
+            if len(equipment_ops) >= REBUILD_BATCH_SIZE:
+                await self._flush(owner_ops, equipment_ops)
+                owner_ops, equipment_ops = [], []
+        await self._flush(owner_ops, equipment_ops)
+        return {"requests": processed}
+
+    async def _requests(self, scope: Dict[str, Any]):
+        fields = ("owner_id", "equipment_id", "status", "total_price", "created_at", "start_date", "end_date")
+        async for request in self.db.rental_requests.find(
+            scope, {"_id": 0, **{field: 1 for field in fields}}, batch_size=REBUILD_BATCH_SIZE
+        ):
+            yield request
+        # Requests moved out by retention.Archiver still count towards history
+        async for record in self.db.rental_requests_archive.find(
+            scope, {"_id": 0, **{f"request.{field}": 1 for field in fields}}, batch_size=REBUILD_BATCH_SIZE
+        ):
+            yield record["request"]
+
+    async def _flush(self, owner_ops, equipment_ops):
+        if owner_ops:
+            await self.owner_daily.bulk_write(owner_ops, ordered=False)
+        if equipment_ops:
+            await self.equipment_daily.bulk_write(equipment_ops, ordered=False)
+
+    async def owner_report(self, owner_id: str, start: date, end: date) -> Dict[str, Any]:
+        start_key, end_key = start.isoformat(), end.isoformat()
+        day_range = {"$gte": start_key, "$lte": end_key}
+        series = await self.owner_daily.find(
+            {"owner_id": owner_id, "day": day_range}, {"_id": 0, "owner_id": 0}
+        ).sort("day", 1).to_list(None)
+
+        span_days = (end - start).days + 1
+        equipment_rows = self.equipment_daily.aggregate([
+            {"$match": {"owner_id": owner_id, "day": day_range}},
+            {"$group": {
+                "_id": "$equipment_id",
+                "booked_days": {"$sum": "$booked_days"},
+                "requests": {"$sum": "$requests"},
+                "earnings": {"$sum": "$earnings"},
+            }},
+        ])
+        equipment = [
+            {
+                "equipment_id": row["_id"],
+                "booked_days": row["booked_days"],
+                "utilization": row["booked_days"] / span_days,
+                "requests": row["requests"],
+                "earnings": row["earnings"],
+            }
+            async for row in equipment_rows
+        ]
+
+        totals = defaultdict(float)
+        for point in series:
+            for key in ("requests", "earnings") + STATUS_COUNTERS:
+                totals[key] += point.get(key, 0)
+        converted = totals["approved"] + totals["completed"]
+        return {
+            "start": start_key,
+            "end": end_key,
+            "series": [
+                {
+                    "day": point["day"],
+                    "requests": int(point.get("requests", 0)),
+                    "approved": int(point.get("approved", 0)),
+                    "declined": int(point.get("declined", 0)),
+                    "completed": int(point.get("completed", 0)),
+                    "earnings": point.get("earnings", 0.0),
+                }
+                for point in series
+            ],
+            "equipment": equipment,
+            "total_requests": int(totals["requests"]),
+            "total_earnings": totals["earnings"],
+            "conversion_rate": converted / totals["requests"] if totals["requests"] else 0.0,
+        }
@@ -0,0 +1,30 @@
+"""Archive finished rental requests now, or report what would be archived.
+
+Run with ``python archive.py --dry-run`` to see how many requests and
+messages are older than RETENTION_DAYS, and ``python archive.py`` to move
+them. Set RETENTION_ENABLED=true to have the job worker do this daily.
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from server import archiver, db
+
+logger = logging.getLogger("archive")
+
+
+async def main(dry_run: bool):
+    await db.connect()
+    try:
+        await archiver.ensure_indexes()
+        result = await (archiver.report() if dry_run else archiver.run())
+        print(json.dumps(result, indent=2, default=str))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="report what would be archived without changing data")
+    asyncio.run(main(parser.parse_args().dry_run))
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import jwt
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KID = "default"
+# Only used when neither JWT_KEYS nor JWT_SECRET is configured (local development)
+DEVELOPMENT_SECRET = "toala_secret_key_2024"
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def parse_keys(value: str) -> Dict[str, bytes]:
+    """Parse ``JWT_KEYS`` ("kid:secret,kid:secret") into prepared HMAC keys."""
+    keys = {}
+    for item in value.split(","):
+        if item.strip():
+            kid, _, secret = item.partition(":")
+            if not secret:
+                raise ValueError(f"JWT_KEYS entry {kid.strip()!r} has no secret")
+            keys[kid.strip()] = secret.strip().encode("utf-8")
+    return keys
+
+
+class KeyRing:
+    """Signing keys addressed by ``kid``.
+
+    New tokens are signed with ``active_kid``; any configured key verifies.
+    Rotating means adding the new key, switching ``JWT_ACTIVE_KID`` and
+    removing the old key once its tokens have expired. Tokens without a
+    ``kid`` header (issued before rotation existed) verify with ``default``.
+    """
+
+    def __init__(self, keys: Dict[str, bytes], active_kid: str, algorithm: str = "HS256"):
+        if active_kid not in keys:
+            raise ValueError(f"JWT_ACTIVE_KID {active_kid!r} is not one of the configured keys")
+        self.keys = keys
+        self.active_kid = active_kid
+        self.algorithm = algorithm
+
+    @classmethod
+    def from_env(cls, env) -> "KeyRing":
+        algorithm = env.get("JWT_ALGORITHM", "HS256")
+        if env.get("JWT_KEYS"):
+            keys = parse_keys(env["JWT_KEYS"])
+            return cls(keys, env.get("JWT_ACTIVE_KID", next(iter(keys))), algorithm)
+        secret = env.get("JWT_SECRET")
+        if not secret:
+            logger.warning("JWT_SECRET is not set; using the development secret")
+            secret = DEVELOPMENT_SECRET
+        return cls({DEFAULT_KID: secret.encode("utf-8")}, DEFAULT_KID, algorithm)
+
+    def encode(self, claims: Dict[str, Any]) -> str:
+        return jwt.encode(claims, self.keys[self.active_kid], algorithm=self.algorithm,
+                          headers={"kid": self.active_kid})
+
+    def decode(self, token: str) -> Dict[str, Any]:
+        kid = jwt.get_unverified_header(token).get("kid", DEFAULT_KID)
+        key = self.keys.get(kid)
+        if key is None:
+            raise jwt.InvalidKeyError(f"Unknown kid {kid!r}")
+        return jwt.decode(token, key, algorithms=[self.algorithm])
+
+
+class RevocationList:
+    """Revoked token ids and per-user minimum token versions, checked in memory.
+
+    Revocations are written to ``token_revocations`` and every process pulls
+    new entries from there on ``refresh``, so a logout reaches all workers
+    within one refresh interval. Entries expire with the tokens they cover.
+
+    ``created_at`` comes from whichever process wrote the entry, so entries
+    do not arrive in timestamp order. Each refresh re-reads the last
+    ``overlap`` seconds before the newest entry seen; applying an entry
+    twice changes nothing.
+    """
+
+    def __init__(self, db, enabled: bool = True, refresh_interval: float = 5.0, overlap: float = 60.0):
+        self.db = db
+        self.enabled = enabled
+        self.refresh_interval = refresh_interval
+        self.overlap = timedelta(seconds=overlap)
+        self._tokens: Dict[str, float] = {}
+        self._min_versions: Dict[str, int] = {}
+        self._since = datetime.min
+        self._stop = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+
+    @property
+    def collection(self):
+        return self.db.token_revocations
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("created_at", ASCENDING)])
+        await self.collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    def is_revoked(self, claims: Dict[str, Any]) -> bool:
+        jti = claims.get("jti")
+        if jti is not None and jti in self._tokens:
+            return True
+        return claims.get("ver", 0) < self._min_versions.get(claims["sub"], 0)
+
+    def _apply(self, entry: Dict[str, Any]):
+        if entry.get("jti"):
+            self._tokens[entry["jti"]] = entry["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+        if entry.get("user_id") is not None:
+            current = self._min_versions.get(entry["user_id"], 0)
+            self._min_versions[entry["user_id"]] = max(current, entry["min_version"])
+
+    async def _record(self, entry: Dict[str, Any]):
+        self._apply(entry)
+        if self.enabled:
+            await self.collection.insert_one(dict(entry, created_at=datetime.utcnow()))
+
+    async def revoke_token(self, claims: Dict[str, Any]):
+        await self._record({"jti": claims["jti"], "expires_at": datetime.utcfromtimestamp(claims["exp"])})
+
+    async def revoke_user(self, user_id: str, min_version: int, expires_at: datetime):
+        await self._record({"user_id": user_id, "min_version": min_version, "expires_at": expires_at})
+
+    async def refresh(self):
+        now = time.time()
+        self._tokens = {jti: expiry for jti, expiry in self._tokens.items() if expiry > now}
+        since = self._since - self.overlap if self._since > datetime.min + self.overlap else datetime.min
+        cursor = self.collection.find({"created_at": {"$gt": since}}).sort("created_at", ASCENDING)
+        async for entry in cursor:
+            self._apply(entry)
+            self._since = max(self._since, entry["created_at"])
+
+    async def run(self):
+        self._stop.clear()
+        while not self._stop.is_set():
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Revocation list refresh failed")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> asyncio.Task:
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+        return self._runner
+
+    async def stop(self):
+        self._stop.set()
+        if self._runner is not None:
+            await self._runner
+            self._runner = None
+
+
+class TokenService:
+    """Issues access tokens and verifies them without touching the database.
+
+    Tokens carry ``sub``, ``name`` and ``ver`` (the user's token version), so
+    most endpoints can authorize from the claims alone. Verified claims are
+    cached by token until they expire; revocation is checked on every call.
+    """
+
+    def __init__(self, keys: KeyRing, revocations: RevocationList, expire_hours: int = 24,
+                 cache_size: int = 10000):
+        self.keys = keys
+        self.revocations = revocations
+        self.expire_hours = expire_hours
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, user: Dict[str, Any]) -> str:
+        return self.keys.encode({
+            "sub": user["id"],
+            "name": user["name"],
+            "ver": user.get("token_version", 0),
+            "jti": str(uuid.uuid4()),
+            "exp": datetime.utcnow() + timedelta(hours=self.expire_hours),
+        })
+
+    def _decode(self, token: str) -> Dict[str, Any]:
+        with self._lock:
+            claims = self._cache.get(token)
+            if claims is not None:
+                self._cache.move_to_end(token)
+        if claims is None or claims["exp"] <= time.time():
+            try:
+                claims = self.keys.decode(token)
+            except jwt.PyJWTError as e:
+                raise InvalidToken(str(e)) from e
+            if claims.get("sub") is None:
+                raise InvalidToken("Token has no subject")
+            with self._lock:
+                self._cache[token] = claims
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return claims
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        claims = self._decode(token)
+        if self.revocations.is_revoked(claims):
+            raise InvalidToken("Token has been revoked")
+        return claims
+
+    def subject(self, token: str) -> Optional[str]:
+        try:
+            return self.verify(token)["sub"]
+        except InvalidToken:
+            return None
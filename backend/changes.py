@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+
+@dataclass
+class ChangeEvent:
+    collection: str
+    operation: str  # INSERT, UPDATE or DELETE
+    document_id: str
+    fields: Optional[FrozenSet[str]] = None  # top-level fields changed by an update, if known
+    document: Optional[Dict[str, Any]] = None  # the document after the change, when known
+    at: datetime = field(default_factory=datetime.utcnow)
+
+
+# Subscribers take one ChangeEvent, or a list of them when subscribed with batch=True
+ChangeHandler = Callable[[Any], Awaitable[None]]
+
+
+class ChangeHooks:
+    """Fans document changes out to whoever keeps derived data.
+
+    Writers ``publish`` after a change is stored, or a ``ChangeFeed``
+    ``dispatch``es batches of changes read from the database; with
+    ``local`` off, ``publish`` is a no-op because the feed delivers the same
+    changes. Subscribers registered for the collection (optionally only for
+    some operations or fields) are awaited in registration order; ``batch``
+    subscribers get each dispatched batch as one list. Polled updates do not
+    say which fields changed; they reach a ``fields`` subscriber only if it
+    was registered with ``unknown_fields``. A failing subscriber
+    is logged and does not affect the write or the other subscribers, so
+    subscribers should be quick and hand anything slow to the job queue.
+    """
+
+    def __init__(self, local: bool = True):
+        self.local = local
+        self.handlers: Dict[str, List[tuple]] = defaultdict(list)
+
+    def subscribe(self, collection: str, operations: Optional[List[str]] = None,
+                  fields: Optional[List[str]] = None, batch: bool = False, unknown_fields: bool = True):
+        """Decorator; ``fields`` limits updates to those touching at least one of them.
+
+        With ``unknown_fields`` off, updates whose changed fields are not
+        known are skipped rather than assumed to touch ``fields``.
+        """
+        def decorator(handler: ChangeHandler) -> ChangeHandler:
+            self.handlers[collection].append((
+                handler,
+                frozenset(operations) if operations else None,
+                frozenset(fields) if fields else None,
+                batch,
+                unknown_fields,
+            ))
+            return handler
+        return decorator
+
+    @staticmethod
+    def _matches(event: ChangeEvent, operations, fields, unknown_fields: bool) -> bool:
+        if operations is not None and event.operation not in operations:
+            return False
+        if fields is None or event.operation != UPDATE:
+            return True
+        if event.fields is None:
+            return unknown_fields
+        return bool(fields & event.fields)
+
+    async def publish(self, event: ChangeEvent):
+        if self.local:
+            await self.dispatch([event])
+
+    async def dispatch(self, events: List[ChangeEvent]):
+        by_collection = defaultdict(list)
+        for event in events:
+            by_collection[event.collection].append(event)
+        for collection, collection_events in by_collection.items():
+            for handler, operations, fields, batch, unknown_fields in self.handlers.get(collection, []):
+                matching = [event for event in collection_events
+                            if self._matches(event, operations, fields, unknown_fields)]
+                if not matching:
+                    continue
+                for group in ([matching] if batch else [[event] for event in matching]):
+                    try:
+                        await handler(group if batch else group[0])
+                    except Exception:
+                        logger.exception("Change handler %s failed for %s change(s) to %s",
+                                         handler.__name__, len(group), collection)
+
+
+# Field that advances on every write, per collection; used when change streams are unavailable
+POLL_FIELDS = {"equipment": "updated_at", "rental_requests": "updated_at", "messages": "timestamp"}
+# Server error codes: change streams need a replica set, and a resume token can fall off the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573
+RESUME_TOKEN_LOST = (260, 280, 286)
+_OPERATIONS = {"insert": INSERT, "update": UPDATE, "replace": UPDATE, "delete": DELETE}
+
+
+def event_from_change(change: Dict[str, Any]) -> Optional[ChangeEvent]:
+    """A ChangeEvent for one change stream document, or None for events we do not track."""
+    operation = _OPERATIONS.get(change["operationType"])
+    if operation is None:
+        return None
+    document = change.get("fullDocument")
+    before = change.get("fullDocumentBeforeChange") or {}
+    fields = None
+    if change["operationType"] == "update":
+        description = change.get("updateDescription", {})
+        fields = frozenset(
+            name.split(".")[0] for name in list(description.get("updatedFields", {})) + description.get("removedFields", [])
+        )
+    # Without pre-images, a hard delete only identifies the document by its Mongo _id
+    document_id = (document or before).get("id") or str(change["documentKey"]["_id"])
+    return ChangeEvent(change["ns"]["coll"], operation, document_id, fields, document,
+                       change.get("wallTime") or datetime.utcnow())
+
+
+class ChangeFeed:
+    """Reads changes to ``collections`` from the database and dispatches them to ``hooks``.
+
+    On a replica set this follows a change stream over the whole database,
+    filtered to ``collections``; the resume token is saved in
+    ``change_feed_state`` after every dispatched batch (and while idle), so
+    a restarted consumer continues where it stopped. A standalone server
+    has no change streams, so the feed falls back to polling each
+    collection's ``POLL_FIELDS`` timestamp, checkpointing the last
+    ``(timestamp, id)`` it saw. Polling cannot see hard deletes or which
+    fields an update touched, reports documents created since the previous
+    poll as inserts, and stays ``settle_seconds`` behind the clock so that
+    writes stamped just before a poll are not skipped.
+
+    Events are dispatched in batches of up to ``batch_size``, or whatever
+    arrived within ``max_wait`` seconds. A lease in ``change_feed_state``
+    keeps one consumer per ``name`` active; others wait on standby, so the
+    feed can be started in every process.
+    """
+
+    def __init__(self, db, hooks: ChangeHooks, collections: Iterable[str], name: str = "changes",
+                 batch_size: int = 100, max_wait: float = 1.0, poll_interval: float = 2.0,
+                 settle_seconds: float = 2.0, lease_seconds: int = 30, pre_images: bool = False):
+        self.db = db
+        self.hooks = hooks
+        self.collections = list(collections)
+        self.name = name
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.lease_seconds = lease_seconds
+        self.pre_images = pre_images
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.mode: Optional[str] = None  # "stream" or "poll" while active
+        self.dispatched = 0
+        self._stop = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+
+    @property
+    def state(self):
+        return self.db.change_feed_state
+
+    async def ensure_indexes(self):
+        for collection in self.collections:
+            await self.db[collection].create_index([(POLL_FIELDS[collection], ASCENDING), ("id", ASCENDING)])
+
+    def stats(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "dispatched": self.dispatched}
+
+    async def _acquire(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.state.update_one(
+                {"_id": f"{self.name}:lease", "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def _release(self):
+        await self.state.delete_one({"_id": f"{self.name}:lease", "owner": self.owner})
+
+    async def _dispatch(self, events: List[ChangeEvent]):
+        await self.hooks.dispatch(events)
+        self.dispatched += len(events)
+
+    async def run(self):
+        self._stop.clear()
+        while not self._stop.is_set():
+            try:
+                if await self._acquire():
+                    await self._follow()
+            except Exception:
+                logger.exception("Change feed %s failed; restarting", self.name)
+            self.mode = None
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.lease_seconds / 3)
+            except asyncio.TimeoutError:
+                pass
+        await self._release()
+
+    async def _follow(self):
+        try:
+            await self._stream()
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAMS_UNSUPPORTED:
+                raise
+            logger.info("Change streams are not available (standalone server); polling instead")
+            await self._poll()
+
+    async def _stream(self):
+        state_id = f"{self.name}:stream"
+        state = await self.state.find_one({"_id": state_id}) or {}
+        options: Dict[str, Any] = {"full_document": "updateLookup", "max_await_time_ms": int(self.max_wait * 1000)}
+        if self.pre_images:
+            options["full_document_before_change"] = "whenAvailable"
+        if state.get("token"):
+            options["resume_after"] = state["token"]
+        pipeline = [{"$match": {"ns.coll": {"$in": self.collections}}}]
+        try:
+            async with self.db.watch(pipeline, **options) as stream:
+                await self._read_stream(stream, state_id)
+        except OperationFailure as e:
+            if e.code not in RESUME_TOKEN_LOST or "resume_after" not in options:
+                raise
+            # Changes between the saved token and now are lost; derived data catches up on its next rebuild
+            logger.warning("Change feed %s resume token expired; continuing from now", self.name)
+            await self.state.delete_one({"_id": state_id})
+
+    async def _read_stream(self, stream, state_id: str):
+        self.mode = "stream"
+        batch: List[ChangeEvent] = []
+        batch_started = last_saved = time.monotonic()
+        while stream.alive and not self._stop.is_set():
+            change = await stream.try_next()
+            if change is not None:
+                event = event_from_change(change)
+                if event is not None:
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append(event)
+            now = time.monotonic()
+            flush = batch and (len(batch) >= self.batch_size or change is None or now - batch_started >= self.max_wait)
+            if flush:
+                await self._dispatch(batch)
+                batch = []
+            # While idle the token still advances, which keeps it from falling off the oplog
+            if flush or (change is None and now - last_saved >= self.lease_seconds / 3):
+                await self.state.update_one(
+                    {"_id": state_id}, {"$set": {"token": stream.resume_token, "updated_at": datetime.utcnow()}},
+                    upsert=True
+                )
+                last_saved = now
+                if not await self._acquire():
+                    logger.warning("Change feed %s lost its lease", self.name)
+                    return
+
+    async def _poll(self):
+        self.mode = "poll"
+        while not self._stop.is_set():
+            for collection in self.collections:
+                if not await self._poll_collection(collection):
+                    logger.warning("Change feed %s lost its lease", self.name)
+                    return
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_collection(self, collection: str) -> bool:
+        """Dispatch what changed in ``collection`` since its checkpoint; False if the lease was lost."""
+        state_id = f"{self.name}:poll:{collection}"
+        time_field = POLL_FIELDS[collection]
+        state = await self.state.find_one({"_id": state_id})
+        if state is None:
+            # First run: start from now rather than replaying the whole collection
+            state = {"at": datetime.utcnow() - timedelta(seconds=self.settle_seconds), "last_id": ""}
+        settled = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+        while not self._stop.is_set():
+            # Renewed per batch, so a long catch-up never runs on an expired lease
+            if not await self._acquire():
+                return False
+            query = {
+                "$or": [
+                    {time_field: {"$gt": state["at"], "$lte": settled}},
+                    {time_field: state["at"], "id": {"$gt": state["last_id"]}},
+                ]
+            }
+            documents = await self.db[collection].find(query, {"_id": 0}).sort(
+                [(time_field, ASCENDING), ("id", ASCENDING)]
+            ).limit(self.batch_size).to_list(self.batch_size)
+            if documents:
+                # Created after the checkpoint position, including ties that were not read yet: an insert
+                seen = (state["at"], state["last_id"])
+                await self._dispatch([
+                    ChangeEvent(
+                        collection,
+                        INSERT if (document.get("created_at", document[time_field]), document["id"]) > seen else UPDATE,
+                        document["id"],
+                        document=document,
+                        at=document[time_field]
+                    )
+                    for document in documents
+                ])
+                state = {"at": documents[-1][time_field], "last_id": documents[-1]["id"]}
+            await self.state.update_one(
+                {"_id": state_id}, {"$set": {**state, "updated_at": datetime.utcnow()}}, upsert=True
+            )
+            if len(documents) < self.batch_size:
+                return True
+        return True
+
+    def start(self) -> asyncio.Task:
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+        return self._runner
+
+    async def stop(self):
+        self._stop.set()
+        if self._runner is not None:
+            await self._runner
+            self._runner = None
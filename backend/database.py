@@ -0,0 +1,339 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from http.cookies import CookieError, SimpleCookie
+from typing import Any, Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, SecondaryPreferred
+
+logger = logging.getLogger(__name__)
+
+READ_PREFERENCES = ("primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest")
+_READ_PREFERENCE_CLASSES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+# Read paths that tolerate slightly stale data
+DEFAULT_READ_ROUTES = "browse=secondaryPreferred,equipment_detail=secondaryPreferred,messages=secondaryPreferred"
+
+
+def parse_read_routes(value: str) -> Dict[str, str]:
+    routes = {}
+    for item in value.split(","):
+        if item.strip():
+            route, _, preference = item.partition("=")
+            routes[route.strip()] = preference.strip() or "secondaryPreferred"
+    return routes
+
+
+LAST_WRITE_COOKIE = "toala_last_write"
+LAST_WRITE_HEADER = "x-last-write"
+
+
+@dataclass
+class _RequestWrites:
+    last_write: float = 0.0  # epoch seconds of the client's latest write
+    wrote: bool = False  # whether this request wrote
+
+
+_request_writes: ContextVar[Optional[_RequestWrites]] = ContextVar("request_writes", default=None)
+
+
+class RecentWrites:
+    """Knows whether the current client wrote recently, so its reads can stay on the primary.
+
+    The time of a client's latest write travels with the client, as the
+    ``toala_last_write`` cookie or, for API clients, the ``X-Last-Write``
+    header, so it holds whichever worker process serves the next request.
+    ``ReadYourWritesMiddleware`` loads it for each request and sends it back
+    after a write. The window should cover the maximum replica staleness.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+
+    def mark(self):
+        current = _request_writes.get()
+        if current is not None:
+            current.last_write = time.time()
+            current.wrote = True
+
+    def active(self) -> bool:
+        current = _request_writes.get()
+        return current is not None and time.time() - current.last_write < self.window_seconds
+
+
+def _last_write_from(headers) -> float:
+    cookie_header = None
+    for name, value in headers:
+        if name == LAST_WRITE_HEADER.encode("latin-1"):
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+        if name == b"cookie":
+            cookie_header = value.decode("latin-1")
+    if cookie_header:
+        try:
+            morsel = SimpleCookie(cookie_header).get(LAST_WRITE_COOKIE)
+            return float(morsel.value) if morsel else 0.0
+        except (CookieError, ValueError):
+            return 0.0
+    return 0.0
+
+
+class ReadYourWritesMiddleware:
+    """ASGI middleware that carries each client's last write time between requests."""
+
+    def __init__(self, app, recent_writes: RecentWrites, cookie_path: str = "/api"):
+        self.app = app
+        self.recent_writes = recent_writes
+        self.cookie_path = cookie_path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        current = _RequestWrites(last_write=_last_write_from(scope["headers"]))
+        token = _request_writes.set(current)
+
+        async def send_with_marker(message):
+            if message["type"] == "http.response.start" and current.wrote:
+                value = f"{current.last_write:.3f}"
+                cookie = (f"{LAST_WRITE_COOKIE}={value}; Max-Age={int(self.recent_writes.window_seconds)}; "
+                          f"Path={self.cookie_path}; HttpOnly; SameSite=Lax")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"set-cookie", cookie.encode("latin-1")),
+                    (LAST_WRITE_HEADER.encode("latin-1"), value.encode("latin-1")),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_marker)
+        finally:
+            _request_writes.reset(token)
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Tracks checked-out connections and waiting operations across all pools."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+        self.open = 0
+
+    def _add(self, **deltas: int):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, in_use=1)
+
+    def connection_checked_in(self, event):
+        self._add(in_use=-1)
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+@dataclass
+class MongoSettings:
+    url: str
+    db_name: str
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: int = 60000
+    connect_timeout_ms: int = 5000
+    server_selection_timeout_ms: int = 5000
+    socket_timeout_ms: int = 30000
+    wait_queue_timeout_ms: int = 2000
+    compressors: str = "zlib"
+    read_preference: str = "primary"
+    app_name: str = "toala-api"
+    read_routes: Dict[str, str] = field(default_factory=lambda: parse_read_routes(DEFAULT_READ_ROUTES))
+    max_staleness_seconds: int = 90
+
+    @classmethod
+    def from_env(cls, env) -> "MongoSettings":
+        return cls(
+            url=env["MONGO_URL"],
+            db_name=env["DB_NAME"],
+            max_pool_size=int(env.get("MONGO_MAX_POOL_SIZE", 100)),
+            min_pool_size=int(env.get("MONGO_MIN_POOL_SIZE", 0)),
+            max_idle_time_ms=int(env.get("MONGO_MAX_IDLE_TIME_MS", 60000)),
+            connect_timeout_ms=int(env.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+            server_selection_timeout_ms=int(env.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+            socket_timeout_ms=int(env.get("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+            wait_queue_timeout_ms=int(env.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000)),
+            compressors=env.get("MONGO_COMPRESSORS", "zlib"),
+            read_preference=env.get("MONGO_READ_PREFERENCE", "primary"),
+            app_name=env.get("MONGO_APP_NAME", "toala-api"),
+            read_routes=parse_read_routes(env.get("MONGO_READ_ROUTES", DEFAULT_READ_ROUTES)),
+            max_staleness_seconds=int(env.get("MONGO_MAX_STALENESS_SECONDS", 90)),
+        )
+
+    def validate(self):
+        if self.min_pool_size > self.max_pool_size:
+            raise ValueError("MONGO_MIN_POOL_SIZE must not exceed MONGO_MAX_POOL_SIZE")
+        if self.read_preference not in READ_PREFERENCES:
+            raise ValueError(f"MONGO_READ_PREFERENCE must be one of {', '.join(READ_PREFERENCES)}")
+        for route, preference in self.read_routes.items():
+            if preference not in READ_PREFERENCES:
+                raise ValueError(f"MONGO_READ_ROUTES: unknown read preference {preference!r} for {route}")
+        # MongoDB rejects maxStalenessSeconds below 90
+        if self.max_staleness_seconds != -1 and self.max_staleness_seconds < 90:
+            raise ValueError("MONGO_MAX_STALENESS_SECONDS must be at least 90, or -1 to disable")
+
+    def client_kwargs(self) -> Dict[str, Any]:
+        kwargs = {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "maxIdleTimeMS": self.max_idle_time_ms,
+            "connectTimeoutMS": self.connect_timeout_ms,
+            "serverSelectionTimeoutMS": self.server_selection_timeout_ms,
+            "socketTimeoutMS": self.socket_timeout_ms,
+            "waitQueueTimeoutMS": self.wait_queue_timeout_ms,
+            "readPreference": self.read_preference,
+            "appname": self.app_name,
+        }
+        if self.compressors:
+            kwargs["compressors"] = self.compressors
+        return kwargs
+
+
+class Database:
+    """Lazily connected Motor database.
+
+    Collections are reached through attribute or item access exactly like a
+    Motor database (``db.users``, ``db["jobs"]``). The client is created by
+    ``connect``, which each server worker calls on startup so that no
+    connection pool is shared across forked processes.
+
+    ``reader(route)`` returns a handle for a designated read path, routed per
+    ``MONGO_READ_ROUTES`` with bounded staleness. Clients that wrote recently
+    (see ``RecentWrites``) read from the primary until replicas have caught up.
+    """
+
+    def __init__(self, settings: MongoSettings):
+        self.settings = settings
+        self.client: Optional[AsyncIOMotorClient] = None
+        self._database = None
+        self._readers: Dict[str, Any] = {}
+        self.pool_monitor = PoolMonitor()
+        self.recent_writes = RecentWrites(max(settings.max_staleness_seconds, 90) + 10)
+
+    @property
+    def database(self):
+        if self._database is None:
+            raise RuntimeError("Database is not connected; call connect() on startup")
+        return self._database
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    def __getitem__(self, name: str):
+        return self.database[name]
+
+    async def connect(self):
+        if self.client is not None:
+            return
+        self.settings.validate()
+        self.client = AsyncIOMotorClient(
+            self.settings.url, event_listeners=[self.pool_monitor], **self.settings.client_kwargs()
+        )
+        self._database = self.client[self.settings.db_name]
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self._database = None
+        self._readers = {}
+
+    def reader(self, route: str):
+        preference = self.settings.read_routes.get(route, "primary")
+        if preference == "primary" or self.recent_writes.active():
+            return self.database
+        if preference not in self._readers:
+            self._readers[preference] = self.client.get_database(
+                self.settings.db_name,
+                read_preference=_READ_PREFERENCE_CLASSES[preference](
+                    max_staleness=self.settings.max_staleness_seconds
+                ),
+            )
+        return self._readers[preference]
+
+    def mark_write(self):
+        self.recent_writes.mark()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        monitor = self.pool_monitor
+        return {
+            "in_use": monitor.in_use,
+            "waiting": monitor.waiting,
+            "open": monitor.open,
+            "max_pool_size": self.settings.max_pool_size,
+            "saturation": monitor.in_use / self.settings.max_pool_size if self.settings.max_pool_size else 0.0,
+        }
+
+    async def self_test(self) -> Dict[str, Any]:
+        """Check connectivity and that the configured pool settings took effect."""
+        start = time.perf_counter()
+        await self.client.admin.command("ping")
+        ping_ms = (time.perf_counter() - start) * 1000
+
+        pool_options = self.client.options.pool_options
+        if pool_options.max_pool_size != self.settings.max_pool_size:
+            raise RuntimeError(
+                f"MongoDB pool size is {pool_options.max_pool_size}, expected {self.settings.max_pool_size}"
+            )
+
+        hello = await self.client.admin.command("hello")
+        if self.settings.read_preference != "primary" and not hello.get("setName"):
+            logger.warning("MONGO_READ_PREFERENCE=%s but MongoDB is not a replica set; all reads go to one server",
+                           self.settings.read_preference)
+
+        report = {
+            "ping_ms": round(ping_ms, 2),
+            "max_pool_size": pool_options.max_pool_size,
+            "min_pool_size": pool_options.min_pool_size,
+            "compressors": self.settings.compressors,
+            "read_preference": self.settings.read_preference,
+            "read_routes": self.settings.read_routes,
+            "replica_set": hello.get("setName"),
+        }
+        logger.info("MongoDB self-test passed: %s", report)
+        return report
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Dict, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic wake-up fires, i.e. how long the loop is blocked.
+
+    With ``detect_blocking`` on (debug mode), a watchdog thread also notices
+    when the loop has not ticked for ``block_threshold`` seconds and records
+    the stack of whatever is running on the loop thread at that moment.
+    """
+
+    def __init__(self, interval: float = 0.5, block_threshold: float = 0.1, detect_blocking: bool = False,
+                 window: int = 600, max_reports: int = 20):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.detect_blocking = detect_blocking
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.samples = 0
+        self.total_lag = 0.0
+        self.blocked = 0
+        self._recent = deque(maxlen=window)
+        self.reports = deque(maxlen=max_reports)
+        self._task = None
+        self._watchdog = None
+        self._watchdog_stop = threading.Event()
+        self._loop_thread_id = None
+        self._last_tick = time.monotonic()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self._last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.samples += 1
+            self.total_lag += lag
+            self._recent.append(lag)
+            if lag > self.block_threshold:
+                self.blocked += 1
+
+    def _watch(self):
+        reported_tick = None
+        while not self._watchdog_stop.wait(self.block_threshold / 2):
+            tick = self._last_tick
+            stalled = time.monotonic() - tick - self.interval
+            if stalled < self.block_threshold or tick == reported_tick:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported_tick = tick
+            stack = "".join(traceback.format_stack(frame))
+            self.reports.append({"at": time.time(), "blocked_for_ms": round(stalled * 1000, 1), "stack": stack})
+            logger.warning("Event loop blocked for %.0f ms; running on the loop thread:\n%s", stalled * 1000, stack)
+
+    def percentile(self, fraction: float, samples: int = 0) -> float:
+        """Lag percentile over the recent window, or over just the last ``samples`` samples."""
+        recent = list(self._recent)[-samples:] if samples else self._recent
+        if not recent:
+            return 0.0
+        ordered = sorted(recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "samples": self.samples,
+            "last_lag_seconds": self.last_lag,
+            "max_lag_seconds": self.max_lag,
+            "mean_lag_seconds": self.total_lag / self.samples if self.samples else 0.0,
+            "p50_lag_seconds": self.percentile(0.5),
+            "p99_lag_seconds": self.percentile(0.99),
+            "blocked_total": self.blocked,
+            "blocking_reports": len(self.reports),
+        }
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if self.detect_blocking and self._watchdog is None:
+            self._loop_thread_id = threading.get_ident()
+            self._watchdog_stop.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        if self._watchdog is not None:
+            self._watchdog_stop.set()
+            self._watchdog.join(timeout=1)
+            self._watchdog = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class ReadinessProbe:
+    """Decides whether this worker should receive traffic.
+
+    Fails when MongoDB does not answer a ping within ``ping_timeout``, when
+    required indexes are missing, when the connection pool is saturated with
+    operations queueing for a connection, or when the event loop is lagging.
+    Lag is the median of the last ``lag_samples`` samples, and the worker is
+    reported unready only while most of its last ``window`` checks failed, so
+    one slow ping or lag spike does not flap it out of rotation.
+    """
+
+    def __init__(self, db, repositories, lag_monitor: LoopLagMonitor, use_mongo: bool = True,
+                 ping_timeout: float = 1.0, max_pool_saturation: float = 0.9, max_loop_lag: float = 0.5,
+                 lag_samples: int = 10, window: int = 3):
+        self.db = db
+        self.repositories = repositories
+        self.lag_monitor = lag_monitor
+        self.use_mongo = use_mongo
+        self.ping_timeout = ping_timeout
+        self.max_pool_saturation = max_pool_saturation
+        self.max_loop_lag = max_loop_lag
+        self.lag_samples = lag_samples
+        self._outcomes = deque(maxlen=window)
+        self._indexes_ok = False
+
+    async def _ping(self) -> Tuple[bool, Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.db.client.admin.command("ping"), timeout=self.ping_timeout)
+        except Exception as e:
+            return False, {"ok": False, "error": repr(e)}
+        return True, {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+    async def _indexes(self) -> Tuple[bool, Dict[str, Any]]:
+        # Indexes are rarely dropped, so stop listing them once all were seen
+        if self._indexes_ok:
+            return True, {"ok": True}
+        try:
+            missing = await asyncio.wait_for(self.repositories.missing_indexes(), timeout=self.ping_timeout)
+        except Exception as e:
+            return False, {"ok": False, "error": repr(e)}
+        self._indexes_ok = not missing
+        return self._indexes_ok, {"ok": self._indexes_ok, "missing": missing}
+
+    async def check(self) -> Tuple[bool, Dict[str, Any]]:
+        checks: Dict[str, Any] = {}
+        ready = True
+
+        lag = self.lag_monitor.percentile(0.5, self.lag_samples)
+        lag_ok = lag <= self.max_loop_lag
+        checks["event_loop"] = {"ok": lag_ok, "lag_ms": round(lag * 1000, 2), "max_lag_ms": round(self.lag_monitor.max_lag * 1000, 2)}
+        ready &= lag_ok
+
+        if self.use_mongo:
+            ping_ok, checks["mongo"] = await self._ping()
+            ready &= ping_ok
+            if ping_ok:
+                indexes_ok, checks["indexes"] = await self._indexes()
+                ready &= indexes_ok
+
+            pool = self.db.pool_stats()
+            pool_ok = not (pool["saturation"] >= self.max_pool_saturation and pool["waiting"] > 0)
+            checks["pool"] = dict(pool, ok=pool_ok)
+            ready &= pool_ok
+
+        self._outcomes.append(ready)
+        failed = self._outcomes.count(False)
+        checks["window"] = {"ok": failed * 2 <= len(self._outcomes), "failed": failed, "of": len(self._outcomes)}
+        return checks["window"]["ok"], checks
+
+
+def prometheus_text(metrics: Iterable[Tuple[str, str, Dict[str, str], float]]) -> str:
+    """Render (name, type, labels, value) tuples in the Prometheus text format."""
+    lines = []
+    declared = set()
+    for name, kind, labels, value in metrics:
+        if name not in declared:
+            lines.append(f"# TYPE {name} {kind}")
+            declared.add(name)
+        label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
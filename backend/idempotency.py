@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+IN_PROGRESS = "in_progress"
+DONE = "done"
+# Response headers worth replaying; everything else is regenerated by the server
+REPLAYED_HEADERS = (b"content-type",)
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used with a different request body."""
+
+
+class IdempotencyInProgress(Exception):
+    """The first request with this key is still running after ``wait_timeout``."""
+
+
+class IdempotencyStore:
+    """First responses keyed by (scope, Idempotency-Key), held in process memory.
+
+    ``begin`` either claims the key for the caller or returns the stored
+    response. Duplicates that arrive while the first request is running wait
+    for it to finish instead of executing again. ``MongoIdempotencyStore``
+    shares the records between processes.
+    """
+
+    def __init__(self, ttl_seconds: float = 86400, wait_timeout: float = 10.0, lock_seconds: float = 30.0):
+        self.ttl_seconds = ttl_seconds
+        self.wait_timeout = wait_timeout
+        self.lock_seconds = lock_seconds
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, asyncio.Event] = {}
+
+    async def ensure_indexes(self):
+        pass
+
+    async def _insert(self, record_id: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Create an in-progress record; returns the existing record instead if there is one."""
+        now = datetime.utcnow()
+        existing = self._records.get(record_id)
+        if existing is not None and existing["expires_at"] > now:
+            return existing
+        self._records[record_id] = {"_id": record_id, "state": IN_PROGRESS, "fingerprint": fingerprint,
+                                    "locked_at": now, "expires_at": now + timedelta(seconds=self.ttl_seconds)}
+        return None
+
+    async def _load(self, record_id: str) -> Optional[Dict[str, Any]]:
+        return self._records.get(record_id)
+
+    async def _take_over(self, record_id: str, locked_before: datetime) -> bool:
+        record = self._records.get(record_id)
+        if record is None or record["state"] != IN_PROGRESS or record["locked_at"] >= locked_before:
+            return False
+        record["locked_at"] = datetime.utcnow()
+        return True
+
+    async def _save(self, record_id: str, response: Dict[str, Any]):
+        self._records[record_id].update(state=DONE, response=response)
+
+    async def _delete(self, record_id: str):
+        self._records.pop(record_id, None)
+
+    async def begin(self, record_id: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Claim ``record_id``; returns None if the caller should execute, else the stored response."""
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            existing = await self._insert(record_id, fingerprint)
+            if existing is None:
+                self._inflight[record_id] = asyncio.Event()
+                return None
+            if existing["fingerprint"] != fingerprint:
+                raise IdempotencyConflict(record_id)
+            if existing["state"] == DONE:
+                return existing["response"]
+
+            # A worker that crashed mid-request leaves its lock behind
+            stale_before = datetime.utcnow() - timedelta(seconds=self.lock_seconds)
+            if await self._take_over(record_id, stale_before):
+                self._inflight[record_id] = asyncio.Event()
+                return None
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise IdempotencyInProgress(record_id)
+            local = self._inflight.get(record_id)
+            try:
+                if local is not None:
+                    await asyncio.wait_for(local.wait(), timeout=remaining)
+                else:
+                    # Running in another process; poll until it finishes
+                    await asyncio.sleep(min(0.05, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    async def complete(self, record_id: str, response: Dict[str, Any]):
+        try:
+            await self._save(record_id, response)
+        finally:
+            self._wake(record_id)
+
+    async def release(self, record_id: str):
+        """Forget a key whose request failed, so a retry runs again."""
+        try:
+            await self._delete(record_id)
+        finally:
+            self._wake(record_id)
+
+    def _wake(self, record_id: str):
+        event = self._inflight.pop(record_id, None)
+        if event is not None:
+            event.set()
+
+
+class MongoIdempotencyStore(IdempotencyStore):
+    """Idempotency records in a TTL-indexed collection shared by all workers."""
+
+    def __init__(self, db, collection: str = "idempotency_keys", **kwargs):
+        super().__init__(**kwargs)
+        self.db = db
+        self.collection_name = collection
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    async def _insert(self, record_id: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        try:
+            await self.collection.insert_one({
+                "_id": record_id, "state": IN_PROGRESS, "fingerprint": fingerprint,
+                "locked_at": now, "expires_at": now + timedelta(seconds=self.ttl_seconds),
+            })
+        except DuplicateKeyError:
+            existing = await self._load(record_id)
+            # Expired between the insert and the read; try again
+            return existing if existing is not None else await self._insert(record_id, fingerprint)
+        return None
+
+    async def _load(self, record_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"_id": record_id})
+
+    async def _take_over(self, record_id: str, locked_before: datetime) -> bool:
+        result = await self.collection.update_one(
+            {"_id": record_id, "state": IN_PROGRESS, "locked_at": {"$lt": locked_before}},
+            {"$set": {"locked_at": datetime.utcnow()}}
+        )
+        return result.modified_count == 1
+
+    async def _save(self, record_id: str, response: Dict[str, Any]):
+        await self.collection.update_one({"_id": record_id}, {"$set": {"state": DONE, "response": response}})
+
+    async def _delete(self, record_id: str):
+        await self.collection.delete_one({"_id": record_id, "state": IN_PROGRESS})
+
+
+def request_fingerprint(method: str, path: str, body: bytes) -> str:
+    return hashlib.sha256(method.encode("latin-1") + b" " + path.encode("latin-1") + b"\n" + body).hexdigest()
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware that replays the first response for a repeated ``Idempotency-Key``.
+
+    Applies to POSTs on ``paths`` from authenticated callers; keys are scoped
+    per user and path. Replays are answered before routing, so body parsing
+    and validation are skipped as well. Responses with a 5xx status are not
+    stored, so those requests can be retried.
+    """
+
+    def __init__(self, app, store: IdempotencyStore, identify: Callable[[str], Optional[str]],
+                 paths: Iterable[str]):
+        self.app = app
+        self.store = store
+        self.identify = identify
+        self.paths = frozenset(paths)
+
+    @staticmethod
+    def _headers(scope) -> Tuple[Optional[str], Optional[str]]:
+        key = token = None
+        for name, value in scope["headers"]:
+            if name == b"idempotency-key":
+                key = value.decode("latin-1")
+            elif name == b"authorization" and value[:7].lower() == b"bearer ":
+                token = value[7:].decode("latin-1")
+        return key, token
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        key, token = self._headers(scope)
+        user_id = self.identify(token) if key and token else None
+        if user_id is None:
+            return await self.app(scope, receive, send)
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+        record_id = f"{user_id}:{scope['path']}:{key}"
+
+        try:
+            stored = await self.store.begin(record_id, request_fingerprint(scope["method"], scope["path"], bytes(body)))
+        except IdempotencyConflict:
+            return await _send_json(send, 422, {"detail": "Idempotency-Key was already used with a different request"})
+        except IdempotencyInProgress:
+            return await _send_json(send, 409, {"detail": "A request with this Idempotency-Key is still in progress"})
+        if stored is not None:
+            return await _send_stored(send, stored)
+
+        replayed = False
+
+        async def replay_body():
+            # The buffered body once, then the real channel, so the app still sees http.disconnect
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {"type": "http.request", "body": bytes(body), "more_body": False}
+
+        response: Dict[str, Any] = {"status": 500, "headers": [], "body": b""}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [[name, value] for name, value in message.get("headers", [])
+                                       if name.lower() in REPLAYED_HEADERS]
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_body, capture)
+        except BaseException:
+            await self.store.release(record_id)
+            raise
+        if response["status"] >= 500:
+            await self.store.release(record_id)
+        else:
+            await self.store.complete(record_id, response)
+
+
+async def _send_stored(send, stored: Dict[str, Any]):
+    headers = [(bytes(name), bytes(value)) for name, value in stored["headers"]]
+    body = bytes(stored["body"])
+    await send({
+        "type": "http.response.start",
+        "status": stored["status"],
+        "headers": headers + [
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"idempotent-replayed", b"true"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(send, status: int, content: Dict[str, Any]):
+    body = json.dumps(content).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1"))],
+    })
+    await send({"type": "http.response.body", "body": body})
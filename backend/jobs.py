@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+@dataclass
+class JobSpec:
+    handler: JobHandler
+    concurrency: int = 1
+    max_attempts: int = 5
+    every: Optional[float] = None  # seconds between runs of a periodic job
+
+
+class JobQueue:
+    """Durable job queue stored in a Mongo collection and run on the event loop.
+
+    Jobs are claimed with ``find_one_and_update`` so several workers can share
+    one collection. A claimed job holds a lease that its worker renews every
+    ``lease_seconds / 3`` while the handler runs; if the worker dies, the job
+    is picked up again once the lease expires. Writes about a job are fenced
+    by its attempt number, so a worker that lost its lease cannot overwrite
+    the newer attempt's outcome. Failed attempts are retried with exponential
+    backoff until ``max_attempts`` is reached.
+
+    Job types registered with ``every`` run periodically. Each run has a job
+    id derived from its time slot, so any number of processes can schedule
+    the next run without creating duplicates.
+
+    With ``enabled`` off (no MongoDB) handlers can still be registered, but
+    nothing may be queued or read.
+    """
+
+    def __init__(
+        self,
+        db,
+        collection: str = "jobs",
+        poll_interval: float = 1.0,
+        lease_seconds: int = 300,
+        backoff_base: float = 2.0,
+        backoff_max: float = 600.0,
+        enabled: bool = True,
+    ):
+        self.db = db
+        self.collection_name = collection
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.enabled = enabled
+        self.specs: Dict[str, JobSpec] = {}
+        self._running: Dict[str, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._stop = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    def register(self, job_type: str, concurrency: int = 1, max_attempts: int = 5, every: Optional[float] = None):
+        def decorator(handler: JobHandler) -> JobHandler:
+            self.specs[job_type] = JobSpec(handler, concurrency, max_attempts, every)
+            self._running.setdefault(job_type, 0)
+            return handler
+        return decorator
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("id", unique=True)
+        await self.collection.create_index([("type", ASCENDING), ("status", ASCENDING), ("run_at", ASCENDING)])
+        await self.collection.create_index([("user_id", ASCENDING), ("created_at", ASCENDING)])
+
+    async def enqueue(
+        self,
+        job_type: str,
+        payload: Optional[Dict[str, Any]] = None,
+        delay_seconds: float = 0,
+        user_id: Optional[str] = None,
+        job_id: Optional[str] = None,
+    ) -> str:
+        """Queue a job; enqueueing an existing ``job_id`` again is a no-op."""
+        if job_type not in self.specs:
+            raise ValueError(f"Unknown job type: {job_type}")
+        now = datetime.utcnow()
+        job = {
+            "id": job_id or str(uuid.uuid4()),
+            "type": job_type,
+            "payload": payload or {},
+            "user_id": user_id,
+            "status": JobStatus.queued.value,
+            "attempts": 0,
+            "max_attempts": self.specs[job_type].max_attempts,
+            "run_at": now + timedelta(seconds=delay_seconds),
+            "lease_expires_at": None,
+            "last_error": None,
+            "result": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        try:
+            await self.collection.insert_one(job)
+        except DuplicateKeyError:
+            if job_id is None:
+                raise
+        return job["id"]
+
+    async def schedule_periodic(self, job_type: Optional[str] = None):
+        """Queue the next run of each periodic job type (or just ``job_type``)."""
+        now = time.time()
+        for name, spec in self.specs.items():
+            if spec.every and job_type in (None, name):
+                slot = int(now // spec.every) + 1
+                await self.enqueue(name, delay_seconds=slot * spec.every - now, job_id=f"{name}@{slot}")
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"id": job_id}, {"_id": 0})
+
+    async def stats(self) -> Dict[str, Dict[str, int]]:
+        pipeline = [{"$group": {"_id": {"type": "$type", "status": "$status"}, "count": {"$sum": 1}}}]
+        result: Dict[str, Dict[str, int]] = {}
+        async for row in self.collection.aggregate(pipeline):
+            result.setdefault(row["_id"]["type"], {})[row["_id"]["status"]] = row["count"]
+        return result
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+
+    async def _claim(self, job_type: str) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {
+                "type": job_type,
+                "$or": [
+                    {"status": JobStatus.queued.value, "run_at": {"$lte": now}},
+                    {"status": JobStatus.running.value, "lease_expires_at": {"$lte": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": JobStatus.running.value,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _heartbeat(self, job: Dict[str, Any]):
+        # Long handlers (rebuilds, migrations) keep their lease, so no other worker starts them again
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            now = datetime.utcnow()
+            try:
+                renewed = await self.collection.update_one(
+                    {"id": job["id"], "status": JobStatus.running.value, "attempts": job["attempts"]},
+                    {"$set": {"lease_expires_at": now + timedelta(seconds=self.lease_seconds), "updated_at": now}},
+                )
+            except Exception:
+                logger.exception("Renewing the lease of job %s failed", job["id"])
+                continue
+            if not renewed.matched_count:
+                logger.warning("Job %s (%s) lost its lease to another worker", job["id"], job["type"])
+                return
+
+    async def _execute(self, job: Dict[str, Any]):
+        job_type = job["type"]
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        update: Optional[Dict[str, Any]] = None
+        try:
+            result = await self.specs[job_type].handler(job["payload"])
+            update = {"status": JobStatus.succeeded.value, "result": result, "last_error": None}
+        except Exception as e:
+            logger.exception("Job %s (%s) failed on attempt %s", job["id"], job_type, job["attempts"])
+            if job["attempts"] >= job["max_attempts"]:
+                update = {"status": JobStatus.failed.value, "last_error": repr(e)}
+            else:
+                update = {
+                    "status": JobStatus.queued.value,
+                    "last_error": repr(e),
+                    "run_at": datetime.utcnow() + timedelta(seconds=self.backoff(job["attempts"])),
+                }
+        finally:
+            heartbeat.cancel()
+            self._running[job_type] -= 1
+            if update is None:
+                # Cancelled (e.g. on shutdown): hand the job back now rather than when its lease runs
+                # out, without counting the interrupted attempt; the cancellation propagates after this
+                await self._record(job, {"status": JobStatus.queued.value, "run_at": datetime.utcnow()},
+                                   {"attempts": -1})
+        await self._record(job, update)
+        if self.specs[job_type].every and update["status"] != JobStatus.queued.value:
+            try:
+                await self.schedule_periodic(job_type)
+            except Exception:
+                logger.exception("Scheduling the next %s run failed", job_type)
+
+    async def _record(self, job: Dict[str, Any], update: Dict[str, Any], inc: Optional[Dict[str, int]] = None):
+        # Fenced by attempt, so a worker whose lease was taken over cannot overwrite the newer run
+        operation: Dict[str, Any] = {"$set": {**update, "lease_expires_at": None, "updated_at": datetime.utcnow()}}
+        if inc:
+            operation["$inc"] = inc
+        try:
+            await self.collection.update_one({"id": job["id"], "attempts": job["attempts"]}, operation)
+        except Exception:
+            # The worker carries on; the job is picked up again once its lease expires
+            logger.exception("Recording the outcome of job %s (%s) failed", job["id"], job["type"])
+
+    async def _dispatch(self) -> int:
+        started = 0
+        for job_type, spec in self.specs.items():
+            while self._running[job_type] < spec.concurrency:
+                job = await self._claim(job_type)
+                if job is None:
+                    break
+                self._running[job_type] += 1
+                task = asyncio.create_task(self._execute(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                started += 1
+        return started
+
+    async def run(self):
+        """Process jobs until ``stop`` is called."""
+        self._stop.clear()
+        try:
+            await self.schedule_periodic()
+        except Exception:
+            logger.exception("Scheduling periodic jobs failed")
+        while not self._stop.is_set():
+            try:
+                started = await self._dispatch()
+            except Exception:
+                logger.exception("Job dispatch failed")
+                started = 0
+            if not started:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def run_until_idle(self):
+        """Process every job that is due now, then return. Used by tests and scripts."""
+        while True:
+            started = await self._dispatch()
+            if self._tasks:
+                await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            elif not started:
+                return
+
+    def start(self) -> asyncio.Task:
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+        return self._runner
+
+    def request_stop(self):
+        self._stop.set()
+
+    async def stop(self):
+        self.request_stop()
+        if self._runner is not None:
+            await self._runner
+            self._runner = None
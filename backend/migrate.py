@@ -0,0 +1,32 @@
+"""Apply schema migrations against the configured database.
+
+Run ``python migrate.py --status`` to list pending migrations and
+``python migrate.py`` to apply them (optionally ``--target VERSION``).
+Migrations rewrite documents in throttled batches and checkpoint their
+progress, so this is safe to run against a live database and to restart.
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from server import db, migration_runner
+
+logger = logging.getLogger("migrate")
+
+
+async def main(status: bool, target):
+    await db.connect()
+    try:
+        result = await (migration_runner.status() if status else migration_runner.run(target))
+        print(json.dumps(result, indent=2, default=str))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--status", action="store_true", help="show the current version and pending migrations")
+    parser.add_argument("--target", type=int, help="stop after this migration version")
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.status, arguments.target))
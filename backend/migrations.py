@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from ranking import NEW_LISTING_SCORE
+
+logger = logging.getLogger(__name__)
+
+Document = Dict[str, Any]
+
+SCHEMA_ID = "schema"
+LOCK_ID = "lock"
+
+
+@dataclass
+class Migration:
+    """One schema change, applied document by document.
+
+    ``query`` selects documents that still need the change, and
+    ``transform`` returns the update for one document (or None to leave it).
+    Keeping ``query`` selective makes a migration safe to re-run.
+    """
+
+    version: int
+    name: str
+    collection: str
+    query: Document
+    transform: Callable[[Document], Optional[Document]]
+    projection: Optional[Document] = None
+    batch_size: Optional[int] = None
+
+
+def _set_defaults(defaults: Document) -> Callable[[Document], Optional[Document]]:
+    def transform(document: Document) -> Optional[Document]:
+        missing = {name: value for name, value in defaults.items() if name not in document}
+        return {"$set": missing} if missing else None
+    return transform
+
+
+def _copy_field(source: str, target: str) -> Callable[[Document], Optional[Document]]:
+    def transform(document: Document) -> Optional[Document]:
+        if target in document or source not in document:
+            return None
+        return {"$set": {target: document[source]}}
+    return transform
+
+
+def _missing_any(fields) -> Document:
+    return {"$or": [{name: {"$exists": False}} for name in fields]}
+
+
+_PRICING_DEFAULTS = {"weekly_discount": 0.0, "monthly_discount": 0.0, "deposit": 0.0, "deposit_rate": 0.0}
+
+# Ordered by version; never renumber or edit a migration once it has shipped
+MIGRATIONS: List[Migration] = [
+    Migration(1, "users.token_version", "users", {"token_version": {"$exists": False}},
+              _set_defaults({"token_version": 0}), {"token_version": 1}),
+    Migration(2, "rental_requests.version", "rental_requests", {"version": {"$exists": False}},
+              _set_defaults({"version": 0}), {"version": 1}),
+    Migration(3, "equipment.pricing_fields", "equipment", _missing_any(_PRICING_DEFAULTS),
+              _set_defaults(_PRICING_DEFAULTS), {name: 1 for name in _PRICING_DEFAULTS}),
+    Migration(4, "equipment.score", "equipment", {"score": {"$exists": False}},
+              _set_defaults({"score": NEW_LISTING_SCORE}), {"score": 1}),
+    Migration(5, "equipment.updated_at", "equipment", {"updated_at": {"$exists": False}},
+              _copy_field("created_at", "updated_at"), {"created_at": 1, "updated_at": 1}),
+]
+
+
+class MigrationRunner:
+    """Applies pending migrations online, in version order.
+
+    Documents are rewritten in ``_id`` order in batches of ``batch_size``.
+    After each batch the last ``_id`` is checkpointed in ``schema_version``,
+    so an interrupted run resumes where it stopped. Between batches the
+    runner sleeps ``throttle`` times as long as the batch took, which keeps
+    the migration's share of database time bounded. A lease in
+    ``schema_version`` keeps two runners from working at once.
+    """
+
+    def __init__(self, db, migrations: Optional[List[Migration]] = None, batch_size: int = 500,
+                 throttle: float = 1.0, lease_seconds: int = 60):
+        self.db = db
+        self.migrations = sorted(migrations if migrations is not None else MIGRATIONS, key=lambda m: m.version)
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def collection(self):
+        return self.db.schema_version
+
+    async def current_version(self) -> int:
+        state = await self.collection.find_one({"_id": SCHEMA_ID})
+        return state["version"] if state else 0
+
+    async def status(self) -> Dict[str, Any]:
+        version = await self.current_version()
+        checkpoints = {
+            row["version"]: row
+            async for row in self.collection.find({"_id": {"$regex": "^migration:"}})
+        }
+        return {
+            "version": version,
+            "latest": max((migration.version for migration in self.migrations), default=0),
+            "pending": [
+                {"version": migration.version, "name": migration.name,
+                 "migrated": checkpoints.get(migration.version, {}).get("migrated", 0)}
+                for migration in self.migrations
+                if migration.version > version
+            ],
+        }
+
+    async def _acquire(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.collection.update_one(
+                {"_id": LOCK_ID, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Held by another runner whose lease has not expired
+            return False
+        return True
+
+    async def _release(self):
+        await self.collection.delete_one({"_id": LOCK_ID, "owner": self.owner})
+
+    async def run(self, target: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Apply pending migrations up to ``target`` (default: all)."""
+        if not await self._acquire():
+            logger.info("Another migration runner holds the lock; skipping")
+            return []
+        results = []
+        try:
+            version = await self.current_version()
+            for migration in self.migrations:
+                if migration.version <= version or (target is not None and migration.version > target):
+                    continue
+                results.append(await self._apply(migration))
+                await self.collection.update_one(
+                    {"_id": SCHEMA_ID}, {"$set": {"version": migration.version, "updated_at": datetime.utcnow()}},
+                    upsert=True
+                )
+                version = migration.version
+        finally:
+            await self._release()
+        return results
+
+    async def _apply(self, migration: Migration) -> Dict[str, Any]:
+        checkpoint_id = f"migration:{migration.version}"
+        checkpoint = await self.collection.find_one({"_id": checkpoint_id}) or {}
+        last_id = checkpoint.get("last_id")
+        migrated = checkpoint.get("migrated", 0)
+        batch_size = migration.batch_size or self.batch_size
+        target = self.db[migration.collection]
+        logger.info("Migration %s (%s) starting%s", migration.version, migration.name,
+                    f" from checkpoint after {migrated} documents" if last_id else "")
+
+        while True:
+            query = dict(migration.query)
+            if last_id is not None:
+                query = {"$and": [migration.query, {"_id": {"$gt": last_id}}]}
+            started = time.perf_counter()
+            batch = await target.find(query, migration.projection).sort("_id", ASCENDING).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            operations = []
+            for document in batch:
+                update = migration.transform(document)
+                if update:
+                    operations.append(UpdateOne({"_id": document["_id"]}, update))
+            if operations:
+                await target.bulk_write(operations, ordered=False)
+            last_id = batch[-1]["_id"]
+            migrated += len(operations)
+            await self.collection.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"version": migration.version, "name": migration.name, "last_id": last_id,
+                          "migrated": migrated, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            if not await self._acquire():
+                raise RuntimeError("Lost the migration lock")
+            await asyncio.sleep((time.perf_counter() - started) * self.throttle)
+
+        await self.collection.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"version": migration.version, "name": migration.name, "migrated": migrated,
+                      "finished_at": datetime.utcnow()}},
+            upsert=True
+        )
+        logger.info("Migration %s (%s) finished: %s documents updated", migration.version, migration.name, migrated)
+        return {"version": migration.version, "name": migration.name, "migrated": migrated}
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import ASCENDING
+
+from jobs import JobQueue
+
+logger = logging.getLogger(__name__)
+
+SEND_DIGEST_JOB = "notifications.send_digest"
+
+
+# Transports
+class LogTransport:
+    async def send(self, recipient: Dict[str, Any], subject: str, body: str):
+        logger.info("Notification to %s: %s\n%s", recipient.get("email"), subject, body)
+
+
+class SMTPTransport:
+    """Sends mail through an SMTP server.
+
+    For local development point it at a stand-in such as
+    ``python -m aiosmtpd -n -l localhost:1025``.
+    """
+
+    def __init__(self, host: str, port: int, sender: str, username: Optional[str] = None,
+                 password: Optional[str] = None, use_tls: bool = False):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+
+    def _send(self, message):
+        import smtplib
+
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password or "")
+            smtp.send_message(message)
+
+    async def send(self, recipient: Dict[str, Any], subject: str, body: str):
+        from email.message import EmailMessage
+
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = recipient["email"]
+        message["Subject"] = subject
+        message.set_content(body)
+        await asyncio.to_thread(self._send, message)
+
+
+class WebhookTransport:
+    def __init__(self, url: str):
+        self.url = url
+
+    def _post(self, data: bytes):
+        import urllib.request
+
+        request = urllib.request.Request(self.url, data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    async def send(self, recipient: Dict[str, Any], subject: str, body: str):
+        data = json.dumps({"recipient_id": recipient["id"], "email": recipient["email"],
+                           "subject": subject, "body": body}).encode("utf-8")
+        await asyncio.to_thread(self._post, data)
+
+
+def transport_from_env(env) -> Any:
+    kind = env.get("NOTIFICATION_TRANSPORT", "log")
+    if kind == "smtp":
+        return SMTPTransport(
+            host=env.get("SMTP_HOST", "localhost"),
+            port=int(env.get("SMTP_PORT", "1025")),
+            sender=env.get("SMTP_SENDER", "noreply@toala.at"),
+            username=env.get("SMTP_USERNAME"),
+            password=env.get("SMTP_PASSWORD"),
+            use_tls=env.get("SMTP_TLS", "false").lower() == "true",
+        )
+    if kind == "webhook":
+        return WebhookTransport(env["NOTIFICATION_WEBHOOK_URL"])
+    return LogTransport()
+
+
+class RateLimiter:
+    """Spaces out calls so at most ``rate`` happen per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Notifier:
+    """Collects notification events and sends them as per-recipient digests.
+
+    ``notify`` only appends to an in-memory buffer, so request handlers pay no
+    I/O. A background loop flushes the buffer with ``insert_many`` and, once a
+    recipient's oldest unsent event is ``digest_window`` seconds old, hands the
+    recipient's events to the job queue as one digest. Events expire
+    ``retention_days`` after they were created, sent or not.
+    """
+
+    def __init__(self, db, job_queue: JobQueue, transport, digest_window: float = 300,
+                 flush_interval: float = 1.0, sends_per_second: float = 5, max_buffer: int = 10000,
+                 retention_days: float = 30, enabled: bool = True):
+        self.db = db
+        self.retention = timedelta(days=retention_days)
+        self.enabled = enabled
+        self.job_queue = job_queue
+        self.transport = transport
+        self.digest_window = digest_window
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.rate_limiter = RateLimiter(sends_per_second)
+        self._buffer: List[Dict[str, Any]] = []
+        self._stop = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        job_queue.register(SEND_DIGEST_JOB, concurrency=4)(self.send_digest)
+
+    @property
+    def events(self):
+        return self.db.notification_events
+
+    async def ensure_indexes(self):
+        await self.events.create_index([("digest_id", ASCENDING), ("recipient_id", ASCENDING), ("created_at", ASCENDING)])
+        await self.events.create_index([("sent_at", ASCENDING), ("claimed_at", ASCENDING)])
+        await self.events.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+    def notify(self, recipient_id: str, kind: str, text: str, data: Optional[Dict[str, Any]] = None):
+        if not self.enabled:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            logger.warning("Notification buffer full, dropping %s event for %s", kind, recipient_id)
+            return
+        now = datetime.utcnow()
+        self._buffer.append({
+            "id": str(uuid.uuid4()),
+            "recipient_id": recipient_id,
+            "kind": kind,
+            "text": text,
+            "data": data or {},
+            "digest_id": None,
+            "claimed_at": None,
+            "sent_at": None,
+            "created_at": now,
+            "expires_at": now + self.retention,
+        })
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        pending, self._buffer = self._buffer, []
+        try:
+            await self.events.insert_many(pending, ordered=False)
+        except Exception:
+            self._buffer[:0] = pending
+            raise
+
+    async def schedule_digests(self) -> int:
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.digest_window)
+        pipeline = [
+            {"$match": {"digest_id": None}},
+            {"$group": {"_id": "$recipient_id", "oldest": {"$min": "$created_at"}}},
+            {"$match": {"oldest": {"$lte": cutoff}}},
+        ]
+        scheduled = 0
+        async for row in self.events.aggregate(pipeline):
+            digest_id = str(uuid.uuid4())
+            claimed = await self.events.update_many(
+                {"recipient_id": row["_id"], "digest_id": None},
+                {"$set": {"digest_id": digest_id, "claimed_at": now}}
+            )
+            # Another process may have claimed these events first
+            if claimed.modified_count:
+                await self._enqueue_digest(digest_id, row["_id"])
+                scheduled += 1
+        await self._reschedule_unsent(cutoff)
+        return scheduled
+
+    async def _enqueue_digest(self, digest_id: str, recipient_id: str):
+        try:
+            # Keyed by digest, so queueing the same digest again is a no-op
+            await self.job_queue.enqueue(SEND_DIGEST_JOB, {"digest_id": digest_id, "recipient_id": recipient_id},
+                                         job_id=f"{SEND_DIGEST_JOB}:{digest_id}")
+        except Exception:
+            logger.exception("Queueing digest %s failed; it is retried on a later pass", digest_id)
+
+    async def _reschedule_unsent(self, claimed_before: datetime):
+        # Events claimed for a digest whose job was never queued would otherwise never be sent
+        pipeline = [
+            {"$match": {"sent_at": None, "claimed_at": {"$ne": None, "$lte": claimed_before}}},
+            {"$group": {"_id": {"digest_id": "$digest_id", "recipient_id": "$recipient_id"}}},
+        ]
+        async for row in self.events.aggregate(pipeline):
+            await self._enqueue_digest(row["_id"]["digest_id"], row["_id"]["recipient_id"])
+
+    async def send_digest(self, payload: Dict[str, Any]):
+        recipient = await self.db.users.find_one({"id": payload["recipient_id"]}, {"id": 1, "email": 1, "name": 1})
+        events = await self.events.find(
+            {"digest_id": payload["digest_id"], "sent_at": None}
+        ).sort("created_at", 1).to_list(None)
+        if not recipient or not events:
+            return {"sent": 0}
+
+        subject = events[0]["text"] if len(events) == 1 else f"You have {len(events)} new updates on Toala"
+        lines = [f"Hello {recipient['name']},", ""]
+        lines += [f"- {event['text']}" for event in events]
+        await self.rate_limiter.wait()
+        await self.transport.send(recipient, subject, "\n".join(lines))
+
+        await self.events.update_many({"digest_id": payload["digest_id"]}, {"$set": {"sent_at": datetime.utcnow()}})
+        return {"sent": len(events)}
+
+    async def run(self):
+        self._stop.clear()
+        last_schedule = 0.0
+        while not self._stop.is_set():
+            try:
+                await self.flush()
+                if time.monotonic() - last_schedule >= min(self.digest_window, 60):
+                    await self.schedule_digests()
+                    last_schedule = time.monotonic()
+            except Exception:
+                logger.exception("Notification loop failed")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+        await self.flush()
+
+    def start(self) -> asyncio.Task:
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self.run())
+        return self._runner
+
+    async def stop(self):
+        self._stop.set()
+        if self._runner is not None:
+            await self._runner
+            self._runner = None
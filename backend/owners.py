@@ -0,0 +1,132 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING
+
+logger = logging.getLogger(__name__)
+
+SYNC_NAMES_JOB = "owners.sync_names"
+VERIFY_NAMES_JOB = "owners.verify_names"
+UNKNOWN_NAME = "Unknown"
+VERIFY_STATE_ID = "verify"
+
+# collection -> [(user id field, denormalized name field)]
+NAME_FIELDS: Dict[str, List[Tuple[str, str]]] = {
+    "equipment": [("owner_id", "owner_name")],
+    "rental_requests": [("owner_id", "owner_name"), ("requester_id", "requester_name")],
+}
+
+
+def missing_name_ids(documents: Iterable[Dict[str, Any]], fields: List[Tuple[str, str]]) -> List[str]:
+    """User ids whose names are not embedded yet, i.e. documents written before denormalization."""
+    return [
+        document[id_field]
+        for document in documents
+        for id_field, name_field in fields
+        if not document.get(name_field)
+    ]
+
+
+def with_names(document: Dict[str, Any], fields: List[Tuple[str, str]], names: Dict[str, str]) -> Dict[str, Any]:
+    """``document`` with every name field filled, preferring the embedded copy."""
+    return {
+        **document,
+        **{
+            name_field: document.get(name_field) or names.get(document[id_field], UNKNOWN_NAME)
+            for id_field, name_field in fields
+        },
+    }
+
+
+class OwnerNames:
+    """Keeps the user names embedded in equipment and rental requests in sync.
+
+    Names are written into ``equipment.owner_name`` and
+    ``rental_requests.owner_name``/``requester_name`` when those documents
+    are created, so reads need no user lookup. When a user renames
+    themselves, ``propagate`` rewrites their documents with ``update_many``
+    from the stored user record, so repeated or reordered sync jobs
+    converge. ``verify`` finds documents whose embedded name differs from
+    the user's, which also catches writes made with a token issued before
+    the rename, and can repair them.
+    """
+
+    def __init__(self, db, repositories, enabled: bool = True, overlap: float = 300.0):
+        self.db = db
+        self.repositories = repositories
+        self.enabled = enabled
+        # Writes that commit slightly after a run started are still checked by the next one
+        self.overlap = overlap
+
+    @property
+    def state(self):
+        return self.db.owner_names_state
+
+    async def ensure_indexes(self):
+        for collection in NAME_FIELDS:
+            await self.db[collection].create_index([("updated_at", ASCENDING), ("id", ASCENDING)])
+        await self.db.users.create_index([("name_updated_at", ASCENDING)], sparse=True)
+
+    async def propagate(self, user_id: str) -> Dict[str, int]:
+        user = await self.repositories.users.get(user_id)
+        if user is None:
+            return {"equipment": 0, "rental_requests": 0}
+        return {
+            "equipment": await self.repositories.equipment.set_owner_name(user_id, user["name"]),
+            "rental_requests": await self.repositories.rental_requests.set_party_name(user_id, user["name"]),
+        }
+
+    async def _drift(self, collection: str, id_field: str, name_field: str,
+                     scope: Dict[str, Any]) -> List[Dict[str, Any]]:
+        pipeline = [
+            {"$match": scope},
+            {"$project": {"_id": 0, id_field: 1, name_field: 1}},
+            {"$lookup": {"from": "users", "localField": id_field, "foreignField": "id", "as": "user"}},
+            {"$project": {"user_id": f"${id_field}", "stored": f"${name_field}",
+                          "name": {"$ifNull": [{"$arrayElemAt": ["$user.name", 0]}, None]}}},
+            {"$match": {"$expr": {"$ne": ["$stored", "$name"]}}},
+            {"$group": {"_id": "$user_id", "documents": {"$sum": 1}, "name": {"$first": "$name"}}},
+        ]
+        return [row async for row in self.db[collection].aggregate(pipeline, allowDiskUse=True)]
+
+    async def _renamed_since(self, since: datetime) -> List[str]:
+        cursor = self.db.users.find({"name_updated_at": {"$gte": since}}, {"_id": 0, "id": 1})
+        return [user["id"] async for user in cursor]
+
+    async def verify(self, repair: bool = False, full: bool = False) -> Dict[str, Any]:
+        """Count documents whose embedded name is missing or stale, per field.
+
+        Only documents written since the previous run, and those of users
+        renamed since then, are checked; the first run, or one with
+        ``full``, checks everything. Documents of users that no longer exist
+        are reported as orphaned and never repaired. With ``repair``, every
+        other drifting user's documents are rewritten through ``propagate``.
+        """
+        started = datetime.utcnow()
+        checkpoint = None if full else await self.state.find_one({"_id": VERIFY_STATE_ID})
+        since: Optional[datetime] = checkpoint["checked_at"] - timedelta(seconds=self.overlap) if checkpoint else None
+        renamed = await self._renamed_since(since) if since is not None else []
+        report: Dict[str, Any] = {"since": since}
+        drifting = set()
+        for collection, fields in NAME_FIELDS.items():
+            for id_field, name_field in fields:
+                scope = {} if since is None else {
+                    "$or": [{"updated_at": {"$gte": since}}, {id_field: {"$in": renamed}}]
+                }
+                rows = await self._drift(collection, id_field, name_field, scope)
+                report[f"{collection}.{name_field}"] = {
+                    "documents": sum(row["documents"] for row in rows if row.get("name") is not None),
+                    "users": sum(1 for row in rows if row.get("name") is not None),
+                    "orphaned": sum(row["documents"] for row in rows if row.get("name") is None),
+                }
+                drifting.update(row["_id"] for row in rows if row.get("name") is not None)
+        if drifting:
+            logger.warning("Embedded user names out of sync for %s users: %s", len(drifting), report)
+        report["repaired_users"] = 0
+        if repair:
+            for user_id in drifting:
+                await self.propagate(user_id)
+            report["repaired_users"] = len(drifting)
+        await self.state.update_one({"_id": VERIFY_STATE_ID}, {"$set": {"checked_at": started}}, upsert=True)
+        return report
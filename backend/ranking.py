@@ -0,0 +1,96 @@
+import math
+import statistics
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from pymongo import UpdateOne
+
+REFRESH_RANKING_JOB = "ranking.refresh"
+WINDOW_DAYS = 90
+RECENCY_HALF_LIFE_DAYS = 14
+WRITE_BATCH_SIZE = 500
+# Weights of the score components, each of which lies in [0, 1]
+WEIGHTS = {"popularity": 0.35, "approval": 0.25, "recency": 0.2, "price": 0.2}
+# A listing with no requests yet, just created and priced at its category median
+NEW_LISTING_SCORE = WEIGHTS["approval"] * 0.5 + WEIGHTS["recency"] + WEIGHTS["price"] * 0.5
+
+
+def _decay(age: timedelta) -> float:
+    return 0.5 ** (max(age.total_seconds(), 0) / (RECENCY_HALF_LIFE_DAYS * 86400))
+
+
+def ranking_scores(equipment: List[Dict[str, Any]], stats: Dict[str, Dict[str, Any]], now: datetime) -> Dict[str, float]:
+    """Browse score per equipment id, between 0 and 1.
+
+    - popularity: requests in the window, log-scaled against the busiest item
+    - approval: accepted share of decided requests, smoothed towards 1/2
+    - recency: half-life decay since the last request, or since listing for
+      items that were never requested, so new listings get a fair start
+    - price: category median price over the item's price, capped at 2
+    """
+    busiest = max((row["requests"] for row in stats.values()), default=0)
+    prices = defaultdict(list)
+    for item in equipment:
+        if item.get("price_per_day"):
+            prices[item["category"]].append(item["price_per_day"])
+    medians = {category: statistics.median(values) for category, values in prices.items()}
+
+    scores = {}
+    for item in equipment:
+        row = stats.get(item["id"], {})
+        requests = row.get("requests", 0)
+        decided = row.get("accepted", 0) + row.get("declined", 0)
+        components = {
+            "popularity": math.log1p(requests) / math.log1p(busiest) if busiest else 0.0,
+            "approval": (row.get("accepted", 0) + 1) / (decided + 2),
+            "recency": _decay(now - (row.get("last_request") or item.get("created_at") or now)),
+            "price": min(medians.get(item["category"], 0) / item["price_per_day"], 2) / 2
+            if item.get("price_per_day") else 0.5,
+        }
+        scores[item["id"]] = round(sum(WEIGHTS[name] * value for name, value in components.items()), 6)
+    return scores
+
+
+class EquipmentRanker:
+    """Maintains the materialized ``score`` that browse sorts by.
+
+    ``refresh`` aggregates the last ``window_days`` of rental requests per
+    equipment and writes back only scores that changed. It runs as a
+    periodic job; listings created in between start at ``NEW_LISTING_SCORE``.
+    """
+
+    def __init__(self, db, window_days: int = WINDOW_DAYS):
+        self.db = db
+        self.window_days = window_days
+
+    async def request_stats(self, since: datetime) -> Dict[str, Dict[str, Any]]:
+        pipeline = [
+            {"$match": {"created_at": {"$gte": since}}},
+            {"$group": {
+                "_id": "$equipment_id",
+                "requests": {"$sum": 1},
+                "accepted": {"$sum": {"$cond": [{"$in": ["$status", ["approved", "completed"]]}, 1, 0]}},
+                "declined": {"$sum": {"$cond": [{"$eq": ["$status", "declined"]}, 1, 0]}},
+                "last_request": {"$max": "$created_at"},
+            }},
+        ]
+        return {row["_id"]: row async for row in self.db.rental_requests.aggregate(pipeline)}
+
+    async def refresh(self) -> Dict[str, int]:
+        now = datetime.utcnow()
+        stats = await self.request_stats(now - timedelta(days=self.window_days))
+        # Soft-deleted listings are never browsed, and their prices should not shift category medians
+        equipment = await self.db.equipment.find(
+            {"deleted_at": None}, {"_id": 0, "id": 1, "category": 1, "price_per_day": 1, "created_at": 1, "score": 1}
+        ).to_list(None)
+        scores = ranking_scores(equipment, stats, now)
+
+        operations = [
+            UpdateOne({"id": item["id"]}, {"$set": {"score": scores[item["id"]]}})
+            for item in equipment
+            if abs(item.get("score", 0.0) - scores[item["id"]]) > 1e-6
+        ]
+        for start in range(0, len(operations), WRITE_BATCH_SIZE):
+            await self.db.equipment.bulk_write(operations[start:start + WRITE_BATCH_SIZE], ordered=False)
+        return {"equipment": len(equipment), "updated": len(operations)}
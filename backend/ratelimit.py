@@ -0,0 +1,272 @@
+import ipaddress
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RateLimitRule:
+    name: str
+    rate: float  # tokens added per second
+    burst: int  # bucket capacity
+    scope: str = "ip"  # "ip", "user" or "route" (shared by all clients)
+    path_prefix: str = "/"
+    methods: Optional[Tuple[str, ...]] = None
+
+    def matches(self, method: str, path: str) -> bool:
+        if self.methods and method not in self.methods:
+            return False
+        return path.startswith(self.path_prefix)
+
+
+# (bucket key, tokens added per second, capacity)
+Bucket = Tuple[str, float, int]
+
+
+def _outcome(buckets: List[Bucket], levels: List[float], cost: float) -> Tuple[List[int], float]:
+    denied = [index for index, level in enumerate(levels) if level < cost]
+    retry_after = max(((cost - levels[index]) / buckets[index][1] for index in denied), default=0.0)
+    return denied, retry_after
+
+
+class InMemoryBackend:
+    """Token buckets held in process memory, split across locked shards.
+
+    Buckets that have refilled completely carry no information, so they are
+    dropped whenever a shard grows past ``max_keys_per_shard``. Each bucket
+    keeps the time it will be full again under its own rule, since one shard
+    holds buckets of every rule.
+    """
+
+    def __init__(self, shards: int = 16, max_keys_per_shard: int = 10000):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.max_keys_per_shard = max_keys_per_shard
+
+    async def consume_all(self, buckets: List[Bucket], cost: float = 1.0) -> Tuple[List[int], float]:
+        """Take ``cost`` from every bucket, or from none if any is short.
+
+        Returns the indexes of the buckets that were short (empty if the
+        tokens were taken) and the seconds until all of them would allow it.
+        """
+        shards = [hash(key) % len(self._shards) for key, _, _ in buckets]
+        # Locked in a fixed order, so concurrent requests over the same shards cannot deadlock
+        locks = [self._shards[shard][1] for shard in sorted(set(shards))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            now = time.monotonic()
+            levels = []
+            for shard, (key, rate, burst) in zip(shards, buckets):
+                tokens, updated, _ = self._shards[shard][0].get(key, (float(burst), now, now))
+                levels.append(min(float(burst), tokens + (now - updated) * rate))
+            denied, retry_after = _outcome(buckets, levels, cost)
+            taken = 0.0 if denied else cost
+            for shard, (key, rate, burst), tokens in zip(shards, buckets, levels):
+                shard_buckets = self._shards[shard][0]
+                shard_buckets[key] = (tokens - taken, now, now + (burst - tokens + taken) / rate)
+                if len(shard_buckets) > self.max_keys_per_shard:
+                    self._prune(shard_buckets, now)
+            return denied, retry_after
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def _prune(buckets, now: float):
+        for key in [key for key, (_, _, full_at) in buckets.items() if full_at <= now]:
+            del buckets[key]
+
+
+class RedisBackend:
+    """Token buckets shared between processes through Redis.
+
+    All buckets of a request are checked and taken from in one script, so
+    the keys must live on one Redis node (no cluster sharding).
+    """
+
+    SCRIPT = """
+    local cost, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local levels, allowed = {}, true
+    for i = 1, #KEYS do
+        local rate, burst = tonumber(ARGV[1 + 2 * i]), tonumber(ARGV[2 + 2 * i])
+        local tokens = tonumber(redis.call('HGET', KEYS[i], 't') or burst)
+        local updated = tonumber(redis.call('HGET', KEYS[i], 'u') or now)
+        levels[i] = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        if levels[i] < cost then
+            allowed = false
+        end
+    end
+    local taken = allowed and cost or 0
+    local result = {}
+    for i = 1, #KEYS do
+        local rate, burst = tonumber(ARGV[1 + 2 * i]), tonumber(ARGV[2 + 2 * i])
+        redis.call('HSET', KEYS[i], 't', levels[i] - taken, 'u', now)
+        redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 1)
+        result[i] = tostring(levels[i])
+    end
+    return result
+    """
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the 'redis' package") from e
+        self.redis = redis.from_url(url)
+        self.prefix = prefix
+        self._script = self.redis.register_script(self.SCRIPT)
+
+    async def consume_all(self, buckets: List[Bucket], cost: float = 1.0) -> Tuple[List[int], float]:
+        args = [cost, time.time()]
+        for _, rate, burst in buckets:
+            args += [rate, burst]
+        levels = await self._script(keys=[self.prefix + key for key, _, _ in buckets], args=args)
+        return _outcome(buckets, [float(level) for level in levels], cost)
+
+
+class RateLimiter:
+    """Applies every matching rule to a request; it passes only if all of them have tokens.
+
+    The client IP is the connection's peer address. ``X-Real-IP`` is only
+    believed when that peer is one of ``trusted_proxies`` (CIDRs), since any
+    client that reaches the API directly could otherwise pick a fresh IP per
+    request. Likewise "user" rules key on the subject of a bearer token only
+    once ``identify`` has verified it; any other request is counted by IP
+    under that rule, so a forged token can neither drain someone else's
+    bucket nor mint new ones.
+    """
+
+    def __init__(self, rules: List[RateLimitRule], backend=None, trusted_proxies: Iterable[str] = (),
+                 identify: Optional[Callable[[str], Optional[str]]] = None):
+        self.rules = rules
+        self.backend = backend or InMemoryBackend()
+        self.identify = identify
+        self.trusted_proxies = [ipaddress.ip_network(cidr.strip(), strict=False) for cidr in trusted_proxies]
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {"allowed": 0, "limited": 0})
+
+    def _trusted(self, peer: str) -> bool:
+        try:
+            address = ipaddress.ip_address(peer)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    def client_ip(self, scope) -> str:
+        client = scope.get("client")
+        peer = client[0] if client else "unknown"
+        if self.trusted_proxies and self._trusted(peer):
+            for name, value in scope["headers"]:
+                if name == b"x-real-ip":
+                    return value.decode("latin-1").strip()
+        return peer
+
+    def user_id(self, scope) -> Optional[str]:
+        """The verified subject of the request's bearer token, if any."""
+        if self.identify is None:
+            return None
+        for name, value in scope["headers"]:
+            if name == b"authorization" and value[:7].lower() == b"bearer ":
+                return self.identify(value[7:].decode("latin-1"))
+        return None
+
+    async def check(self, scope) -> Optional[float]:
+        """Return None if the request may proceed, else seconds until it may retry."""
+        method, path = scope["method"], scope["path"]
+        ip = user = None
+        identified = False
+        buckets: List[Bucket] = []
+        applied: List[RateLimitRule] = []
+        for rule in self.rules:
+            if not rule.matches(method, path):
+                continue
+            if rule.scope == "user" and not identified:
+                user, identified = self.user_id(scope), True
+            # Without a verified subject, a "user" rule counts by client IP instead
+            if rule.scope == "user" and user is not None:
+                key = f"{rule.name}:user:{user}"
+            elif rule.scope == "route":
+                key = f"{rule.name}:route"
+            else:
+                ip = ip or self.client_ip(scope)
+                key = f"{rule.name}:ip:{ip}"
+            buckets.append((key, rule.rate, rule.burst))
+            applied.append(rule)
+        if not buckets:
+            return None
+        # All or nothing: a request refused by one rule leaves the other rules' tokens alone
+        denied, retry_after = await self.backend.consume_all(buckets)
+        for index, rule in enumerate(applied):
+            if not denied:
+                self.counters[rule.name]["allowed"] += 1
+            elif index in denied:
+                self.counters[rule.name]["limited"] += 1
+        return retry_after if denied else None
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: dict(counts) for name, counts in self.counters.items()}
+
+
+class RateLimitMiddleware:
+    """ASGI middleware that rejects over-limit requests before routing."""
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+        try:
+            retry_after = await self.limiter.check(scope)
+        except Exception:
+            # Never take the API down because the limiter backend is unavailable
+            logger.exception("Rate limiter check failed")
+            retry_after = None
+        if retry_after is None:
+            return await self.app(scope, receive, send)
+
+        body = json.dumps({"detail": "Too many requests"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def default_rules() -> List[RateLimitRule]:
+    return [
+        # bcrypt-backed endpoints: roughly 10 attempts per minute per IP
+        RateLimitRule("auth_login", rate=10 / 60, burst=10, path_prefix="/api/auth/login", methods=("POST",)),
+        RateLimitRule("auth_register", rate=5 / 60, burst=5, path_prefix="/api/auth/register", methods=("POST",)),
+        # Caps total bcrypt work regardless of how many IPs are involved: per process with the
+        # memory backend, across all processes with Redis
+        RateLimitRule("auth_total", rate=20, burst=40, scope="route", path_prefix="/api/auth/", methods=("POST",)),
+        RateLimitRule("equipment_browse", rate=2, burst=60, path_prefix="/api/equipment", methods=("GET",)),
+        RateLimitRule("user", rate=10, burst=100, scope="user", path_prefix="/api/"),
+        RateLimitRule("ip", rate=20, burst=200, path_prefix="/api/"),
+    ]
+
+
+def limiter_from_env(env, identify: Optional[Callable[[str], Optional[str]]] = None) -> RateLimiter:
+    backend = None
+    if env.get("RATE_LIMIT_BACKEND", "memory") == "redis":
+        backend = RedisBackend(env.get("REDIS_URL", "redis://localhost:6379/0"))
+    return RateLimiter(
+        default_rules(),
+        backend=backend,
+        # e.g. the reverse proxy's network; unset means X-Real-IP is never trusted
+        trusted_proxies=[cidr for cidr in env.get("TRUSTED_PROXIES", "").split(",") if cidr.strip()],
+        identify=identify,
+    )
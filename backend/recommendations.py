@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import math
+import re
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+REBUILD_RECOMMENDATIONS_JOB = "recommendations.rebuild"
+RECORD_RENTAL_JOB = "recommendations.record_rental"
+FORGET_EQUIPMENT_JOB = "recommendations.forget_equipment"
+TOP_K = 20
+PAIR_CANDIDATES = 200
+WRITE_BATCH_SIZE = 500
+SIMILARITY_BLOCK_ROWS = 1000
+TOKEN_PATTERN = re.compile(r"[^\W_]{2,}")
+
+Neighbors = List[Dict[str, Any]]
+
+
+def _scipy():
+    # The API processes never build matrices; only the job worker pays for the import
+    import numpy
+    from scipy import sparse
+
+    return numpy, sparse
+
+
+def tokenize(equipment: Dict[str, Any]) -> List[str]:
+    words = TOKEN_PATTERN.findall(f"{equipment.get('title', '')} {equipment.get('description', '')}".lower())
+    # The title counts twice and the category acts as one extra, usually rare, term
+    words += TOKEN_PATTERN.findall(str(equipment.get("title", "")).lower())
+    if equipment.get("category"):
+        words.append(f"category:{equipment['category']}")
+    return words
+
+
+def top_k_rows(matrix, ids: Sequence[str], k: int, row_offset: int = 0) -> List[Neighbors]:
+    """Highest-scoring columns of each CSR row, excluding the row's own item."""
+    numpy, _ = _scipy()
+    result = []
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        columns, scores = matrix.indices[start:end], matrix.data[start:end]
+        keep = (columns != row + row_offset) & (scores > 0)
+        columns, scores = columns[keep], scores[keep]
+        if len(scores) > k:
+            best = numpy.argpartition(-scores, k)[:k]
+            columns, scores = columns[best], scores[best]
+        order = numpy.argsort(-scores, kind="stable")
+        result.append([
+            {"equipment_id": ids[columns[index]], "score": round(float(scores[index]), 4)} for index in order
+        ])
+    return result
+
+
+def text_neighbors(equipment: Sequence[Dict[str, Any]], k: int = TOP_K) -> List[Neighbors]:
+    """TF-IDF cosine similarity over title, description and category."""
+    numpy, sparse = _scipy()
+    ids = [item["id"] for item in equipment]
+    vocabulary: Dict[str, int] = {}
+    rows, columns = [], []
+    for row, item in enumerate(equipment):
+        for token in tokenize(item):
+            rows.append(row)
+            columns.append(vocabulary.setdefault(token, len(vocabulary)))
+    counts = sparse.csr_matrix(
+        (numpy.ones(len(rows)), (rows, columns)), shape=(len(equipment), max(len(vocabulary), 1))
+    )
+    counts.sum_duplicates()
+
+    document_frequency = numpy.bincount(counts.indices, minlength=counts.shape[1])
+    idf = numpy.log((1 + len(equipment)) / (1 + document_frequency)) + 1
+    weights = counts.multiply(idf).tocsr()
+    norms = numpy.sqrt(numpy.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    weights = (sparse.diags(1 / norms) @ weights).tocsr()
+
+    neighbors: List[Neighbors] = []
+    transposed = weights.T.tocsc()
+    # Row blocks keep the similarity matrix from being materialized all at once
+    for start in range(0, len(equipment), SIMILARITY_BLOCK_ROWS):
+        block = (weights[start:start + SIMILARITY_BLOCK_ROWS] @ transposed).tocsr()
+        neighbors += top_k_rows(block, ids, k, row_offset=start)
+    return neighbors
+
+
+def co_rental_matrix(ids: Sequence[str], rentals: Iterable[Tuple[str, str]]):
+    """Item-by-item counts of distinct renters who requested both items, plus renters per item."""
+    numpy, sparse = _scipy()
+    item_index = {item_id: index for index, item_id in enumerate(ids)}
+    user_index: Dict[str, int] = {}
+    rows, columns = [], []
+    for requester_id, equipment_id in rentals:
+        if equipment_id in item_index:
+            rows.append(user_index.setdefault(requester_id, len(user_index)))
+            columns.append(item_index[equipment_id])
+    renters_matrix = sparse.csr_matrix(
+        (numpy.ones(len(rows)), (rows, columns)), shape=(max(len(user_index), 1), len(ids))
+    )
+    renters_matrix.sum_duplicates()
+    renters_matrix.data[:] = 1  # rented at all, not how often
+    counts = (renters_matrix.T @ renters_matrix).tocsr()
+    counts.setdiag(0)
+    counts.eliminate_zeros()
+    return counts, numpy.asarray(renters_matrix.sum(axis=0)).ravel()
+
+
+def co_rental_neighbors(ids: Sequence[str], counts, renters, k: int = TOP_K) -> List[Neighbors]:
+    """Scores for "renters also rented": co-rental counts over sqrt(renters_a * renters_b)."""
+    numpy, sparse = _scipy()
+    scale = 1 / numpy.sqrt(numpy.maximum(renters, 1))
+    scores = (sparse.diags(scale) @ counts @ sparse.diags(scale)).tocsr()
+    return top_k_rows(scores, ids, k)
+
+
+class Recommender:
+    """Precomputed "similar items" and "renters also rented" lists per equipment.
+
+    ``rebuild`` recomputes both from scratch in the job worker: TF-IDF cosine
+    similarity over listing text and normalized co-rental counts from
+    ``rental_requests``. Between rebuilds, ``record_rental`` folds each new
+    request into the pair counts in ``equipment_pairs`` and refreshes the
+    affected items' lists, and ``forget`` removes deleted listings. Reads
+    are a single lookup by ``equipment_id``.
+    """
+
+    def __init__(self, db, top_k: int = TOP_K, enabled: bool = True):
+        self.db = db
+        self.top_k = top_k
+        self.enabled = enabled
+
+    @property
+    def lists(self):
+        return self.db.equipment_recommendations
+
+    @property
+    def pairs(self):
+        return self.db.equipment_pairs
+
+    async def ensure_indexes(self):
+        await self.lists.create_index("equipment_id", unique=True)
+        await self.pairs.create_index([("a", ASCENDING), ("b", ASCENDING)], unique=True)
+        await self.pairs.create_index([("a", ASCENDING), ("count", DESCENDING)])
+
+    async def get(self, equipment_id: str) -> Optional[Dict[str, Any]]:
+        return await self.lists.find_one({"equipment_id": equipment_id}, {"_id": 0})
+
+    async def rebuild(self) -> Dict[str, int]:
+        started = datetime.utcnow()
+        # Soft-deleted listings must not come back as neighbors, or take part in the co-rental counts
+        equipment = await self.db.equipment.find(
+            {"deleted_at": None}, {"_id": 0, "id": 1, "title": 1, "description": 1, "category": 1}
+        ).to_list(None)
+        if not equipment:
+            return {"equipment": 0, "pairs": 0}
+        ids = [item["id"] for item in equipment]
+        rentals = [
+            (request["requester_id"], request["equipment_id"])
+            async for request in self.db.rental_requests.find(
+                {"equipment_id": {"$in": ids}}, {"_id": 0, "requester_id": 1, "equipment_id": 1}
+            )
+        ]
+
+        def compute():
+            counts, renters = co_rental_matrix(ids, rentals)
+            return text_neighbors(equipment, self.top_k), co_rental_neighbors(ids, counts, renters, self.top_k), counts, renters
+
+        # Matrix work runs off the event loop
+        similar, also_rented, counts, renters = await asyncio.to_thread(compute)
+
+        operations = [
+            UpdateOne(
+                {"equipment_id": item_id},
+                {"$set": {"similar": similar[index], "also_rented": also_rented[index],
+                          "renters": int(renters[index]), "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            for index, item_id in enumerate(ids)
+        ]
+        await self._write(self.lists, operations)
+        await self.lists.delete_many({"updated_at": {"$lt": started}})
+
+        coo = counts.tocoo()
+        await self.pairs.delete_many({})
+        pairs = [{"a": ids[a], "b": ids[b], "count": int(count)} for a, b, count in zip(coo.row, coo.col, coo.data)]
+        for start in range(0, len(pairs), WRITE_BATCH_SIZE):
+            try:
+                await self.pairs.insert_many(pairs[start:start + WRITE_BATCH_SIZE], ordered=False)
+            except BulkWriteError:
+                # record_rental may have upserted the same pair meanwhile; its count is current
+                pass
+        return {"equipment": len(ids), "pairs": len(pairs)}
+
+    @staticmethod
+    async def _write(collection, operations: List[UpdateOne]):
+        for start in range(0, len(operations), WRITE_BATCH_SIZE):
+            await collection.bulk_write(operations[start:start + WRITE_BATCH_SIZE], ordered=False)
+
+    async def record_rental(self, requester_id: str, equipment_id: str) -> Dict[str, int]:
+        """Fold one new rental request into the co-rental counts.
+
+        Only a renter's first request for an item changes anything. Two
+        workers processing the same renter at once can miscount a pair; the
+        next rebuild corrects it.
+        """
+        if await self.db.rental_requests.count_documents(
+            {"requester_id": requester_id, "equipment_id": equipment_id}, limit=2
+        ) != 1:
+            return {"updated": 0}
+        others = [
+            other for other in await self.db.rental_requests.distinct("equipment_id", {"requester_id": requester_id})
+            if other != equipment_id
+        ]
+        await self.lists.update_one({"equipment_id": equipment_id}, {"$inc": {"renters": 1}}, upsert=True)
+        if others:
+            await self._write(self.pairs, [
+                UpdateOne({"a": a, "b": b}, {"$inc": {"count": 1}}, upsert=True)
+                for other in others for a, b in ((equipment_id, other), (other, equipment_id))
+            ])
+        for item_id in [equipment_id] + others:
+            await self._refresh_also_rented(item_id)
+        return {"updated": len(others) + 1}
+
+    async def forget(self, equipment_id: str) -> Dict[str, int]:
+        """Drop a deleted listing's lists and pair counts, and rescore its co-rented items."""
+        others = await self.pairs.distinct("b", {"a": equipment_id})
+        await self.lists.delete_one({"equipment_id": equipment_id})
+        await self.pairs.delete_many({"a": equipment_id})
+        # Looked up through the (a, b) index rather than scanning on b alone
+        await self.pairs.delete_many({"a": {"$in": others}, "b": equipment_id})
+        for item_id in others:
+            await self._refresh_also_rented(item_id)
+        return {"updated": len(others)}
+
+    async def _refresh_also_rented(self, equipment_id: str):
+        pairs = await self.pairs.find({"a": equipment_id}).sort("count", DESCENDING).to_list(PAIR_CANDIDATES)
+        ids = [equipment_id] + [pair["b"] for pair in pairs]
+        renters = {
+            row["equipment_id"]: row.get("renters", 0)
+            async for row in self.lists.find({"equipment_id": {"$in": ids}}, {"equipment_id": 1, "renters": 1})
+        }
+        own = max(renters.get(equipment_id, 0), 1)
+        scored = sorted(
+            ({"equipment_id": pair["b"], "score": round(pair["count"] / math.sqrt(own * max(renters.get(pair["b"], 0), 1)), 4)}
+             for pair in pairs),
+            key=lambda neighbor: -neighbor["score"]
+        )
+        await self.lists.update_one(
+            {"equipment_id": equipment_id},
+            {"$set": {"also_rented": scored[:self.top_k], "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
@@ -0,0 +1,604 @@
+import bisect
+import re
+from collections import Counter, defaultdict
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+Document = Dict[str, Any]
+
+CURSOR_BATCH_SIZE = 100
+# Browse orderings, each backed by an equipment index
+SEARCH_SORTS = {
+    "score": [("score", DESCENDING), ("id", ASCENDING)],
+    # id breaks ties, so skip/limit pages over equal prices neither repeat nor skip listings
+    "price": [("price_per_day", ASCENDING), ("id", ASCENDING)],
+}
+
+# collection -> [(index keys, unique)]
+INDEXES = {
+    "users": [([("id", ASCENDING)], True), ([("email", ASCENDING)], False)],
+    "equipment": [
+        ([("id", ASCENDING)], True),
+        ([("owner_id", ASCENDING)], False),
+        ([("is_available", ASCENDING), ("category", ASCENDING), ("price_per_day", ASCENDING), ("id", ASCENDING)], False),
+        # "Best first" browse, with and without a category filter
+        ([("is_available", ASCENDING), ("category", ASCENDING), ("score", DESCENDING), ("id", ASCENDING)], False),
+        ([("is_available", ASCENDING), ("score", DESCENDING), ("id", ASCENDING)], False),
+    ],
+    "rental_requests": [
+        ([("id", ASCENDING)], True),
+        ([("owner_id", ASCENDING)], False),
+        ([("requester_id", ASCENDING)], False),
+    ],
+    "messages": [([("request_id", ASCENDING), ("timestamp", ASCENDING)], False)],
+}
+
+# collection -> [(index keys, partial filter)]; indexes over the few documents that match the filter
+PARTIAL_INDEXES = {
+    # Soft-deleted listings, for purging
+    "equipment": [([("deleted_at", ASCENDING)], {"deleted_at": {"$exists": True}})],
+}
+
+
+class QueryLog:
+    """Counts repository operations so tests and benchmarks can assert on them."""
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+
+    def record(self, operation: str):
+        self.counts[operation] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+    def total(self, prefix: str = "") -> int:
+        return sum(count for operation, count in self.counts.items() if operation.startswith(prefix))
+
+
+class Repositories:
+    """Data access for users, equipment, rental requests and messages.
+
+    Handlers receive an instance through the ``get_repositories`` dependency,
+    so tests can swap in ``InMemoryRepositories``.
+    """
+
+    def __init__(self, users, equipment, rental_requests, messages, queries: QueryLog):
+        self.users = users
+        self.equipment = equipment
+        self.rental_requests = rental_requests
+        self.messages = messages
+        self.queries = queries
+
+    def reader(self, route: str) -> "Repositories":
+        """Repositories for a read path that may be served by a replica."""
+        return self
+
+    def mark_write(self):
+        """Record that the current request wrote, so the client's next reads see it."""
+        pass
+
+    async def ensure_indexes(self):
+        pass
+
+    async def missing_indexes(self) -> List[str]:
+        return []
+
+
+# MongoDB implementation
+class _MotorRepository:
+    collection_name = ""
+
+    def __init__(self, db, queries: QueryLog):
+        self.db = db
+        self.queries = queries
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    def _record(self, operation: str):
+        self.queries.record(f"{self.collection_name}.{operation}")
+
+    async def get(self, document_id: str) -> Optional[Document]:
+        self._record("get")
+        return await self.collection.find_one({"id": document_id})
+
+    async def insert(self, document: Document):
+        self._record("insert")
+        await self.collection.insert_one(document)
+
+
+class MotorUserRepository(_MotorRepository):
+    collection_name = "users"
+
+    async def get_by_email(self, email: str) -> Optional[Document]:
+        self._record("get_by_email")
+        return await self.collection.find_one({"email": email})
+
+    async def names(self, user_ids: Iterable[str]) -> Dict[str, str]:
+        self._record("names")
+        users = self.collection.find({"id": {"$in": list(set(user_ids))}}, {"id": 1, "name": 1})
+        return {user["id"]: user["name"] async for user in users}
+
+    async def bump_token_version(self, user_id: str) -> int:
+        """Invalidate all tokens issued so far; returns the new version."""
+        self._record("bump_token_version")
+        user = await self.collection.find_one_and_update(
+            {"id": user_id}, {"$inc": {"token_version": 1}},
+            projection={"token_version": 1}, return_document=ReturnDocument.AFTER
+        )
+        return user["token_version"]
+
+    async def update_profile(self, user_id: str, fields: Document) -> Optional[Document]:
+        """Apply profile changes; returns the updated user, or None if it does not exist."""
+        self._record("update_profile")
+        return await self.collection.find_one_and_update(
+            {"id": user_id}, {"$set": fields}, return_document=ReturnDocument.AFTER
+        )
+
+
+class MotorEquipmentRepository(_MotorRepository):
+    collection_name = "equipment"
+
+    async def insert_many(self, documents: List[Document]) -> Dict[int, str]:
+        """Insert documents unordered; returns error messages keyed by position."""
+        self._record("insert_many")
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            return {
+                write_error["index"]: write_error.get("errmsg", "Insert failed")
+                for write_error in e.details.get("writeErrors", [])
+            }
+        return {}
+
+    async def search(self, category: Optional[str] = None, location: Optional[str] = None,
+                     max_price: Optional[float] = None, skip: int = 0, limit: int = 20,
+                     sort: str = "score") -> List[Document]:
+        self._record("search")
+        query: Document = {"is_available": True}
+        if category:
+            query["category"] = category
+        if location:
+            query["location"] = {"$regex": location, "$options": "i"}
+        if max_price:
+            query["price_per_day"] = {"$lte": max_price}
+        cursor = self.collection.find(query).sort(SEARCH_SORTS[sort])
+        return await cursor.skip(skip).limit(limit).to_list(limit)
+
+    def iter_by_owner(self, owner_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_by_owner")
+        return self.collection.find(
+            {"owner_id": owner_id, "deleted_at": None}, batch_size=CURSOR_BATCH_SIZE, limit=limit
+        )
+
+    async def get_many(self, equipment_ids: Iterable[str]) -> Dict[str, Document]:
+        self._record("get_many")
+        equipment = self.collection.find({"id": {"$in": list(set(equipment_ids))}}, {"images": 0})
+        return {item["id"]: item async for item in equipment}
+
+    async def titles(self, equipment_ids: Iterable[str]) -> Dict[str, str]:
+        self._record("titles")
+        equipment = self.collection.find({"id": {"$in": list(set(equipment_ids))}}, {"id": 1, "title": 1})
+        return {item["id"]: item["title"] async for item in equipment}
+
+    async def set_owner_name(self, owner_id: str, name: str) -> int:
+        self._record("set_owner_name")
+        result = await self.collection.update_many(
+            {"owner_id": owner_id, "owner_name": {"$ne": name}}, {"$set": {"owner_name": name}}
+        )
+        return result.modified_count
+
+    async def update(self, equipment_id: str, owner_id: str, fields: Document) -> Optional[Document]:
+        """Set only ``fields`` on a live listing the caller owns; returns it updated, or None."""
+        self._record("update")
+        return await self.collection.find_one_and_update(
+            {"id": equipment_id, "owner_id": owner_id, "deleted_at": None},
+            {"$set": fields},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def soft_delete(self, equipment_id: str, owner_id: str, deleted_at) -> Optional[Document]:
+        """Hide a listing the caller owns; it stays stored for the requests that refer to it."""
+        self._record("soft_delete")
+        return await self.collection.find_one_and_update(
+            {"id": equipment_id, "owner_id": owner_id, "deleted_at": None},
+            {"$set": {"deleted_at": deleted_at, "is_available": False, "updated_at": deleted_at}},
+            projection={"images": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def add_images(self, equipment_id: str, owner_id: str, urls: List[str], max_images: int,
+                         updated_at, sources: Optional[Dict[str, Document]] = None) -> Optional[Document]:
+        """Append images to a live listing the caller owns if it stays within ``max_images``.
+
+        ``sources`` maps stored image ids to their responsive variants.
+        """
+        self._record("add_images")
+        updates = {"updated_at": updated_at}
+        updates.update({f"image_sources.{image_id}": source for image_id, source in (sources or {}).items()})
+        return await self.collection.find_one_and_update(
+            {"id": equipment_id, "owner_id": owner_id, "deleted_at": None,
+             f"images.{max_images - len(urls)}": {"$exists": False}},
+            {"$push": {"images": {"$each": urls}}, "$set": updates},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def remove_image(self, equipment_id: str, owner_id: str, url: str, updated_at,
+                           image_id: Optional[str] = None) -> Optional[Document]:
+        self._record("remove_image")
+        update = {"$pull": {"images": url}, "$set": {"updated_at": updated_at}}
+        if image_id:
+            update["$unset"] = {f"image_sources.{image_id}": ""}
+        return await self.collection.find_one_and_update(
+            {"id": equipment_id, "owner_id": owner_id, "deleted_at": None, "images": url},
+            update,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def purge_deleted(self, deleted_before, limit: int = 500) -> Dict[str, Tuple[str, List[str]]]:
+        """Drop the images of up to ``limit`` listings deleted before ``deleted_before``.
+
+        Returns the owner and dropped images per listing, so stored image files can be removed too.
+        """
+        self._record("purge_deleted")
+        query = {"deleted_at": {"$lt": deleted_before}, "images.0": {"$exists": True}}
+        purged = {
+            item["id"]: (item["owner_id"], item["images"])
+            async for item in self.collection.find(query, {"id": 1, "owner_id": 1, "images": 1}, limit=limit)
+        }
+        if purged:
+            await self.collection.update_many(
+                {"id": {"$in": list(purged)}}, {"$set": {"images": []}, "$unset": {"image_sources": ""}}
+            )
+        return purged
+
+
+class MotorRentalRequestRepository(_MotorRepository):
+    collection_name = "rental_requests"
+
+    def iter_for_owner(self, owner_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_for_owner")
+        return self.collection.find({"owner_id": owner_id}, batch_size=CURSOR_BATCH_SIZE, limit=limit)
+
+    def iter_for_requester(self, requester_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_for_requester")
+        return self.collection.find({"requester_id": requester_id}, batch_size=CURSOR_BATCH_SIZE, limit=limit)
+
+    async def transition(self, request_id: str, owner_id: str, sources: Iterable[str], status: str, updated_at,
+                         expected_version: Optional[int] = None,
+                         idempotency_key: Optional[str] = None) -> Optional[Document]:
+        """Move a request to ``status`` if it is currently in one of ``sources``.
+
+        A single conditional update, so concurrent transitions cannot both
+        apply. Returns the document as it was before the update, or None if
+        nothing matched.
+        """
+        self._record("transition")
+        query: Document = {"id": request_id, "owner_id": owner_id, "status": {"$in": list(sources)}}
+        if expected_version is not None:
+            # Requests created before versioning have no version field
+            query["version"] = {"$in": [0, None]} if expected_version == 0 else expected_version
+        return await self.collection.find_one_and_update(
+            query,
+            {"$set": {"status": status, "updated_at": updated_at, "status_idempotency_key": idempotency_key},
+             "$inc": {"version": 1}},
+            return_document=ReturnDocument.BEFORE
+        )
+
+    async def set_party_name(self, user_id: str, name: str) -> int:
+        """Rewrite the user's embedded name on requests they own or made."""
+        self._record("set_party_name")
+        modified = 0
+        for id_field, name_field in (("owner_id", "owner_name"), ("requester_id", "requester_name")):
+            result = await self.collection.update_many(
+                {id_field: user_id, name_field: {"$ne": name}}, {"$set": {name_field: name}}
+            )
+            modified += result.modified_count
+        return modified
+
+
+class MotorMessageRepository(_MotorRepository):
+    collection_name = "messages"
+
+    def iter_for_request(self, request_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_for_request")
+        return self.collection.find(
+            {"request_id": request_id}, batch_size=CURSOR_BATCH_SIZE, limit=limit
+        ).sort("timestamp", ASCENDING)
+
+
+class MotorRepositories(Repositories):
+    def __init__(self, db, queries: Optional[QueryLog] = None):
+        queries = queries or QueryLog()
+        super().__init__(
+            MotorUserRepository(db, queries),
+            MotorEquipmentRepository(db, queries),
+            MotorRentalRequestRepository(db, queries),
+            MotorMessageRepository(db, queries),
+            queries,
+        )
+        self.db = db
+
+    def reader(self, route: str) -> Repositories:
+        return MotorRepositories(self.db.reader(route), self.queries)
+
+    def mark_write(self):
+        self.db.mark_write()
+
+    async def ensure_indexes(self):
+        for collection, indexes in INDEXES.items():
+            for keys, unique in indexes:
+                await self.db[collection].create_index(keys, unique=unique)
+        for collection, indexes in PARTIAL_INDEXES.items():
+            for keys, partial_filter in indexes:
+                await self.db[collection].create_index(keys, partialFilterExpression=partial_filter)
+
+    async def missing_indexes(self) -> List[str]:
+        missing = []
+        for collection in set(INDEXES) | set(PARTIAL_INDEXES):
+            indexes = INDEXES.get(collection, []) + PARTIAL_INDEXES.get(collection, [])
+            existing = [list(info["key"]) for info in (await self.db[collection].index_information()).values()]
+            for keys, _ in indexes:
+                if keys not in existing:
+                    missing.append(f"{collection}:{','.join(field for field, _ in keys)}")
+        return missing
+
+
+# In-memory implementation
+async def _iterate(documents: Iterable[Document], limit: int = 0) -> AsyncIterator[Document]:
+    for count, document in enumerate(documents):
+        if limit and count >= limit:
+            return
+        yield dict(document)
+
+
+class _InMemoryRepository:
+    name = ""
+
+    def __init__(self, queries: QueryLog):
+        self.queries = queries
+        self.by_id: Dict[str, Document] = {}
+
+    def _record(self, operation: str):
+        self.queries.record(f"{self.name}.{operation}")
+
+    def _index(self, document: Document):
+        pass
+
+    async def get(self, document_id: str) -> Optional[Document]:
+        self._record("get")
+        document = self.by_id.get(document_id)
+        return dict(document) if document else None
+
+    async def insert(self, document: Document):
+        self._record("insert")
+        if document["id"] in self.by_id:
+            raise ValueError(f"Duplicate id {document['id']}")
+        self.by_id[document["id"]] = dict(document)
+        self._index(self.by_id[document["id"]])
+
+
+class InMemoryUserRepository(_InMemoryRepository):
+    name = "users"
+
+    def __init__(self, queries: QueryLog):
+        super().__init__(queries)
+        self.by_email: Dict[str, Document] = {}
+
+    def _index(self, document: Document):
+        self.by_email[document["email"]] = document
+
+    async def get_by_email(self, email: str) -> Optional[Document]:
+        self._record("get_by_email")
+        document = self.by_email.get(email)
+        return dict(document) if document else None
+
+    async def names(self, user_ids: Iterable[str]) -> Dict[str, str]:
+        self._record("names")
+        return {user_id: self.by_id[user_id]["name"] for user_id in set(user_ids) if user_id in self.by_id}
+
+    async def bump_token_version(self, user_id: str) -> int:
+        self._record("bump_token_version")
+        user = self.by_id[user_id]
+        user["token_version"] = user.get("token_version", 0) + 1
+        return user["token_version"]
+
+    async def update_profile(self, user_id: str, fields: Document) -> Optional[Document]:
+        self._record("update_profile")
+        user = self.by_id.get(user_id)
+        if user is None:
+            return None
+        user.update(fields)
+        return dict(user)
+
+
+class InMemoryEquipmentRepository(_InMemoryRepository):
+    name = "equipment"
+
+    def __init__(self, queries: QueryLog):
+        super().__init__(queries)
+        self.by_owner: Dict[str, List[Document]] = defaultdict(list)
+
+    def _index(self, document: Document):
+        self.by_owner[document["owner_id"]].append(document)
+
+    async def insert_many(self, documents: List[Document]) -> Dict[int, str]:
+        self._record("insert_many")
+        errors = {}
+        for index, document in enumerate(documents):
+            if document["id"] in self.by_id:
+                errors[index] = f"Duplicate id {document['id']}"
+                continue
+            self.by_id[document["id"]] = dict(document)
+            self._index(self.by_id[document["id"]])
+        return errors
+
+    async def search(self, category: Optional[str] = None, location: Optional[str] = None,
+                     max_price: Optional[float] = None, skip: int = 0, limit: int = 20,
+                     sort: str = "score") -> List[Document]:
+        self._record("search")
+        pattern = re.compile(location, re.IGNORECASE) if location else None
+        matches = [
+            document for document in self.by_id.values()
+            if document.get("is_available", True)
+            and (not category or document["category"] == category)
+            and (not pattern or pattern.search(document["location"]))
+            and (not max_price or document["price_per_day"] <= max_price)
+        ]
+        if sort == "score":
+            matches.sort(key=lambda document: (-document.get("score", 0.0), document["id"]))
+        else:
+            matches.sort(key=lambda document: (document["price_per_day"], document["id"]))
+        return [dict(document) for document in matches[skip:skip + limit]]
+
+    def iter_by_owner(self, owner_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_by_owner")
+        return _iterate([document for document in self.by_owner.get(owner_id, []) if not document.get("deleted_at")], limit)
+
+    async def get_many(self, equipment_ids: Iterable[str]) -> Dict[str, Document]:
+        self._record("get_many")
+        return {item_id: dict(self.by_id[item_id]) for item_id in set(equipment_ids) if item_id in self.by_id}
+
+    async def titles(self, equipment_ids: Iterable[str]) -> Dict[str, str]:
+        self._record("titles")
+        return {item_id: self.by_id[item_id]["title"] for item_id in set(equipment_ids) if item_id in self.by_id}
+
+    async def set_owner_name(self, owner_id: str, name: str) -> int:
+        self._record("set_owner_name")
+        stale = [document for document in self.by_owner.get(owner_id, []) if document.get("owner_name") != name]
+        for document in stale:
+            document["owner_name"] = name
+        return len(stale)
+
+    def _owned_live(self, equipment_id: str, owner_id: str) -> Optional[Document]:
+        document = self.by_id.get(equipment_id)
+        if document is None or document["owner_id"] != owner_id or document.get("deleted_at"):
+            return None
+        return document
+
+    async def update(self, equipment_id: str, owner_id: str, fields: Document) -> Optional[Document]:
+        self._record("update")
+        document = self._owned_live(equipment_id, owner_id)
+        if document is None:
+            return None
+        document.update(fields)
+        return dict(document)
+
+    async def soft_delete(self, equipment_id: str, owner_id: str, deleted_at) -> Optional[Document]:
+        self._record("soft_delete")
+        document = self._owned_live(equipment_id, owner_id)
+        if document is None:
+            return None
+        document.update(deleted_at=deleted_at, is_available=False, updated_at=deleted_at)
+        return dict(document)
+
+    async def add_images(self, equipment_id: str, owner_id: str, urls: List[str], max_images: int,
+                         updated_at, sources: Optional[Dict[str, Document]] = None) -> Optional[Document]:
+        self._record("add_images")
+        document = self._owned_live(equipment_id, owner_id)
+        if document is None or len(document.get("images", [])) + len(urls) > max_images:
+            return None
+        document.update(images=document.get("images", []) + urls, updated_at=updated_at,
+                        image_sources={**document.get("image_sources", {}), **(sources or {})})
+        return dict(document)
+
+    async def remove_image(self, equipment_id: str, owner_id: str, url: str, updated_at,
+                           image_id: Optional[str] = None) -> Optional[Document]:
+        self._record("remove_image")
+        document = self._owned_live(equipment_id, owner_id)
+        if document is None or url not in document.get("images", []):
+            return None
+        sources = {key: source for key, source in document.get("image_sources", {}).items() if key != image_id}
+        document.update(images=[image for image in document["images"] if image != url], updated_at=updated_at,
+                        image_sources=sources)
+        return dict(document)
+
+    async def purge_deleted(self, deleted_before, limit: int = 500) -> Dict[str, Tuple[str, List[str]]]:
+        self._record("purge_deleted")
+        purged = {}
+        for document in self.by_id.values():
+            if len(purged) >= limit:
+                break
+            if document.get("deleted_at") and document["deleted_at"] < deleted_before and document.get("images"):
+                purged[document["id"]] = (document["owner_id"], document["images"])
+                document["images"] = []
+                document.pop("image_sources", None)
+        return purged
+
+
+class InMemoryRentalRequestRepository(_InMemoryRepository):
+    name = "rental_requests"
+
+    def __init__(self, queries: QueryLog):
+        super().__init__(queries)
+        self.by_owner: Dict[str, List[Document]] = defaultdict(list)
+        self.by_requester: Dict[str, List[Document]] = defaultdict(list)
+
+    def _index(self, document: Document):
+        self.by_owner[document["owner_id"]].append(document)
+        self.by_requester[document["requester_id"]].append(document)
+
+    def iter_for_owner(self, owner_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_for_owner")
+        return _iterate(list(self.by_owner.get(owner_id, [])), limit)
+
+    def iter_for_requester(self, requester_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_for_requester")
+        return _iterate(list(self.by_requester.get(requester_id, [])), limit)
+
+    async def transition(self, request_id: str, owner_id: str, sources: Iterable[str], status: str, updated_at,
+                         expected_version: Optional[int] = None,
+                         idempotency_key: Optional[str] = None) -> Optional[Document]:
+        self._record("transition")
+        document = self.by_id.get(request_id)
+        if (document is None or document["owner_id"] != owner_id or document["status"] not in sources
+                or (expected_version is not None and document.get("version", 0) != expected_version)):
+            return None
+        before = dict(document)
+        document.update(status=status, updated_at=updated_at, status_idempotency_key=idempotency_key,
+                        version=document.get("version", 0) + 1)
+        return before
+
+    async def set_party_name(self, user_id: str, name: str) -> int:
+        self._record("set_party_name")
+        modified = 0
+        for index, name_field in ((self.by_owner, "owner_name"), (self.by_requester, "requester_name")):
+            for document in index.get(user_id, []):
+                if document.get(name_field) != name:
+                    document[name_field] = name
+                    modified += 1
+        return modified
+
+
+class InMemoryMessageRepository(_InMemoryRepository):
+    name = "messages"
+
+    def __init__(self, queries: QueryLog):
+        super().__init__(queries)
+        self.by_request: Dict[str, List[Document]] = defaultdict(list)
+
+    def _index(self, document: Document):
+        # Kept sorted by timestamp, matching the Mongo index order
+        bisect.insort(self.by_request[document["request_id"]], document, key=lambda item: item["timestamp"])
+
+    def iter_for_request(self, request_id: str, limit: int = 0) -> AsyncIterator[Document]:
+        self._record("iter_for_request")
+        return _iterate(list(self.by_request.get(request_id, [])), limit)
+
+
+class InMemoryRepositories(Repositories):
+    """Dict-backed repositories with the same secondary indexes as MongoDB."""
+
+    def __init__(self, queries: Optional[QueryLog] = None):
+        queries = queries or QueryLog()
+        super().__init__(
+            InMemoryUserRepository(queries),
+            InMemoryEquipmentRepository(queries),
+            InMemoryRentalRequestRepository(queries),
+            InMemoryMessageRepository(queries),
+            queries,
+        )
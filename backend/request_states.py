@@ -0,0 +1,38 @@
+from collections import Counter
+from typing import Dict, Tuple
+
+# status -> statuses it may move to
+TRANSITIONS: Dict[str, Tuple[str, ...]] = {
+    "pending": ("approved", "declined"),
+    "approved": ("completed",),
+    "declined": (),
+    "completed": (),
+}
+
+
+def allowed_sources(status: str) -> Tuple[str, ...]:
+    """Statuses from which a request may move to ``status``."""
+    return tuple(source for source, targets in TRANSITIONS.items() if status in targets)
+
+
+def can_transition(old_status: str, new_status: str) -> bool:
+    return new_status in TRANSITIONS.get(old_status, ())
+
+
+class TransitionMetrics:
+    """Outcome counts for status transitions.
+
+    ``conflict`` counts updates that lost a race or carried a stale version;
+    ``replayed`` counts retries recognised by their idempotency key.
+    """
+
+    OUTCOMES = ("applied", "replayed", "conflict", "invalid", "not_found", "forbidden")
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+
+    def record(self, outcome: str):
+        self.counts[outcome] += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {outcome: self.counts[outcome] for outcome in self.OUTCOMES}
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from bson.binary import Binary
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from streaming import ndjson_line
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_JOB = "retention.archive"
+ARCHIVED_STATUSES = ("completed", "declined")
+# Request fields copied to the top level of an archive record for querying
+REQUEST_FIELDS = ("owner_id", "requester_id", "equipment_id", "status", "created_at", "updated_at")
+
+
+def compress_messages(messages: List[Dict[str, Any]]) -> Binary:
+    return Binary(zlib.compress(b"".join(ndjson_line(message) for message in messages), 6))
+
+
+def decompress_messages(data: bytes) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in zlib.decompress(data).splitlines() if line]
+
+
+class Archiver:
+    """Moves finished rental requests and their messages out of the hot collections.
+
+    Completed or declined requests whose last update is older than
+    ``retention_days`` are copied, one record per request with its messages
+    as compressed NDJSON, into ``rental_requests_archive`` and then deleted
+    from ``rental_requests`` and ``messages``. Requests are deleted first,
+    with the eligibility check repeated, and only the archived messages of
+    requests that were actually deleted are removed. Archive records are
+    overwritten with ``$set``, so a run that stops halfway can simply be
+    repeated and picks up whatever changed in between. ``report`` describes
+    what a run would move without changing anything.
+    """
+
+    def __init__(self, db, retention_days: int = 365, batch_size: int = 200, pause_seconds: float = 0.1):
+        self.db = db
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+
+    @property
+    def archive(self):
+        return self.db.rental_requests_archive
+
+    async def ensure_indexes(self):
+        await self.db.rental_requests.create_index([("status", ASCENDING), ("updated_at", ASCENDING)])
+        await self.archive.create_index([("owner_id", ASCENDING), ("updated_at", DESCENDING)])
+        await self.archive.create_index([("requester_id", ASCENDING), ("updated_at", DESCENDING)])
+
+    def cutoff(self, now: Optional[datetime] = None) -> datetime:
+        return (now or datetime.utcnow()) - timedelta(days=self.retention_days)
+
+    def _eligible(self, cutoff: datetime) -> Dict[str, Any]:
+        return {"status": {"$in": list(ARCHIVED_STATUSES)}, "updated_at": {"$lt": cutoff}}
+
+    async def _batches(self, cutoff: datetime, projection: Dict[str, int]) -> AsyncIterator[List[Dict[str, Any]]]:
+        batch = []
+        cursor = self.db.rental_requests.find(self._eligible(cutoff), projection, batch_size=self.batch_size)
+        async for request in cursor.sort("updated_at", ASCENDING):
+            batch.append(request)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def report(self) -> Dict[str, Any]:
+        """Dry run: what the next archive run would move."""
+        cutoff = self.cutoff()
+        report = {"cutoff": cutoff, "requests": 0, "request_bytes": 0, "messages": 0, "message_bytes": 0,
+                  "oldest_update": None}
+        async for batch in self._batches(cutoff, {"_id": 0, "id": 1, "updated_at": 1}):
+            report["requests"] += len(batch)
+            report["oldest_update"] = report["oldest_update"] or batch[0]["updated_at"]
+            ids = [request["id"] for request in batch]
+            async for row in self.db.rental_requests.aggregate([
+                {"$match": {"id": {"$in": ids}}},
+                {"$group": {"_id": None, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}},
+            ]):
+                report["request_bytes"] += row["bytes"]
+            async for row in self.db.messages.aggregate([
+                {"$match": {"request_id": {"$in": ids}}},
+                {"$group": {"_id": None, "count": {"$sum": 1}, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}},
+            ]):
+                report["messages"] += row["count"]
+                report["message_bytes"] += row["bytes"]
+        return report
+
+    async def run(self) -> Dict[str, Any]:
+        cutoff = self.cutoff()
+        archived = messages_archived = 0
+        while True:
+            # Deleting as we go, so each pass starts again from the oldest remaining request
+            batch = await self.db.rental_requests.find(
+                self._eligible(cutoff), {"_id": 0}
+            ).sort("updated_at", ASCENDING).limit(self.batch_size).to_list(self.batch_size)
+            if not batch:
+                break
+            ids = [request["id"] for request in batch]
+            threads = defaultdict(list)
+            message_ids = defaultdict(list)
+            async for message in self.db.messages.find({"request_id": {"$in": ids}}).sort(
+                [("request_id", ASCENDING), ("timestamp", ASCENDING)]
+            ):
+                message_ids[message["request_id"]].append(message.pop("_id"))
+                threads[message["request_id"]].append(message)
+
+            now = datetime.utcnow()
+            await self.archive.bulk_write([
+                UpdateOne(
+                    {"_id": request["id"]},
+                    {"$set": {
+                        **{field: request.get(field) for field in REQUEST_FIELDS},
+                        "request": request,
+                        "messages": compress_messages(threads[request["id"]]),
+                        "message_count": len(threads[request["id"]]),
+                        "archived_at": now,
+                    }},
+                    upsert=True
+                )
+                for request in batch
+            ], ordered=False)
+            # The delete re-checks eligibility, so a request updated since the read stays hot
+            # and its archive record is dropped again
+            deleted = await self.db.rental_requests.delete_many({"id": {"$in": ids}, **self._eligible(cutoff)})
+            kept = set(await self.db.rental_requests.distinct("id", {"id": {"$in": ids}}))
+            if kept:
+                await self.archive.delete_many({"_id": {"$in": list(kept)}})
+            gone = [request_id for request_id in ids if request_id not in kept]
+            # Only the messages that went into the archive; a late message stays where it is
+            await self.db.messages.delete_many(
+                {"_id": {"$in": [message_id for request_id in gone for message_id in message_ids[request_id]]}}
+            )
+
+            archived += deleted.deleted_count
+            messages_archived += sum(len(threads[request_id]) for request_id in gone)
+            if not deleted.deleted_count:
+                break
+            await asyncio.sleep(self.pause_seconds)
+        if archived:
+            logger.info("Archived %s requests and %s messages last updated before %s", archived, messages_archived, cutoff)
+        return {"requests": archived, "messages": messages_archived}
+
+    async def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """An archived request with its messages decompressed."""
+        record = await self.archive.find_one({"_id": request_id})
+        if record is None:
+            return None
+        return {"request": record["request"], "messages": decompress_messages(record["messages"])}
+
+    def iter_for_user(self, user_id: str, limit: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """Archived requests the user owns or made, newest first, without their messages."""
+        return self.archive.find(
+            {"$or": [{"owner_id": user_id}, {"requester_id": user_id}]},
+            {"_id": 0, "request": 1, "updated_at": 1},
+            limit=limit
+        ).sort("updated_at", DESCENDING)
@@ -0,0 +1,40 @@
+"""Server entry point.
+
+``SERVER_MODE=production`` (the default) runs ``WEB_CONCURRENCY`` uvicorn
+worker processes, one per core unless configured; every worker opens its own
+MongoDB pool on startup. ``SERVER_MODE=development`` runs a single
+auto-reloading process.
+"""
+import os
+
+import uvicorn
+
+
+def worker_count() -> int:
+    configured = os.environ.get("WEB_CONCURRENCY")
+    if configured:
+        return max(1, int(configured))
+    return max(1, os.cpu_count() or 1)
+
+
+def main():
+    mode = os.environ.get("SERVER_MODE", "production")
+    options = {
+        "host": os.environ.get("HOST", "0.0.0.0"),
+        "port": int(os.environ.get("PORT", "8001")),
+        "proxy_headers": True,
+        "forwarded_allow_ips": os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    }
+    if mode == "development":
+        uvicorn.run("server:app", reload=True, **options)
+    else:
+        uvicorn.run(
+            "server:app",
+            workers=worker_count(),
+            timeout_keep_alive=int(os.environ.get("KEEP_ALIVE_TIMEOUT", "5")),
+            **options
+        )
+
+
+if __name__ == "__main__":
+    main()
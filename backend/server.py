@@ -1,38 +1,259 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
 import os
 import logging
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, ValidationError
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import bcrypt
-import jwt
 from enum import Enum
 
+from database import Database, MongoSettings, ReadYourWritesMiddleware
+from analytics import REBUILD_JOB, OwnerAnalytics
+from auth import InvalidToken, KeyRing, RevocationList, TokenService
+from changes import DELETE, INSERT, UPDATE, ChangeEvent, ChangeFeed, ChangeHooks
+from idempotency import IdempotencyMiddleware, IdempotencyStore, MongoIdempotencyStore
+from health import LoopLagMonitor, ReadinessProbe, prometheus_text
+from jobs import JobQueue
+from migrations import MigrationRunner
+from notifications import Notifier, transport_from_env
+from owners import NAME_FIELDS, SYNC_NAMES_JOB, VERIFY_NAMES_JOB, OwnerNames, missing_name_ids, with_names
+from repositories import InMemoryRepositories, MotorRepositories, Repositories
+from pricing import MAX_QUOTE_ITEMS, price_quotes
+from ranking import NEW_LISTING_SCORE, REFRESH_RANKING_JOB, EquipmentRanker
+from recommendations import FORGET_EQUIPMENT_JOB, REBUILD_RECOMMENDATIONS_JOB, RECORD_RENTAL_JOB, Recommender
+from request_states import TransitionMetrics, allowed_sources, can_transition
+from ratelimit import RateLimitMiddleware, limiter_from_env
+from retention import ARCHIVE_JOB, Archiver
+from uploads import IMAGE_URL_PREFIX, ImageStore, UploadRejected, image_id_from_url, read_image_parts
+from streaming import (
+    CSV_MEDIA_TYPE,
+    NDJSON_MEDIA_TYPE,
+    csv_line,
+    iter_batches,
+    iter_csv_rows,
+    iter_ndjson_rows,
+    ndjson_line,
+)
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection; each worker process connects on startup
+db = Database(MongoSettings.from_env(os.environ))
+
+# Data access for handlers; DATA_BACKEND=memory runs the API without MongoDB
+DATA_BACKEND = os.environ.get('DATA_BACKEND', 'mongo')
+USE_MONGO = DATA_BACKEND == 'mongo'
+repositories: Repositories = MotorRepositories(db) if USE_MONGO else InMemoryRepositories()
+
+def get_repositories() -> Repositories:
+    return repositories
+
+# Background jobs; set JOB_WORKER_IN_PROCESS=false when running worker.py separately
+job_queue = JobQueue(db, enabled=USE_MONGO)
+JOB_WORKER_IN_PROCESS = os.environ.get('JOB_WORKER_IN_PROCESS', 'true').lower() == 'true'
+
+# Notifications are buffered in memory and sent as digests by the job queue
+notifier = Notifier(
+    db,
+    job_queue,
+    transport_from_env(os.environ),
+    digest_window=float(os.environ.get('NOTIFICATION_DIGEST_SECONDS', '300')),
+    sends_per_second=float(os.environ.get('NOTIFICATION_SENDS_PER_SECOND', '5')),
+    retention_days=float(os.environ.get('NOTIFICATION_RETENTION_DAYS', '30')),
+    enabled=USE_MONGO
+)
+
+# Rental request status transitions
+transition_metrics = TransitionMetrics()
+
+# Analytics rollups
+analytics = OwnerAnalytics(db, enabled=USE_MONGO)
+ANALYTICS_DEFAULT_DAYS = 30
+
+@job_queue.register(REBUILD_JOB)
+async def rebuild_analytics(payload: dict):
+    return await analytics.rebuild(payload.get("owner_id"))
+
+# Browse ranking; equipment.score is refreshed periodically by the job queue
+ranker = EquipmentRanker(db)
+
+@job_queue.register(REFRESH_RANKING_JOB, every=float(os.environ.get('RANKING_REFRESH_MINUTES', '15')) * 60)
+async def refresh_ranking(payload: dict):
+    return await ranker.refresh()
+
+# Retention: finished requests and their messages move to a compressed archive
+RETENTION_ENABLED = os.environ.get('RETENTION_ENABLED', 'false').lower() == 'true'
+archiver = Archiver(db, retention_days=int(os.environ.get('RETENTION_DAYS', '365')))
+
+if RETENTION_ENABLED:
+    @job_queue.register(ARCHIVE_JOB, every=86400)
+    async def archive_finished_requests(payload: dict):
+        return await archiver.run()
+
+# Equipment recommendations, rebuilt periodically and updated as requests arrive
+recommender = Recommender(db, enabled=USE_MONGO)
 
-# JWT Configuration
-JWT_SECRET = "toala_secret_key_2024"
-JWT_ALGORITHM = "HS256"
+@job_queue.register(REBUILD_RECOMMENDATIONS_JOB, every=float(os.environ.get('RECOMMENDATIONS_REBUILD_HOURS', '6')) * 3600)
+async def rebuild_recommendations(payload: dict):
+    return await recommender.rebuild()
+
+@job_queue.register(RECORD_RENTAL_JOB)
+async def record_rental_for_recommendations(payload: dict):
+    return await recommender.record_rental(payload["requester_id"], payload["equipment_id"])
+
+@job_queue.register(FORGET_EQUIPMENT_JOB)
+async def forget_equipment_for_recommendations(payload: dict):
+    return await recommender.forget(payload["equipment_id"])
+
+# Change hooks invalidate data derived from listings. With
+# CHANGE_FEED_ENABLED they are fed from a Mongo change stream (or polling) and see
+# every write, including other processes' and bulk imports; otherwise handlers publish.
+CHANGE_FEED_ENABLED = USE_MONGO and os.environ.get('CHANGE_FEED_ENABLED', 'false').lower() == 'true'
+change_hooks = ChangeHooks(local=not CHANGE_FEED_ENABLED)
+change_feed = ChangeFeed(
+    db,
+    change_hooks,
+    # Only collections with subscribers; add one here when subscribing to it
+    ["equipment"],
+    batch_size=int(os.environ.get('CHANGE_FEED_BATCH_SIZE', '100')),
+    max_wait=float(os.environ.get('CHANGE_FEED_MAX_WAIT_SECONDS', '1.0')),
+    pre_images=os.environ.get('CHANGE_FEED_PRE_IMAGES', 'false').lower() == 'true'
+)
+EQUIPMENT_TEXT_FIELDS = ["title", "description", "category"]
+RECOMMENDATIONS_EDIT_DELAY = float(os.environ.get('RECOMMENDATIONS_EDIT_DELAY_MINUTES', '10')) * 60
+
+# Polled updates don't say what changed; edits seen that way wait for the periodic rebuild
+@change_hooks.subscribe("equipment", operations=[UPDATE], fields=EQUIPMENT_TEXT_FIELDS, batch=True,
+                        unknown_fields=False)
+async def rebuild_recommendations_after_edit(events: List[ChangeEvent]):
+    if recommender.enabled:
+        # Text similarity needs the whole corpus; edits within one delay window share a rebuild
+        slot = int(time.time() // RECOMMENDATIONS_EDIT_DELAY) + 1
+        await job_queue.enqueue(
+            REBUILD_RECOMMENDATIONS_JOB,
+            delay_seconds=slot * RECOMMENDATIONS_EDIT_DELAY - time.time(),
+            job_id=f"{REBUILD_RECOMMENDATIONS_JOB}@edit-{slot}"
+        )
+
+@change_hooks.subscribe("equipment", operations=[UPDATE, DELETE], fields=["deleted_at"])
+async def forget_deleted_equipment(event: ChangeEvent):
+    # The change feed sees a soft delete as an update that sets deleted_at
+    deleted = event.operation == DELETE or (event.document or {}).get("deleted_at")
+    if recommender.enabled and deleted:
+        await job_queue.enqueue(FORGET_EQUIPMENT_JOB, {"equipment_id": event.document_id})
+
+# Deleted listings stay stored for the requests that refer to them; their images go after EQUIPMENT_PURGE_DAYS
+PURGE_DELETED_EQUIPMENT_JOB = "equipment.purge_deleted"
+EQUIPMENT_PURGE_DAYS = int(os.environ.get('EQUIPMENT_PURGE_DAYS', '30'))
+
+@job_queue.register(PURGE_DELETED_EQUIPMENT_JOB, every=86400)
+async def purge_deleted_equipment(payload: dict):
+    deleted_before = datetime.utcnow() - timedelta(days=EQUIPMENT_PURGE_DAYS)
+    listings = files = 0
+    while True:
+        purged = await repositories.equipment.purge_deleted(deleted_before)
+        if not purged:
+            return {"purged": listings, "files": files}
+        listings += len(purged)
+        for owner_id, images in purged.values():
+            # Listings saved before image ownership was checked may show other users' uploads
+            for image_id in filter(None, map(image_id_from_url, images)):
+                if await image_store.delete(image_id, owner_id=owner_id):
+                    files += 1
+
+# User names embedded in equipment and requests; renames fan out through the job queue
+owner_names = OwnerNames(db, repositories, enabled=USE_MONGO)
+OWNER_NAMES_REPAIR = os.environ.get('OWNER_NAMES_REPAIR', 'true').lower() == 'true'
+
+@job_queue.register(SYNC_NAMES_JOB)
+async def sync_owner_names(payload: dict):
+    return await owner_names.propagate(payload["user_id"])
+
+@job_queue.register(VERIFY_NAMES_JOB, every=float(os.environ.get('OWNER_NAMES_VERIFY_HOURS', '24')) * 3600)
+async def verify_owner_names(payload: dict):
+    return await owner_names.verify(repair=OWNER_NAMES_REPAIR)
+
+# JWT Configuration; keys rotate through JWT_KEYS/JWT_ACTIVE_KID, or a single JWT_SECRET
 ACCESS_TOKEN_EXPIRE_HOURS = 24
+revocations = RevocationList(
+    db,
+    enabled=USE_MONGO,
+    refresh_interval=float(os.environ.get('JWT_REVOCATION_REFRESH_SECONDS', '5'))
+)
+token_service = TokenService(KeyRing.from_env(os.environ), revocations, expire_hours=ACCESS_TOKEN_EXPIRE_HOURS)
 
-# Create the main app without a prefix
-app = FastAPI(title="Toala.at Equipment Lending API")
+# Bulk import/export
+BULK_INSERT_BATCH_SIZE = 100
+STREAM_BATCH_SIZE = 100
+MAX_EQUIPMENT_IMAGES = 10
+
+# Image uploads: streamed multipart, resized and transcoded in a process pool, stored in GridFS
+IMAGE_UPLOAD_MAX_BYTES = int(float(os.environ.get('IMAGE_UPLOAD_MAX_MB', '10')) * 1024 * 1024)
+# Stored images never change, so browsers and CDNs may keep them for good
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+image_store = ImageStore(
+    db,
+    workers=int(os.environ.get('IMAGE_WORKERS', '2')),
+    max_dimension=int(os.environ.get('IMAGE_MAX_DIMENSION', '2048')),
+    widths=[int(width) for width in os.environ.get('IMAGE_VARIANT_WIDTHS', '320,640,1280').split(',') if width.strip()],
+    formats=[f"image/{name.strip()}" for name in os.environ.get('IMAGE_VARIANT_FORMATS', 'avif,webp').split(',') if name.strip()],
+    enabled=USE_MONGO
+)
+
+# Online schema migrations; run with migrate.py, or in the background on startup
+MIGRATE_ON_STARTUP = os.environ.get('MIGRATE_ON_STARTUP', 'false').lower() == 'true'
+migration_runner = MigrationRunner(
+    db,
+    batch_size=int(os.environ.get('MIGRATION_BATCH_SIZE', '500')),
+    throttle=float(os.environ.get('MIGRATION_THROTTLE', '1.0'))
+)
+
+# Rate limiting, checked before routing so rejected requests never reach bcrypt or Mongo
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+rate_limiter = limiter_from_env(os.environ, identify=token_service.subject)
+
+# Idempotency-Key support for retried creates; the first response is replayed for 24h
+IDEMPOTENT_PATHS = ("/api/equipment", "/api/requests", "/api/messages")
+_idempotency_options = dict(
+    ttl_seconds=float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400')),
+    wait_timeout=float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '10'))
+)
+idempotency_store = MongoIdempotencyStore(db, **_idempotency_options) if USE_MONGO else IdempotencyStore(**_idempotency_options)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Health probes live outside /api so load balancers can reach them without auth or rate limits
+health_router = APIRouter()
+DEBUG = os.environ.get('DEBUG', 'false').lower() == 'true'
+# In debug mode a watchdog thread logs the stack of anything blocking the loop past the threshold
+loop_lag_monitor = LoopLagMonitor(
+    interval=float(os.environ.get('LOOP_LAG_SAMPLE_SECONDS', '0.5')),
+    block_threshold=float(os.environ.get('LOOP_BLOCK_THRESHOLD_SECONDS', '0.1')),
+    detect_blocking=DEBUG or os.environ.get('LOOP_BLOCK_DETECTION', 'false').lower() == 'true'
+)
+readiness_probe = ReadinessProbe(
+    db,
+    repositories,
+    loop_lag_monitor,
+    use_mongo=USE_MONGO,
+    ping_timeout=float(os.environ.get('READINESS_PING_TIMEOUT_SECONDS', '1.0')),
+    max_pool_saturation=float(os.environ.get('READINESS_MAX_POOL_SATURATION', '0.9')),
+    max_loop_lag=float(os.environ.get('READINESS_MAX_LOOP_LAG_SECONDS', '0.5')),
+    lag_samples=int(os.environ.get('READINESS_LAG_SAMPLES', '10')),
+    window=int(os.environ.get('READINESS_WINDOW', '3'))
+)
+
 # Security
 security = HTTPBearer()
 
@@ -52,7 +273,17 @@ class EquipmentCategory(str, Enum):
     household = "household"
     other = "other"
 
+class BrowseSort(str, Enum):
+    score = "score"  # best first
+    price = "price"  # cheapest first
+
 # Models
+class ImageSources(BaseModel):
+    """Responsive variants of a stored image: its size and a srcset per content type, best first."""
+    width: int
+    height: int
+    srcset: Dict[str, str] = {}
+
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     email: EmailStr
@@ -63,7 +294,15 @@ class User(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
-    avatar: Optional[str] = None  # base64 image
+    avatar: Optional[str] = None  # uploaded image URL, or a legacy base64 image
+    avatar_sources: Optional[ImageSources] = None  # variants of an uploaded avatar
+    token_version: int = 0  # bumped to invalidate every token issued so far
+
+class CurrentUser(BaseModel):
+    """The authenticated caller as described by the access token's claims."""
+    id: str
+    name: str
+    token_version: int = 0
 
 class UserCreate(BaseModel):
     email: EmailStr
@@ -74,6 +313,13 @@ class UserCreate(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
 
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    location: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
 class UserLogin(BaseModel):
     email: EmailStr
     password: str
@@ -88,6 +334,7 @@ class UserResponse(BaseModel):
     longitude: Optional[float] = None
     created_at: datetime
     avatar: Optional[str] = None
+    avatar_sources: Optional[ImageSources] = None
 
 class Token(BaseModel):
     access_token: str
@@ -97,6 +344,7 @@ class Token(BaseModel):
 class Equipment(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     owner_id: str
+    owner_name: Optional[str] = None  # copy of the owner's name, kept in sync by owners.OwnerNames
     title: str
     description: str
     category: EquipmentCategory
@@ -104,12 +352,19 @@ class Equipment(BaseModel):
     location: str
     latitude: Optional[float] = None
     longitude: Optional[float] = None
-    images: List[str] = []  # base64 images, max 10
+    images: List[str] = []  # uploaded image URLs or base64 images, max 10
+    image_sources: Dict[str, ImageSources] = {}  # stored image id -> responsive variants
     availability_calendar: Dict[str, bool] = {}  # date string -> available
     min_rental_days: int = 1
     max_rental_days: Optional[int] = None
+    weekly_discount: float = Field(0.0, ge=0, lt=1)  # fraction off rentals of 7+ days
+    monthly_discount: float = Field(0.0, ge=0, lt=1)  # fraction off rentals of 30+ days
+    deposit: float = Field(0.0, ge=0)
+    deposit_rate: float = Field(0.0, ge=0)  # deposit as a fraction of the rental total, if larger
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)  # by owner edits, not derived fields
     is_available: bool = True
+    score: float = NEW_LISTING_SCORE  # browse ranking, maintained by ranking.EquipmentRanker
 
 class EquipmentCreate(BaseModel):
     title: str
@@ -122,6 +377,33 @@ class EquipmentCreate(BaseModel):
     images: List[str] = []
     min_rental_days: int = 1
     max_rental_days: Optional[int] = None
+    weekly_discount: float = Field(0.0, ge=0, lt=1)  # fraction off rentals of 7+ days
+    monthly_discount: float = Field(0.0, ge=0, lt=1)  # fraction off rentals of 30+ days
+    deposit: float = Field(0.0, ge=0)
+    deposit_rate: float = Field(0.0, ge=0)  # deposit as a fraction of the rental total, if larger
+
+class EquipmentUpdate(BaseModel):
+    title: Optional[str] = None
+    description: Optional[str] = None
+    category: Optional[EquipmentCategory] = None
+    price_per_day: Optional[float] = None
+    location: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    images: Optional[List[str]] = None
+    min_rental_days: Optional[int] = None
+    max_rental_days: Optional[int] = None
+    weekly_discount: Optional[float] = Field(None, ge=0, lt=1)
+    monthly_discount: Optional[float] = Field(None, ge=0, lt=1)
+    deposit: Optional[float] = Field(None, ge=0)
+    deposit_rate: Optional[float] = Field(None, ge=0)
+    is_available: Optional[bool] = None
+
+# Fields of EquipmentUpdate that may be left out but not cleared
+EQUIPMENT_REQUIRED_FIELDS = (
+    "title", "description", "category", "price_per_day", "location", "images", "min_rental_days",
+    "weekly_discount", "monthly_discount", "deposit", "deposit_rate", "is_available",
+)
 
 class EquipmentResponse(BaseModel):
     id: str
@@ -135,21 +417,39 @@ class EquipmentResponse(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
     images: List[str] = []
+    image_sources: Dict[str, ImageSources] = {}
     min_rental_days: int
     max_rental_days: Optional[int] = None
+    weekly_discount: float = 0.0
+    monthly_discount: float = 0.0
+    deposit: float = 0.0
+    deposit_rate: float = 0.0
     created_at: datetime
     is_available: bool
 
+class BulkImportError(BaseModel):
+    line: int
+    error: str
+
+class BulkImportResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[BulkImportError] = []
+
 class RentalRequest(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     equipment_id: str
     requester_id: str
     owner_id: str
+    requester_name: Optional[str] = None  # copies of both names, kept in sync by owners.OwnerNames
+    owner_name: Optional[str] = None
     start_date: datetime
     end_date: datetime
     total_price: float
+    deposit: float = 0.0
     message: str
     status: RequestStatus = RequestStatus.pending
+    version: int = 0  # incremented by every status transition
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -170,11 +470,77 @@ class RentalRequestResponse(BaseModel):
     start_date: datetime
     end_date: datetime
     total_price: float
+    deposit: float = 0.0
     message: str
     status: RequestStatus
+    version: int = 0
     created_at: datetime
     updated_at: datetime
 
+class RecommendedEquipment(BaseModel):
+    id: str
+    title: str
+    category: EquipmentCategory
+    price_per_day: float
+    location: str
+    score: float
+
+class SimilarEquipmentResponse(BaseModel):
+    equipment_id: str
+    similar: List[RecommendedEquipment]  # by listing text
+    also_rented: List[RecommendedEquipment]  # by renters who requested both
+
+class QuoteItem(BaseModel):
+    equipment_id: str
+    start_date: datetime
+    end_date: datetime
+
+class QuoteRequest(BaseModel):
+    items: List[QuoteItem]
+
+class Quote(BaseModel):
+    equipment_id: str
+    start_date: datetime
+    end_date: datetime
+    days: int
+    price_per_day: float
+    subtotal: float
+    discount_rate: float
+    discount: float
+    total: float
+    deposit: float
+    valid: bool
+    error: Optional[str] = None
+
+class QuoteResponse(BaseModel):
+    quotes: List[Quote]
+    total: float  # sum over valid quotes
+    deposit: float
+
+class AnalyticsDay(BaseModel):
+    day: str
+    requests: int
+    approved: int
+    declined: int
+    completed: int
+    earnings: float
+
+class EquipmentUtilization(BaseModel):
+    equipment_id: str
+    booked_days: int
+    utilization: float
+    requests: int
+    earnings: float
+
+class OwnerAnalyticsResponse(BaseModel):
+    start: str
+    end: str
+    series: List[AnalyticsDay]
+    equipment: List[EquipmentUtilization]
+    total_requests: int
+    total_earnings: float
+    conversion_rate: float
+
 class Message(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     sender_id: str
@@ -185,7 +551,7 @@ class Message(BaseModel):
     read: bool = False
 
 class MessageCreate(BaseModel):
-    recipient_id: str
+    recipient_id: Optional[str] = None  # always the other party of the request; checked if sent
     request_id: str
     content: str
 
@@ -200,6 +566,10 @@ class MessageResponse(BaseModel):
     timestamp: datetime
     read: bool
 
+class ArchivedRequestResponse(BaseModel):
+    request: RentalRequestResponse
+    messages: List[MessageResponse]
+
 # Utility functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -207,32 +577,94 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
+def create_access_token(user: dict) -> str:
+    return token_service.issue(user)
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def stream_responses(cursor, build_responses) -> StreamingResponse:
+    # Encodes documents batch by batch as the cursor yields them, so memory stays bounded
+    async def rows():
+        async for batch in iter_batches(cursor, STREAM_BATCH_SIZE):
+            for response in await build_responses(batch):
+                yield ndjson_line(response.dict())
+    return StreamingResponse(rows(), media_type=NDJSON_MEDIA_TYPE)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def fill_names(documents: List[dict], collection: str, repos: Repositories) -> List[dict]:
+    # User names are embedded at write time; only documents older than that need a lookup
+    fields = NAME_FIELDS[collection]
+    missing = missing_name_ids(documents, fields)
+    names = await repos.users.names(missing) if missing else {}
+    return [with_names(document, fields, names) for document in documents]
+
+async def record_analytics_transition(request: dict, old_status: Optional[str], new_status: str):
+    # Rollups are derived data: the request is already stored, so a failed rollup must not fail
+    # the call (and make a retry create a duplicate). The owner's rollups are rebuilt instead.
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    except jwt.PyJWTError:
+        await analytics.record_transition(request, old_status, new_status)
+    except Exception:
+        logger.exception("Analytics rollup failed for request %s (%s -> %s)", request["id"], old_status, new_status)
+        try:
+            await job_queue.enqueue(REBUILD_JOB, {"owner_id": request["owner_id"]}, delay_seconds=60)
+        except Exception:
+            logger.exception("Scheduling an analytics rebuild for owner %s failed", request["owner_id"])
+
+async def build_rental_request_responses(requests: List[dict], repos: Repositories) -> List[RentalRequestResponse]:
+    titles = await repos.equipment.titles(request["equipment_id"] for request in requests)
+    return [
+        RentalRequestResponse(**request, equipment_title=titles.get(request["equipment_id"], "Unknown"))
+        for request in await fill_names(requests, "rental_requests", repos)
+    ]
+
+async def build_message_responses(messages: List[dict], repos: Repositories) -> List[MessageResponse]:
+    names = await repos.users.names(
+        [message["sender_id"] for message in messages] + [message["recipient_id"] for message in messages]
+    )
+    return [
+        MessageResponse(
+            **message,
+            sender_name=names.get(message["sender_id"], "Unknown"),
+            recipient_name=names.get(message["recipient_id"], "Unknown")
+        )
+        for message in messages
+    ]
+
+def get_token_claims(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    try:
+        return token_service.verify(credentials.credentials)
+    except InvalidToken:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    
-    user = await db.users.find_one({"id": user_id})
+
+async def get_current_user(
+    claims: dict = Depends(get_token_claims),
+    repos: Repositories = Depends(get_repositories)
+) -> CurrentUser:
+    # Authorized from the token alone; only tokens issued before claims carried a name need a lookup
+    if "name" in claims:
+        return CurrentUser(id=claims["sub"], name=claims["name"], token_version=claims.get("ver", 0))
+    user = await repos.users.get(claims["sub"])
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
+    return CurrentUser(id=user["id"], name=user["name"], token_version=user.get("token_version", 0))
+
+async def get_fresh_user(
+    claims: dict = Depends(get_token_claims),
+    repos: Repositories = Depends(get_repositories)
+) -> User:
+    # For endpoints that must see the stored user record, not the token's copy of it
+    user = await repos.users.get(claims["sub"])
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    if claims.get("ver", 0) < user.get("token_version", 0):
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     return User(**user)
 
 # Authentication routes
 @api_router.post("/auth/register", response_model=Token)
-async def register(user_data: UserCreate):
+async def register(user_data: UserCreate, repos: Repositories = Depends(get_repositories)):
     # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await repos.users.get_by_email(user_data.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -247,262 +679,760 @@ async def register(user_data: UserCreate):
         longitude=user_data.longitude
     )
     
-    await db.users.insert_one(user.dict())
+    await repos.users.insert(user.dict())
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = create_access_token(user.dict())
     user_response = UserResponse(**user.dict())
     
     return Token(access_token=access_token, token_type="bearer", user=user_response)
 
 @api_router.post("/auth/login", response_model=Token)
-async def login(login_data: UserLogin):
-    user = await db.users.find_one({"email": login_data.email})
+async def login(login_data: UserLogin, repos: Repositories = Depends(get_repositories)):
+    user = await repos.users.get_by_email(login_data.email)
     if not user or not verify_password(login_data.password, user["password_hash"]):
         raise HTTPException(status_code=400, detail="Invalid email or password")
     
-    access_token = create_access_token(data={"sub": user["id"]})
+    access_token = create_access_token(user)
     user_response = UserResponse(**user)
     
     return Token(access_token=access_token, token_type="bearer", user=user_response)
 
 @api_router.get("/auth/me", response_model=UserResponse)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: User = Depends(get_fresh_user)):
     return UserResponse(**current_user.dict())
 
+@api_router.patch("/auth/me", response_model=Token)
+async def update_current_user(
+    user_data: UserUpdate,
+    current_user: User = Depends(get_fresh_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    fields = user_data.dict(exclude_unset=True)
+    if "name" in fields and not fields["name"]:
+        raise HTTPException(status_code=400, detail="Name cannot be empty")
+    if "location" in fields and not fields["location"]:
+        raise HTTPException(status_code=400, detail="Location cannot be empty")
+    if "name" in fields:
+        # Lets the owner name check look only at users renamed since its last run
+        fields["name_updated_at"] = datetime.utcnow()
+    user = await repos.users.update_profile(current_user.id, fields) if fields else current_user.dict()
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    repos.mark_write()
+    
+    if user["name"] != current_user.name:
+        # Copies of the name in equipment and requests are rewritten in the background
+        if owner_names.enabled:
+            await job_queue.enqueue(SYNC_NAMES_JOB, {"user_id": current_user.id}, user_id=current_user.id)
+        else:
+            await owner_names.propagate(current_user.id)
+    
+    # A new token, since the old one carries the old name
+    return Token(access_token=create_access_token(user), token_type="bearer", user=UserResponse(**user))
+
+async def store_uploaded_images(request: Request, user_id: str, kind: str, max_files: int) -> List[dict]:
+    # Limits are enforced while the body streams in; decoding happens in the image worker pool
+    try:
+        uploads = await read_image_parts(request, IMAGE_UPLOAD_MAX_BYTES, max_files)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    stored = []
+    try:
+        for upload in uploads:
+            stored.append(await image_store.save(upload, user_id, kind))
+    except UploadRejected as e:
+        for image in stored:
+            await image_store.delete(image["id"])
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    finally:
+        for upload in uploads:
+            upload.close()
+    return stored
+
+@api_router.put("/auth/me/avatar", response_model=UserResponse)
+async def upload_avatar(
+    request: Request,
+    current_user: User = Depends(get_fresh_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    image = (await store_uploaded_images(request, current_user.id, "avatar", max_files=1))[0]
+    user = await repos.users.update_profile(
+        current_user.id, {"avatar": image["url"], "avatar_sources": image["sources"]}
+    )
+    if user is None:
+        await image_store.delete(image["id"])
+        raise HTTPException(status_code=404, detail="User not found")
+    repos.mark_write()
+    previous = image_id_from_url(current_user.avatar)
+    if previous:
+        await image_store.delete(previous, owner_id=current_user.id)
+    return UserResponse(**user)
+
+@api_router.post("/auth/logout")
+async def logout(claims: dict = Depends(get_token_claims)):
+    if "jti" in claims:
+        await revocations.revoke_token(claims)
+    return {"message": "Logged out"}
+
+@api_router.post("/auth/logout-all")
+async def logout_all(current_user: User = Depends(get_fresh_user), repos: Repositories = Depends(get_repositories)):
+    version = await repos.users.bump_token_version(current_user.id)
+    await revocations.revoke_user(
+        current_user.id, version, datetime.utcnow() + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
+    )
+    return {"message": "Logged out everywhere"}
+
 # Equipment routes
+async def foreign_image_error(urls: List[str], owner_id: str) -> Optional[str]:
+    # Stored image URLs are public, but a listing may only show (and later delete) its owner's uploads
+    file_ids = set(filter(None, map(image_id_from_url, urls)))
+    if file_ids - await image_store.owned(file_ids, owner_id):
+        return "Images must be uploaded by the listing owner"
+    return None
+
 @api_router.post("/equipment", response_model=EquipmentResponse)
-async def create_equipment(equipment_data: EquipmentCreate, current_user: User = Depends(get_current_user)):
+async def create_equipment(
+    equipment_data: EquipmentCreate,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
     # Validate images (max 10)
-    if len(equipment_data.images) > 10:
+    if len(equipment_data.images) > MAX_EQUIPMENT_IMAGES:
         raise HTTPException(status_code=400, detail="Maximum 10 images allowed")
+    error = await foreign_image_error(equipment_data.images, current_user.id)
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
     
     equipment = Equipment(
         owner_id=current_user.id,
+        owner_name=current_user.name,
         **equipment_data.dict()
     )
     
-    await db.equipment.insert_one(equipment.dict())
+    await repos.equipment.insert(equipment.dict())
+    repos.mark_write()
+    await change_hooks.publish(ChangeEvent("equipment", INSERT, equipment.id, document=equipment.dict()))
     
-    return EquipmentResponse(
-        **equipment.dict(),
-        owner_name=current_user.name
+    return EquipmentResponse(**equipment.dict())
+
+def format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in error.errors()
     )
 
+async def insert_equipment_batch(batch: List[tuple], result: BulkImportResult, repos: Repositories):
+    # batch holds (line number, equipment document) pairs
+    write_errors = await repos.equipment.insert_many([doc for _, doc in batch])
+    for index, error in sorted(write_errors.items()):
+        result.errors.append(BulkImportError(line=batch[index][0], error=error))
+    result.inserted += len(batch) - len(write_errors)
+    result.failed += len(write_errors)
+    for index, (_, doc) in enumerate(batch):
+        if index not in write_errors:
+            await change_hooks.publish(ChangeEvent("equipment", INSERT, doc["id"], document=doc))
+
+@api_router.post("/equipment/bulk", response_model=BulkImportResult)
+async def bulk_import_equipment(
+    request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Accepts NDJSON (default) or CSV with a header row; rows are validated as they arrive
+    if CSV_MEDIA_TYPE in request.headers.get("content-type", ""):
+        rows = iter_csv_rows(request.stream(), list_fields=["images"])
+    else:
+        rows = iter_ndjson_rows(request.stream())
+    
+    result = BulkImportResult(inserted=0, failed=0)
+    batch = []
+    async for line_no, record, error in rows:
+        if error is None:
+            try:
+                equipment_data = EquipmentCreate(**record)
+                if len(equipment_data.images) > MAX_EQUIPMENT_IMAGES:
+                    error = "Maximum 10 images allowed"
+                else:
+                    error = await foreign_image_error(equipment_data.images, current_user.id)
+            except ValidationError as e:
+                error = format_validation_error(e)
+        if error is not None:
+            result.errors.append(BulkImportError(line=line_no, error=error))
+            result.failed += 1
+            continue
+        
+        equipment = Equipment(owner_id=current_user.id, owner_name=current_user.name, **equipment_data.dict())
+        batch.append((line_no, equipment.dict()))
+        if len(batch) >= BULK_INSERT_BATCH_SIZE:
+            await insert_equipment_batch(batch, result, repos)
+            batch = []
+    
+    if batch:
+        await insert_equipment_batch(batch, result, repos)
+    
+    if result.inserted:
+        repos.mark_write()
+    return result
+
+@api_router.get("/equipment/export")
+async def export_equipment(
+    format: str = "ndjson",
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Format must be 'ndjson' or 'csv'")
+    
+    cursor = repos.equipment.iter_by_owner(current_user.id)
+    
+    async def ndjson_rows():
+        async for equipment in cursor:
+            yield ndjson_line(EquipmentResponse(**{**equipment, "owner_name": current_user.name}).dict())
+    
+    async def csv_rows():
+        # Same columns as the CSV import so exports can be re-imported
+        fields = list(EquipmentCreate.__fields__)
+        yield csv_line(fields)
+        async for equipment in cursor:
+            yield csv_line(equipment.get(field) for field in fields)
+    
+    if format == "csv":
+        return StreamingResponse(csv_rows(), media_type=CSV_MEDIA_TYPE)
+    return StreamingResponse(ndjson_rows(), media_type=NDJSON_MEDIA_TYPE)
+
 @api_router.get("/equipment", response_model=List[EquipmentResponse])
 async def get_equipment(
     category: Optional[EquipmentCategory] = None,
     location: Optional[str] = None,
     max_price: Optional[float] = None,
     skip: int = 0,
-    limit: int = 20
+    limit: int = 20,
+    sort: BrowseSort = BrowseSort.score,
+    repos: Repositories = Depends(get_repositories)
 ):
-    query = {"is_available": True}
-    
-    if category:
-        query["category"] = category
-    if location:
-        query["location"] = {"$regex": location, "$options": "i"}
-    if max_price:
-        query["price_per_day"] = {"$lte": max_price}
-    
-    equipment_list = await db.equipment.find(query).skip(skip).limit(limit).to_list(limit)
-    
-    # Add owner names
-    result = []
-    for equipment in equipment_list:
-        owner = await db.users.find_one({"id": equipment["owner_id"]})
-        equipment_response = EquipmentResponse(
-            **equipment,
-            owner_name=owner["name"] if owner else "Unknown"
-        )
-        result.append(equipment_response)
+    reader = repos.reader("browse")
+    equipment_list = await reader.equipment.search(category, location, max_price, skip, limit, sort.value)
     
-    return result
+    return [EquipmentResponse(**equipment) for equipment in await fill_names(equipment_list, "equipment", reader)]
 
 @api_router.get("/equipment/{equipment_id}", response_model=EquipmentResponse)
-async def get_equipment_by_id(equipment_id: str):
-    equipment = await db.equipment.find_one({"id": equipment_id})
-    if not equipment:
+async def get_equipment_by_id(
+    equipment_id: str,
+    repos: Repositories = Depends(get_repositories)
+):
+    reader = repos.reader("equipment_detail")
+    equipment = await reader.equipment.get(equipment_id)
+    if not equipment or equipment.get("deleted_at"):
         raise HTTPException(status_code=404, detail="Equipment not found")
     
-    owner = await db.users.find_one({"id": equipment["owner_id"]})
-    return EquipmentResponse(
-        **equipment,
-        owner_name=owner["name"] if owner else "Unknown"
+    equipment = (await fill_names([equipment], "equipment", reader))[0]
+    return EquipmentResponse(**equipment)
+
+async def owned_equipment_error(equipment_id: str, user_id: str, repos: Repositories) -> HTTPException:
+    # Why a conditional update on a listing matched nothing
+    equipment = await repos.equipment.get(equipment_id)
+    if not equipment or equipment.get("deleted_at"):
+        return HTTPException(status_code=404, detail="Equipment not found")
+    if equipment["owner_id"] != user_id:
+        return HTTPException(status_code=403, detail="Not authorized to change this equipment")
+    return HTTPException(status_code=409, detail="Equipment was changed meanwhile; reload and try again")
+
+@api_router.patch("/equipment/{equipment_id}", response_model=EquipmentResponse)
+async def update_equipment(
+    equipment_id: str,
+    equipment_data: EquipmentUpdate,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Only the fields sent are written, so e.g. a title change never rewrites the images
+    fields = equipment_data.dict(exclude_unset=True)
+    cleared = [name for name in EQUIPMENT_REQUIRED_FIELDS if name in fields and fields[name] is None]
+    if cleared:
+        raise HTTPException(status_code=400, detail=f"Cannot clear {', '.join(cleared)}")
+    if len(fields.get("images") or []) > MAX_EQUIPMENT_IMAGES:
+        raise HTTPException(status_code=400, detail="Maximum 10 images allowed")
+    if not fields:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    error = await foreign_image_error(fields.get("images") or [], current_user.id)
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
+    
+    equipment = await repos.equipment.update(equipment_id, current_user.id, {**fields, "updated_at": datetime.utcnow()})
+    if equipment is None:
+        raise await owned_equipment_error(equipment_id, current_user.id, repos)
+    repos.mark_write()
+    await change_hooks.publish(ChangeEvent("equipment", UPDATE, equipment_id, frozenset(fields), equipment))
+    
+    return EquipmentResponse(**(await fill_names([equipment], "equipment", repos))[0])
+
+@api_router.delete("/equipment/{equipment_id}")
+async def delete_equipment(
+    equipment_id: str,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Soft delete: requests keep referring to the listing, but it no longer shows up anywhere
+    equipment = await repos.equipment.soft_delete(equipment_id, current_user.id, datetime.utcnow())
+    if equipment is None:
+        raise await owned_equipment_error(equipment_id, current_user.id, repos)
+    repos.mark_write()
+    await change_hooks.publish(ChangeEvent("equipment", DELETE, equipment_id, document=equipment))
+    
+    return {"message": "Equipment deleted"}
+
+@api_router.post("/equipment/{equipment_id}/images", response_model=EquipmentResponse)
+async def upload_equipment_images(
+    equipment_id: str,
+    request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Checked before the body is read, so refused uploads cost no image processing
+    equipment = await repos.equipment.get(equipment_id)
+    if not equipment or equipment.get("deleted_at") or equipment["owner_id"] != current_user.id:
+        raise await owned_equipment_error(equipment_id, current_user.id, repos)
+    room = MAX_EQUIPMENT_IMAGES - len(equipment.get("images", []))
+    if room <= 0:
+        raise HTTPException(status_code=400, detail="Maximum 10 images allowed")
+    
+    images = await store_uploaded_images(request, current_user.id, "equipment", max_files=room)
+    urls = [image["url"] for image in images]
+    equipment = await repos.equipment.add_images(
+        equipment_id, current_user.id, urls, MAX_EQUIPMENT_IMAGES, datetime.utcnow(),
+        sources={image["id"]: image["sources"] for image in images}
+    )
+    if equipment is None:
+        # Deleted, or filled up by a concurrent upload, while this one was processed
+        for image in images:
+            await image_store.delete(image["id"])
+        raise HTTPException(status_code=409, detail="Equipment changed during the upload; reload and try again")
+    repos.mark_write()
+    await change_hooks.publish(ChangeEvent("equipment", UPDATE, equipment_id, frozenset(["images"]), equipment))
+    
+    return EquipmentResponse(**(await fill_names([equipment], "equipment", repos))[0])
+
+@api_router.delete("/equipment/{equipment_id}/images/{image_id}", response_model=EquipmentResponse)
+async def delete_equipment_image(
+    equipment_id: str,
+    image_id: str,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    equipment = await repos.equipment.remove_image(
+        equipment_id, current_user.id, f"{IMAGE_URL_PREFIX}{image_id}", datetime.utcnow(), image_id=image_id
+    )
+    if equipment is None:
+        error = await owned_equipment_error(equipment_id, current_user.id, repos)
+        if error.status_code == 409:
+            # The listing is live and owned, so the image is not one of its images
+            error = HTTPException(status_code=404, detail="Image not found")
+        raise error
+    await image_store.delete(image_id, owner_id=current_user.id)
+    repos.mark_write()
+    await change_hooks.publish(ChangeEvent("equipment", UPDATE, equipment_id, frozenset(["images"]), equipment))
+    
+    return EquipmentResponse(**(await fill_names([equipment], "equipment", repos))[0])
+
+async def stored_image_response(file_id: str, if_none_match: Optional[str]):
+    etag = f'"{file_id}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL})
+    image = await image_store.open(file_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    metadata, length, chunks = image
+    return StreamingResponse(
+        chunks,
+        media_type=metadata.get("content_type", "application/octet-stream"),
+        headers={"Content-Length": str(length), "ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    )
+
+@api_router.get("/images/{image_id}")
+async def get_image(image_id: str, if_none_match: Optional[str] = Header(None)):
+    return await stored_image_response(image_id, if_none_match)
+
+@api_router.get("/images/{image_id}/{variant}")
+async def get_image_variant(image_id: str, variant: str, if_none_match: Optional[str] = Header(None)):
+    # e.g. 640.webp, as listed in the image's srcset
+    return await stored_image_response(f"{image_id}/{variant}", if_none_match)
+
+@api_router.get("/equipment/{equipment_id}/similar", response_model=SimilarEquipmentResponse)
+async def get_similar_equipment(equipment_id: str, repos: Repositories = Depends(get_repositories)):
+    lists = await recommender.get(equipment_id) if recommender.enabled else None
+    lists = lists or {}
+    similar, also_rented = lists.get("similar", []), lists.get("also_rented", [])
+    equipment = await repos.reader("equipment_detail").equipment.get_many(
+        neighbor["equipment_id"] for neighbor in similar + also_rented
+    )
+    
+    def summaries(neighbors):
+        return [
+            RecommendedEquipment(**{**equipment[neighbor["equipment_id"]], "score": neighbor["score"]})
+            for neighbor in neighbors
+            if neighbor["equipment_id"] in equipment and equipment[neighbor["equipment_id"]].get("is_available", True)
+        ]
+    
+    return SimilarEquipmentResponse(
+        equipment_id=equipment_id,
+        similar=summaries(similar),
+        also_rented=summaries(also_rented)
     )
 
 @api_router.get("/my-equipment", response_model=List[EquipmentResponse])
-async def get_my_equipment(current_user: User = Depends(get_current_user)):
-    equipment_list = await db.equipment.find({"owner_id": current_user.id}).to_list(100)
-    
-    result = []
-    for equipment in equipment_list:
-        equipment_response = EquipmentResponse(
-            **equipment,
-            owner_name=current_user.name
-        )
-        result.append(equipment_response)
+async def get_my_equipment(
+    http_request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    async def build_responses(equipment_list):
+        return [EquipmentResponse(**{**equipment, "owner_name": current_user.name}) for equipment in equipment_list]
     
-    return result
+    if wants_ndjson(http_request):
+        return stream_responses(repos.equipment.iter_by_owner(current_user.id), build_responses)
+    
+    equipment_list = [equipment async for equipment in repos.equipment.iter_by_owner(current_user.id, limit=100)]
+    return await build_responses(equipment_list)
 
 # Rental request routes
 @api_router.post("/requests", response_model=RentalRequestResponse)
-async def create_rental_request(request_data: RentalRequestCreate, current_user: User = Depends(get_current_user)):
+async def create_rental_request(
+    request_data: RentalRequestCreate,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
     # Get equipment details
-    equipment = await db.equipment.find_one({"id": request_data.equipment_id})
-    if not equipment:
+    equipment = await repos.equipment.get(request_data.equipment_id)
+    if not equipment or equipment.get("deleted_at"):
         raise HTTPException(status_code=404, detail="Equipment not found")
     
     if equipment["owner_id"] == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot request your own equipment")
     
-    # Calculate total price
-    days = (request_data.end_date - request_data.start_date).days + 1
-    total_price = days * equipment["price_per_day"]
+    quote = price_quotes([(equipment, request_data.start_date, request_data.end_date)])[0]
+    if not quote["valid"]:
+        raise HTTPException(status_code=400, detail=quote["error"])
     
+    equipment = (await fill_names([equipment], "equipment", repos))[0]
     rental_request = RentalRequest(
         equipment_id=request_data.equipment_id,
         requester_id=current_user.id,
         owner_id=equipment["owner_id"],
+        requester_name=current_user.name,
+        owner_name=equipment["owner_name"],
         start_date=request_data.start_date,
         end_date=request_data.end_date,
-        total_price=total_price,
+        total_price=quote["total"],
+        deposit=quote["deposit"],
         message=request_data.message
     )
     
-    await db.rental_requests.insert_one(rental_request.dict())
+    await repos.rental_requests.insert(rental_request.dict())
+    repos.mark_write()
+    await record_analytics_transition(rental_request.dict(), None, RequestStatus.pending.value)
+    if recommender.enabled:
+        await job_queue.enqueue(
+            RECORD_RENTAL_JOB, {"requester_id": current_user.id, "equipment_id": request_data.equipment_id}
+        )
     
-    # Get owner and equipment details for response
-    owner = await db.users.find_one({"id": equipment["owner_id"]})
+    return RentalRequestResponse(**rental_request.dict(), equipment_title=equipment["title"])
+
+@api_router.post("/quotes", response_model=QuoteResponse)
+async def create_quotes(quote_request: QuoteRequest, repos: Repositories = Depends(get_repositories)):
+    # Prices many listings with one equipment fetch, e.g. to compare them side by side
+    if len(quote_request.items) > MAX_QUOTE_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_QUOTE_ITEMS} items per quote request")
     
-    return RentalRequestResponse(
-        **rental_request.dict(),
-        equipment_title=equipment["title"],
-        requester_name=current_user.name,
-        owner_name=owner["name"] if owner else "Unknown"
+    equipment = await repos.reader("equipment_detail").equipment.get_many(
+        item.equipment_id for item in quote_request.items
+    )
+    priced = price_quotes([
+        (equipment.get(item.equipment_id), item.start_date, item.end_date) for item in quote_request.items
+    ])
+    quotes = [Quote(**item.dict(), **price) for item, price in zip(quote_request.items, priced)]
+    return QuoteResponse(
+        quotes=quotes,
+        total=round(sum(quote.total for quote in quotes if quote.valid), 2),
+        deposit=round(sum(quote.deposit for quote in quotes if quote.valid), 2)
     )
 
 @api_router.get("/requests/received", response_model=List[RentalRequestResponse])
-async def get_received_requests(current_user: User = Depends(get_current_user)):
-    requests = await db.rental_requests.find({"owner_id": current_user.id}).to_list(100)
+async def get_received_requests(
+    http_request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    async def build_responses(requests):
+        return await build_rental_request_responses(requests, repos)
     
-    result = []
-    for request in requests:
-        equipment = await db.equipment.find_one({"id": request["equipment_id"]})
-        requester = await db.users.find_one({"id": request["requester_id"]})
-        
-        request_response = RentalRequestResponse(
-            **request,
-            equipment_title=equipment["title"] if equipment else "Unknown",
-            requester_name=requester["name"] if requester else "Unknown",
-            owner_name=current_user.name
-        )
-        result.append(request_response)
+    if wants_ndjson(http_request):
+        return stream_responses(repos.rental_requests.iter_for_owner(current_user.id), build_responses)
     
-    return result
+    requests = [request async for request in repos.rental_requests.iter_for_owner(current_user.id, limit=100)]
+    return await build_responses(requests)
 
 @api_router.get("/requests/sent", response_model=List[RentalRequestResponse])
-async def get_sent_requests(current_user: User = Depends(get_current_user)):
-    requests = await db.rental_requests.find({"requester_id": current_user.id}).to_list(100)
+async def get_sent_requests(
+    http_request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    async def build_responses(requests):
+        return await build_rental_request_responses(requests, repos)
     
-    result = []
-    for request in requests:
-        equipment = await db.equipment.find_one({"id": request["equipment_id"]})
-        owner = await db.users.find_one({"id": request["owner_id"]})
-        
-        request_response = RentalRequestResponse(
-            **request,
-            equipment_title=equipment["title"] if equipment else "Unknown",
-            requester_name=current_user.name,
-            owner_name=owner["name"] if owner else "Unknown"
-        )
-        result.append(request_response)
+    if wants_ndjson(http_request):
+        return stream_responses(repos.rental_requests.iter_for_requester(current_user.id), build_responses)
     
-    return result
+    requests = [request async for request in repos.rental_requests.iter_for_requester(current_user.id, limit=100)]
+    return await build_responses(requests)
 
 @api_router.put("/requests/{request_id}/status")
-async def update_request_status(request_id: str, status: RequestStatus, current_user: User = Depends(get_current_user)):
-    request = await db.rental_requests.find_one({"id": request_id})
-    if not request:
-        raise HTTPException(status_code=404, detail="Request not found")
+async def update_request_status(
+    request_id: str,
+    status: RequestStatus,
+    version: Optional[int] = None,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    # One conditional update enforces ownership, the state machine and the optional expected version
+    request = await repos.rental_requests.transition(
+        request_id,
+        current_user.id,
+        allowed_sources(status.value),
+        status.value,
+        datetime.utcnow(),
+        expected_version=version,
+        idempotency_key=idempotency_key
+    )
+    if request is None:
+        # Only failed transitions pay for a second read, to report why
+        current = await repos.rental_requests.get(request_id)
+        if not current:
+            transition_metrics.record("not_found")
+            raise HTTPException(status_code=404, detail="Request not found")
+        if current["owner_id"] != current_user.id:
+            transition_metrics.record("forbidden")
+            raise HTTPException(status_code=403, detail="Not authorized to update this request")
+        if idempotency_key and current.get("status_idempotency_key") == idempotency_key and current["status"] == status.value:
+            transition_metrics.record("replayed")
+            return {"message": f"Request status updated to {status.value}", "status": status.value, "version": current.get("version", 0)}
+        if not can_transition(current["status"], status.value):
+            transition_metrics.record("invalid")
+            raise HTTPException(status_code=409, detail=f"Cannot change status from {RequestStatus(current['status']).value} to {status.value}")
+        transition_metrics.record("conflict")
+        raise HTTPException(status_code=409, detail="Request was modified by someone else; reload and try again")
     
-    # Only owner can update status
-    if request["owner_id"] != current_user.id:
-        raise HTTPException(status_code=403, detail="Not authorized to update this request")
+    transition_metrics.record("applied")
+    repos.mark_write()
+    await record_analytics_transition(request, request["status"], status.value)
     
-    await db.rental_requests.update_one(
-        {"id": request_id},
-        {"$set": {"status": status, "updated_at": datetime.utcnow()}}
-    )
+    if status in (RequestStatus.approved, RequestStatus.declined):
+        notifier.notify(
+            request["requester_id"],
+            "request_status",
+            f"Your rental request has been {status.value}",
+            {"request_id": request_id, "status": status.value}
+        )
     
-    return {"message": f"Request status updated to {status}"}
+    return {"message": f"Request status updated to {status.value}", "status": status.value, "version": request.get("version", 0) + 1}
 
 # Message routes
 @api_router.post("/messages", response_model=MessageResponse)
-async def send_message(message_data: MessageCreate, current_user: User = Depends(get_current_user)):
+async def send_message(
+    message_data: MessageCreate,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
     # Verify request exists and user is part of it
-    request = await db.rental_requests.find_one({"id": message_data.request_id})
+    request = await repos.rental_requests.get(message_data.request_id)
     if not request:
         raise HTTPException(status_code=404, detail="Request not found")
     
     if current_user.id not in [request["owner_id"], request["requester_id"]]:
         raise HTTPException(status_code=403, detail="Not authorized to message in this request")
     
+    # Messages only ever go to the other party, whatever recipient the client names
+    sender_is_owner = current_user.id == request["owner_id"]
+    recipient_id = request["requester_id"] if sender_is_owner else request["owner_id"]
+    if message_data.recipient_id is not None and message_data.recipient_id != recipient_id:
+        raise HTTPException(status_code=400, detail="Messages can only be sent to the other party of the request")
+    
     message = Message(
         sender_id=current_user.id,
-        recipient_id=message_data.recipient_id,
+        recipient_id=recipient_id,
         request_id=message_data.request_id,
         content=message_data.content
     )
     
-    await db.messages.insert_one(message.dict())
-    
-    # Get recipient details
-    recipient = await db.users.find_one({"id": message_data.recipient_id})
+    await repos.messages.insert(message.dict())
+    repos.mark_write()
+    notifier.notify(
+        recipient_id,
+        "message",
+        f"New message from {current_user.name}",
+        {"request_id": message_data.request_id, "message_id": message.id}
+    )
     
+    request = (await fill_names([request], "rental_requests", repos))[0]
     return MessageResponse(
         **message.dict(),
         sender_name=current_user.name,
-        recipient_name=recipient["name"] if recipient else "Unknown"
+        recipient_name=request["requester_name"] if sender_is_owner else request["owner_name"]
     )
 
 @api_router.get("/messages/{request_id}", response_model=List[MessageResponse])
-async def get_messages(request_id: str, current_user: User = Depends(get_current_user)):
+async def get_messages(
+    request_id: str,
+    http_request: Request,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    reader = repos.reader("messages")
+    
     # Verify user is part of the request
-    request = await db.rental_requests.find_one({"id": request_id})
+    request = await reader.rental_requests.get(request_id)
     if not request:
-        raise HTTPException(status_code=404, detail="Request not found")
+        # Threads of archived requests come from the archive instead
+        archived = await get_archived_thread(request_id, current_user)
+        return await build_message_responses(archived["messages"], repos)
     
     if current_user.id not in [request["owner_id"], request["requester_id"]]:
         raise HTTPException(status_code=403, detail="Not authorized to view these messages")
     
-    messages = await db.messages.find({"request_id": request_id}).sort("timestamp", 1).to_list(1000)
+    async def build_responses(messages):
+        return await build_message_responses(messages, reader)
     
-    result = []
-    for message in messages:
-        sender = await db.users.find_one({"id": message["sender_id"]})
-        recipient = await db.users.find_one({"id": message["recipient_id"]})
-        
-        message_response = MessageResponse(
-            **message,
-            sender_name=sender["name"] if sender else "Unknown",
-            recipient_name=recipient["name"] if recipient else "Unknown"
-        )
-        result.append(message_response)
+    if wants_ndjson(http_request):
+        # Streamed threads are not capped; documents are encoded as they arrive
+        return stream_responses(reader.messages.iter_for_request(request_id), build_responses)
     
-    return result
+    messages = [message async for message in reader.messages.iter_for_request(request_id, limit=1000)]
+    return await build_responses(messages)
 
-# Include the router in the main app
-app.include_router(api_router)
+# Archive routes; slower than the hot collections, for history older than RETENTION_DAYS
+async def get_archived_thread(request_id: str, current_user: CurrentUser) -> dict:
+    archived = await archiver.get(request_id) if USE_MONGO else None
+    if not archived:
+        raise HTTPException(status_code=404, detail="Request not found")
+    if current_user.id not in [archived["request"]["owner_id"], archived["request"]["requester_id"]]:
+        raise HTTPException(status_code=403, detail="Not authorized to view this request")
+    return archived
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@api_router.get("/archive/requests", response_model=List[RentalRequestResponse])
+async def get_archived_requests(
+    limit: int = 50,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    if not USE_MONGO:
+        return []
+    records = archiver.iter_for_user(current_user.id, limit=min(limit, 200))
+    return await build_rental_request_responses([record["request"] async for record in records], repos)
+
+@api_router.get("/archive/requests/{request_id}", response_model=ArchivedRequestResponse)
+async def get_archived_request(
+    request_id: str,
+    current_user: CurrentUser = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    archived = await get_archived_thread(request_id, current_user)
+    requests = await build_rental_request_responses([archived["request"]], repos)
+    return ArchivedRequestResponse(
+        request=requests[0],
+        messages=await build_message_responses(archived["messages"], repos)
+    )
+
+# Analytics routes
+@api_router.get("/analytics/owner", response_model=OwnerAnalyticsResponse)
+async def get_owner_analytics(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    if not analytics.enabled:
+        raise HTTPException(status_code=503, detail="Analytics are not available without MongoDB")
+    
+    return await analytics.owner_report(current_user.id, start, end)
+
+@api_router.post("/analytics/owner/rebuild")
+async def rebuild_owner_analytics(current_user: CurrentUser = Depends(get_current_user)):
+    if not (analytics.enabled and job_queue.enabled):
+        raise HTTPException(status_code=503, detail="Analytics are not available without MongoDB")
+    job_id = await job_queue.enqueue(REBUILD_JOB, {"owner_id": current_user.id}, user_id=current_user.id)
+    return {"job_id": job_id}
+
+# Job routes
+@api_router.get("/jobs/stats")
+async def get_job_stats(current_user: CurrentUser = Depends(get_current_user)):
+    if not job_queue.enabled:
+        raise HTTPException(status_code=503, detail="The job queue is not available without MongoDB")
+    return await job_queue.stats()
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: CurrentUser = Depends(get_current_user)):
+    if not job_queue.enabled:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = await job_queue.get(job_id)
+    if not job or job.get("user_id") != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# Health routes
+@health_router.get("/healthz")
+async def liveness():
+    return {"status": "ok"}
+
+@health_router.get("/readyz")
+async def readiness():
+    ready, checks = await readiness_probe.check()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "unavailable", "checks": checks}
+    )
+
+@health_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    lag = loop_lag_monitor.stats()
+    samples = [
+        ("toala_event_loop_lag_seconds", "gauge", {"quantile": "0.5"}, lag["p50_lag_seconds"]),
+        ("toala_event_loop_lag_seconds", "gauge", {"quantile": "0.99"}, lag["p99_lag_seconds"]),
+        ("toala_event_loop_lag_last_seconds", "gauge", {}, lag["last_lag_seconds"]),
+        ("toala_event_loop_lag_max_seconds", "gauge", {}, lag["max_lag_seconds"]),
+        ("toala_event_loop_lag_samples_total", "counter", {}, lag["samples"]),
+        ("toala_event_loop_blocked_total", "counter", {}, lag["blocked_total"]),
+    ]
+    if USE_MONGO:
+        pool = db.pool_stats()
+        samples += [
+            ("toala_mongo_pool_connections", "gauge", {"state": state}, pool[state])
+            for state in ("in_use", "waiting", "open")
+        ]
+    if CHANGE_FEED_ENABLED:
+        samples.append(("toala_change_feed_events_total", "counter", {}, change_feed.dispatched))
+    samples += [
+        ("toala_request_transitions_total", "counter", {"outcome": outcome}, count)
+        for outcome, count in transition_metrics.stats().items()
+    ]
+    for rule, counts in rate_limiter.stats().items():
+        samples += [
+            ("toala_rate_limit_requests_total", "counter", {"rule": rule, "outcome": outcome}, count)
+            for outcome, count in counts.items()
+        ]
+    return prometheus_text(samples)
+
+@api_router.get("/ratelimit/stats")
+async def get_rate_limit_stats(current_user: CurrentUser = Depends(get_current_user)):
+    return rate_limiter.stats()
+
+@api_router.get("/debug/event-loop")
+async def get_event_loop_report(current_user: CurrentUser = Depends(get_current_user)):
+    if not loop_lag_monitor.detect_blocking:
+        raise HTTPException(status_code=404, detail="Blocking-call detection is disabled")
+    return {"stats": loop_lag_monitor.stats(), "reports": list(loop_lag_monitor.reports)}
 
 # Configure logging
 logging.basicConfig(
@@ -511,6 +1441,91 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+async def ensure_indexes():
+    try:
+        await repositories.ensure_indexes()
+        await job_queue.ensure_indexes()
+        await notifier.ensure_indexes()
+        await analytics.ensure_indexes()
+        await revocations.ensure_indexes()
+        await idempotency_store.ensure_indexes()
+        await recommender.ensure_indexes()
+        await archiver.ensure_indexes()
+        await owner_names.ensure_indexes()
+        if CHANGE_FEED_ENABLED:
+            await change_feed.ensure_indexes()
+    except Exception:
+        logger.exception("Index creation failed")
+
+async def run_migrations():
+    try:
+        await migration_runner.run()
+    except Exception:
+        logger.exception("Schema migration failed")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    loop_lag_monitor.start()
+    if USE_MONGO:
+        await db.connect()
+        await db.self_test()
+        # Index builds can take a while on large collections; don't hold up readiness for them
+        index_task = asyncio.create_task(ensure_indexes())
+        migration_task = asyncio.create_task(run_migrations()) if MIGRATE_ON_STARTUP else None
+        notifier.start()
+        revocations.start()
+        if CHANGE_FEED_ENABLED:
+            change_feed.start()
+        if JOB_WORKER_IN_PROCESS:
+            job_queue.start()
+    else:
+        logger.warning("DATA_BACKEND=%s: using in-memory repositories, jobs and analytics are disabled", DATA_BACKEND)
+        index_task = migration_task = None
+    logger.info("Startup complete in %.0f ms", (time.perf_counter() - started) * 1000)
+    
+    yield
+    
+    for task in (index_task, migration_task):
+        if task is not None and not task.done():
+            task.cancel()
+    await notifier.stop()
+    await revocations.stop()
+    await change_feed.stop()
+    await job_queue.stop()
+    await loop_lag_monitor.stop()
+    image_store.shutdown()
+    db.close()
+
+def create_app() -> FastAPI:
+    app = FastAPI(title="Toala.at Equipment Lending API", lifespan=lifespan)
+    
+    # Include the router in the main app
+    app.include_router(api_router)
+    app.include_router(health_router)
+    
+    # Innermost, so the write marker is set on whatever response the handler produced
+    app.add_middleware(ReadYourWritesMiddleware, recent_writes=db.recent_writes)
+    
+    app.add_middleware(
+        IdempotencyMiddleware,
+        store=idempotency_store,
+        identify=token_service.subject,
+        paths=IDEMPOTENT_PATHS
+    )
+    
+    # Added before CORS so that 429 responses still carry CORS headers
+    if RATE_LIMIT_ENABLED:
+        app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+    
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Last-Write"],
+    )
+    return app
+
+app = create_app()
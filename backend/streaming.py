@@ -0,0 +1,175 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+
+# MongoDB's document size limit: a longer row could not be stored anyway
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+# A parsed input row: (line number, record or None, error message or None)
+ParsedRow = Tuple[int, Optional[Dict[str, Any]], Optional[str]]
+# An input line: (text or None, error message or None)
+Line = Tuple[Optional[str], Optional[str]]
+
+
+def _line_too_long(max_line_bytes: int) -> str:
+    return f"Line is longer than {max_line_bytes} bytes"
+
+
+def _decode_line(line: bytes, max_line_bytes: int) -> Line:
+    if len(line) > max_line_bytes:
+        return None, _line_too_long(max_line_bytes)
+    try:
+        return line.decode("utf-8").rstrip("\r"), None
+    except UnicodeDecodeError as e:
+        return None, f"Line is not valid UTF-8 (byte {e.start})"
+
+
+async def iter_lines(chunks: AsyncIterable[bytes], max_line_bytes: int = MAX_LINE_BYTES) -> AsyncIterator[Line]:
+    """Split a byte stream into text lines without buffering the whole body.
+
+    A line that is not UTF-8 or is longer than ``max_line_bytes`` comes back
+    as an error instead, so one bad row does not end the stream; the rest of
+    an over-long line is skipped rather than buffered.
+    """
+    buffer = b""
+    overflow = False
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if overflow:
+                overflow = False
+                yield None, _line_too_long(max_line_bytes)
+            else:
+                yield _decode_line(line, max_line_bytes)
+        if len(buffer) > max_line_bytes:
+            overflow = True
+            buffer = b""
+    if overflow:
+        yield None, _line_too_long(max_line_bytes)
+    elif buffer:
+        yield _decode_line(buffer, max_line_bytes)
+
+
+async def iter_ndjson_rows(chunks: AsyncIterable[bytes]) -> AsyncIterator[ParsedRow]:
+    line_no = 0
+    async for line, error in iter_lines(chunks):
+        line_no += 1
+        if error is not None:
+            yield line_no, None, error
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "Each line must be a JSON object"
+            continue
+        yield line_no, record, None
+
+
+async def iter_csv_rows(
+    chunks: AsyncIterable[bytes], list_fields: Iterable[str] = (), max_line_bytes: int = MAX_LINE_BYTES
+) -> AsyncIterator[ParsedRow]:
+    """Parse CSV rows as they stream in; the first record is the header.
+
+    Empty cells are dropped so model defaults apply, and ``list_fields`` are
+    split on ``|``. Quoted values may span several lines, as in our own
+    exports; errors are reported at the line the record starts on.
+    """
+    list_fields = set(list_fields)
+    header: Optional[List[str]] = None
+    line_no = start_line = 0
+    pending: List[str] = []
+    pending_bytes = 0
+    async for line, error in iter_lines(chunks, max_line_bytes):
+        line_no += 1
+        if error is not None:
+            yield (start_line if pending else line_no), None, error
+            pending, pending_bytes = [], 0
+            continue
+        if not pending:
+            if not line.strip():
+                continue
+            start_line = line_no
+        pending.append(line + "\n")
+        pending_bytes += len(line) + 1
+        try:
+            values = next(csv.reader(pending, strict=True))
+        except csv.Error as e:
+            if str(e) == "unexpected end of data":
+                # Inside a quoted value that continues on the next line
+                if pending_bytes > max_line_bytes:
+                    yield start_line, None, f"Quoted value is longer than {max_line_bytes} bytes"
+                    pending, pending_bytes = [], 0
+                continue
+            try:
+                values = next(csv.reader(pending))
+            except csv.Error as e:
+                yield start_line, None, f"Invalid CSV: {e}"
+                pending, pending_bytes = [], 0
+                continue
+        pending, pending_bytes = [], 0
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        if len(values) != len(header):
+            yield start_line, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        record: Dict[str, Any] = {}
+        for key, value in zip(header, values):
+            if value == "":
+                continue
+            record[key] = value.split("|") if key in list_fields else value
+        yield start_line, record, None
+    if pending:
+        yield start_line, None, "Invalid CSV: quoted value is not closed"
+
+
+async def iter_batches(cursor: AsyncIterable[Dict[str, Any]], size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Group documents from an async cursor into lists of at most ``size``."""
+    batch: List[Dict[str, Any]] = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return str(value)
+
+
+def ndjson_line(data: Dict[str, Any]) -> bytes:
+    return (json.dumps(data, default=_json_default, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def csv_line(values: Iterable[Any]) -> bytes:
+    out = io.StringIO()
+    csv.writer(out).writerow(
+        [
+            "|".join(value) if isinstance(value, list)
+            else "" if value is None
+            else value.value if isinstance(value, Enum)
+            else value
+            for value in values
+        ]
+    )
+    return out.getvalue().encode("utf-8")
@@ -0,0 +1,455 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import uuid
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+logger = logging.getLogger(__name__)
+
+# Accepted upload types -> Pillow format used when re-encoding
+IMAGE_TYPES = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_IMAGE_DIMENSION = 2048
+MAX_IMAGE_PIXELS = 40_000_000  # larger images are refused before being decoded in full
+SPOOL_MEMORY_BYTES = 1024 * 1024  # upload parts above this are spooled to a temporary file
+STORE_CHUNK_BYTES = 255 * 1024  # GridFS default chunk size
+# Responsive variants: widths rendered (never above the image's own) and formats, best first
+VARIANT_WIDTHS = (320, 640, 1280)
+VARIANT_TYPES = {"image/avif": "AVIF", "image/webp": "WEBP"}
+VARIANT_EXTENSIONS = {"image/avif": "avif", "image/webp": "webp"}
+ENCODE_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+    "WEBP": {"quality": 80, "method": 4},
+    "AVIF": {"quality": 60, "speed": 6},
+}
+IMAGE_URL_PREFIX = "/api/images/"
+
+
+class UploadRejected(Exception):
+    status_code = 400
+
+
+class UploadTooLarge(UploadRejected):
+    status_code = 413
+
+
+class UnsupportedImageType(UploadRejected):
+    status_code = 415
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Content type from an image's first bytes, whatever the client claimed."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+@dataclass
+class UploadedFile:
+    """An image part, kept in memory while small and spooled to a temporary file beyond that.
+
+    The spill file is named (unlike ``tempfile.SpooledTemporaryFile``'s), so
+    the image worker processes can open it by path instead of being sent the
+    bytes; ``close`` removes it.
+    """
+
+    field_name: str
+    filename: str
+    content_type: str
+    size: int = 0
+    head: bytes = b""
+    _buffer: Optional[io.BytesIO] = field(default_factory=io.BytesIO, repr=False)
+    _spool: Optional[Any] = field(default=None, repr=False)
+
+    def write(self, data: bytes):
+        if len(self.head) < 12:
+            self.head += data[:12 - len(self.head)]
+        self.size += len(data)
+        if self._spool is None and self.size > SPOOL_MEMORY_BYTES:
+            self._spool = tempfile.NamedTemporaryFile(prefix="upload-", delete=False)
+            self._spool.write(self._buffer.getbuffer())
+            self._buffer = None
+        (self._spool or self._buffer).write(data)
+
+    def source(self) -> Union[bytes, str]:
+        """What ``process_image`` reads: the bytes of a small part, or the path of a spooled one."""
+        if self._spool is None:
+            return self._buffer.getvalue()
+        self._spool.flush()
+        return self._spool.name
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            try:
+                os.unlink(self._spool.name)
+            except FileNotFoundError:
+                pass
+            self._spool = None
+
+
+class _ImagePartReader:
+    """python-multipart callbacks that collect image parts within the limits.
+
+    Limits are checked as each chunk arrives, so an oversized or mistyped
+    upload is refused after at most one chunk past the limit, not after the
+    whole body has been read. Image data is spooled through ``UploadedFile``
+    and non-file fields are skipped without buffering.
+    """
+
+    def __init__(self, max_file_bytes: int, max_files: int):
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.files: List[UploadedFile] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+        self._current: Optional[UploadedFile] = None
+
+    def callbacks(self) -> Dict[str, Any]:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._current = None
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[bytes(self._header_field).lower()] = bytes(self._header_value)
+        self._header_field.clear()
+        self._header_value.clear()
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in options:
+            return
+        if len(self.files) >= self.max_files:
+            raise UploadRejected(f"At most {self.max_files} files per upload")
+        content_type = parse_options_header(self._headers.get(b"content-type", b""))[0].decode("latin-1").lower()
+        if content_type not in IMAGE_TYPES:
+            raise UnsupportedImageType(f"Images must be one of: {', '.join(IMAGE_TYPES)}")
+        self._current = UploadedFile(
+            options.get(b"name", b"").decode("utf-8", "replace"),
+            options[b"filename"].decode("utf-8", "replace"),
+            content_type,
+        )
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._current is None:
+            return
+        received = self._current.size
+        if received + end - start > self.max_file_bytes:
+            raise UploadTooLarge(f"Images must be at most {self.max_file_bytes / (1024 * 1024):.1f} MB")
+        self._current.write(data[start:end])
+        if received < 12 <= self._current.size:
+            self._check_type()
+
+    def on_part_end(self):
+        if self._current is not None:
+            self._check_type()
+            self.files.append(self._current)
+        self._current = None
+
+    def close(self):
+        for upload in self.files + ([self._current] if self._current is not None else []):
+            upload.close()
+
+    def _check_type(self):
+        if sniff_image_type(self._current.head) != self._current.content_type:
+            raise UnsupportedImageType(
+                f"{self._current.filename} is not a valid {IMAGE_TYPES[self._current.content_type]} image"
+            )
+
+
+async def read_image_parts(request, max_file_bytes: int = MAX_IMAGE_BYTES, max_files: int = 1) -> List[UploadedFile]:
+    """Parse a multipart/form-data request body as it streams in, keeping only image parts.
+
+    The caller closes the returned files once they are processed.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadRejected("Expected a multipart/form-data body")
+    # Refuse declared oversized bodies before reading any of it; a little slack for part headers
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_files * (max_file_bytes + 16 * 1024):
+        raise UploadTooLarge(f"Upload must be at most {max_files * max_file_bytes / (1024 * 1024):.1f} MB")
+
+    reader = _ImagePartReader(max_file_bytes, max_files)
+    parser = MultipartParser(params[b"boundary"], reader.callbacks())
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+        if not reader.files:
+            raise UploadRejected("No image file in the upload")
+    except BaseException:
+        reader.close()
+        raise
+    return reader.files
+
+
+def _encode(image, content_type: str) -> bytes:
+    image_format = IMAGE_TYPES.get(content_type) or VARIANT_TYPES[content_type]
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    options = dict(ENCODE_OPTIONS.get(image_format, {}))
+    # Colour profiles are kept; EXIF (camera, GPS) and other metadata are not passed on
+    if image.info.get("icc_profile"):
+        options["icc_profile"] = image.info["icc_profile"]
+    output = io.BytesIO()
+    image.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def variant_widths(width: int, widths: Sequence[int] = VARIANT_WIDTHS) -> List[int]:
+    """Widths to render for an image ``width`` pixels wide; never upscaled, always including its own."""
+    return sorted({candidate for candidate in widths if candidate < width} | {width})
+
+
+def process_image(source: Union[bytes, str], content_type: str, max_dimension: int = MAX_IMAGE_DIMENSION,
+                  widths: Sequence[int] = VARIANT_WIDTHS,
+                  formats: Sequence[str] = tuple(VARIANT_TYPES)) -> Dict[str, Any]:
+    """Normalize an upload and render its responsive variants.
+
+    Runs in a worker process, on the upload's bytes or the path of its
+    spooled copy. The image is decoded, turned upright
+    according to its EXIF orientation, shrunk to ``max_dimension`` and
+    re-encoded in its own format without metadata such as GPS positions;
+    anything that does not decode as the declared type is refused. Each of
+    ``variant_widths`` is then encoded in each of ``formats`` the installed
+    Pillow can write (AVIF needs Pillow 11.2+ or pillow-avif-plugin).
+    """
+    # Imported here so the API processes never load Pillow themselves
+    from PIL import Image, ImageOps
+
+    try:
+        import pillow_avif  # noqa: F401  (registers AVIF on older Pillow)
+    except ImportError:
+        pass
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    warnings.simplefilter("error", Image.DecompressionBombWarning)
+    try:
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        if Image.MIME.get(image.format) != content_type:
+            raise UnsupportedImageType(f"Not a valid {IMAGE_TYPES[content_type]} image")
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise UploadTooLarge(f"Images must be at most {MAX_IMAGE_PIXELS // 1_000_000} megapixels")
+    except (OSError, SyntaxError, ValueError):
+        raise UnsupportedImageType("The image could not be decoded")
+
+    Image.init()
+    supported = [variant_type for variant_type in formats if VARIANT_TYPES[variant_type] in Image.SAVE]
+    variants = []
+    for width in variant_widths(image.width, widths):
+        resized = image if width == image.width else image.resize(
+            (width, max(1, round(image.height * width / image.width))), Image.LANCZOS
+        )
+        for variant_type in supported:
+            variants.append({"width": width, "content_type": variant_type, "data": _encode(resized, variant_type)})
+    return {"data": _encode(image, content_type), "content_type": content_type, "width": image.width,
+            "height": image.height, "variants": variants}
+
+
+def image_id_from_url(url: Optional[str]) -> Optional[str]:
+    """The stored image id behind an image URL, or None for base64 and external images."""
+    if url and url.startswith(IMAGE_URL_PREFIX):
+        return url[len(IMAGE_URL_PREFIX):]
+    return None
+
+
+def variant_id(image_id: str, width: int, content_type: str) -> str:
+    return f"{image_id}/{width}.{VARIANT_EXTENSIONS[content_type]}"
+
+
+def image_sources(image_id: str, width: int, height: int, variants: Iterable[Tuple[int, str]]) -> Dict[str, Any]:
+    """What a client needs for a responsive <img>/<picture>: size and a srcset per content type."""
+    srcset: Dict[str, List[str]] = {}
+    for variant_width, content_type in sorted(variants):
+        srcset.setdefault(content_type, []).append(
+            f"{IMAGE_URL_PREFIX}{variant_id(image_id, variant_width, content_type)} {variant_width}w"
+        )
+    return {"width": width, "height": height,
+            "srcset": {content_type: ", ".join(entries) for content_type, entries in srcset.items()}}
+
+
+class ImageStore:
+    """Uploaded images, processed in a process pool and stored in GridFS.
+
+    Decoding, resizing and transcoding are CPU-bound and would stall the
+    event loop, so they run in a pool of ``workers`` processes started on
+    first use. The normalized image and its variants are written to the
+    ``images`` GridFS bucket in chunks, all under the image id as filename,
+    and served back by id. Stored files never change, so they can be cached
+    for good. With ``enabled`` off (no MongoDB) images are kept in memory.
+    """
+
+    def __init__(self, db, bucket: str = "images", workers: int = 2, max_dimension: int = MAX_IMAGE_DIMENSION,
+                 widths: Sequence[int] = VARIANT_WIDTHS, formats: Sequence[str] = tuple(VARIANT_TYPES),
+                 enabled: bool = True):
+        self.db = db
+        self.bucket_name = bucket
+        self.workers = workers
+        self.max_dimension = max_dimension
+        self.widths = tuple(widths)
+        self.formats = tuple(formats)
+        self.enabled = enabled
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._memory: Dict[str, Tuple[bytes, Dict[str, Any]]] = {}
+
+    @property
+    def bucket(self):
+        # Pool workers import this module too; driver imports stay out of its top level
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+        return AsyncIOMotorGridFSBucket(self.db.database, bucket_name=self.bucket_name, chunk_size_bytes=STORE_CHUNK_BYTES)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Spawned rather than forked: the parent has a running event loop and driver threads
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def _write(self, file_id: str, image_id: str, data: bytes, metadata: Dict[str, Any]):
+        if not self.enabled:
+            self._memory[file_id] = (data, metadata)
+            return
+        stream = self.bucket.open_upload_stream_with_id(file_id, image_id, metadata=metadata)
+        try:
+            for start in range(0, len(data), STORE_CHUNK_BYTES):
+                await stream.write(data[start:start + STORE_CHUNK_BYTES])
+        except BaseException:
+            await stream.abort()
+            raise
+        await stream.close()
+
+    async def save(self, upload: UploadedFile, owner_id: str, kind: str) -> Dict[str, Any]:
+        processed = await asyncio.get_running_loop().run_in_executor(
+            self._executor(), process_image, upload.source(), upload.content_type, self.max_dimension,
+            self.widths, self.formats
+        )
+        image_id = uuid.uuid4().hex
+        metadata = {"owner_id": owner_id, "kind": kind, "width": processed["width"], "height": processed["height"],
+                    "original_filename": upload.filename, "uploaded_at": datetime.utcnow()}
+        try:
+            await self._write(image_id, image_id, processed["data"],
+                              {**metadata, "content_type": processed["content_type"]})
+            for variant in processed["variants"]:
+                await self._write(variant_id(image_id, variant["width"], variant["content_type"]), image_id,
+                                  variant["data"], {**metadata, "content_type": variant["content_type"],
+                                                    "variant_width": variant["width"]})
+        except BaseException:
+            await self.delete(image_id)
+            raise
+        return {
+            "id": image_id,
+            "url": f"{IMAGE_URL_PREFIX}{image_id}",
+            "size": len(processed["data"]) + sum(len(variant["data"]) for variant in processed["variants"]),
+            "sources": image_sources(
+                image_id, processed["width"], processed["height"],
+                [(variant["width"], variant["content_type"]) for variant in processed["variants"]]
+            ),
+            **metadata,
+        }
+
+    async def open(self, file_id: str) -> Optional[Tuple[Dict[str, Any], int, AsyncIterator[bytes]]]:
+        """Metadata, length and a chunk iterator for a stored image or variant, or None."""
+        if not self.enabled:
+            if file_id not in self._memory:
+                return None
+            data, metadata = self._memory[file_id]
+
+            async def memory_chunks():
+                yield data
+            return metadata, len(data), memory_chunks()
+
+        from gridfs.errors import NoFile
+
+        try:
+            stream = await self.bucket.open_download_stream(file_id)
+        except NoFile:
+            return None
+
+        async def chunks():
+            while True:
+                chunk = await stream.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+        return stream.metadata or {}, stream.length, chunks()
+
+    async def owned(self, file_ids: Iterable[str], owner_id: str) -> Set[str]:
+        """The ids among ``file_ids`` of stored images or variants uploaded by ``owner_id``."""
+        file_ids = set(file_ids)
+        if not file_ids:
+            return set()
+        if not self.enabled:
+            return {file_id for file_id in file_ids
+                    if file_id in self._memory and self._memory[file_id][1].get("owner_id") == owner_id}
+        cursor = self.bucket.find({"_id": {"$in": list(file_ids)}, "metadata.owner_id": owner_id})
+        return {grid_out._id async for grid_out in cursor}
+
+    async def delete(self, image_id: str, owner_id: Optional[str] = None) -> int:
+        """Delete an image and all of its variants; returns the number of files removed.
+
+        With ``owner_id``, only files that user uploaded are removed, since an
+        image URL can be copied into anyone's listing or profile.
+        """
+        if not self.enabled:
+            file_ids = [file_id for file_id, (_, metadata) in self._memory.items()
+                        if file_id.split("/")[0] == image_id and owner_id in (None, metadata.get("owner_id"))]
+            for file_id in file_ids:
+                del self._memory[file_id]
+            return len(file_ids)
+
+        from gridfs.errors import NoFile
+
+        query = {"filename": image_id}
+        if owner_id is not None:
+            query["metadata.owner_id"] = owner_id
+        bucket = self.bucket
+        deleted = 0
+        async for grid_out in bucket.find(query, no_cursor_timeout=False):
+            try:
+                await bucket.delete(grid_out._id)
+                deleted += 1
+            except NoFile:
+                pass
+        return deleted
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,34 @@
+"""Standalone background job worker.
+
+Run with ``python worker.py`` next to the API (set JOB_WORKER_IN_PROCESS=false
+on the API processes so only the worker consumes jobs).
+"""
+import asyncio
+import logging
+import signal
+
+from server import CHANGE_FEED_ENABLED, change_feed, db, job_queue
+
+logger = logging.getLogger("worker")
+
+
+async def main():
+    await db.connect()
+    await db.self_test()
+    await job_queue.ensure_indexes()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, job_queue.request_stop)
+    if CHANGE_FEED_ENABLED:
+        # Only one process follows the feed at a time; the others stand by
+        change_feed.start()
+    logger.info("Job worker started for types: %s", ", ".join(job_queue.specs) or "none")
+    try:
+        await job_queue.run()
+    finally:
+        await change_feed.stop()
+        db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
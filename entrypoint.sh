@@ -5,8 +5,8 @@ set -e
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
 echo "Starting FastAPI backend"
-# Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
+# Start the multi-worker server (see backend/serve.py)
+python3 serve.py &
 BACKEND_PID=$!
 
 echo "Waiting for backend to start..."
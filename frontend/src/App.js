@@ -5,6 +5,50 @@ import axios from 'axios';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Uploaded images are served by the API; older listings store base64 data
+const imageSrc = (image) => {
+  if (image.startsWith('data:') || image.startsWith('http')) return image;
+  if (image.startsWith('/api/')) return `${BACKEND_URL}${image}`;
+  return `data:image/jpeg;base64,${image}`;
+};
+
+// Width an image takes in the equipment grids, so the browser picks a small variant
+const GRID_IMAGE_SIZES = '(min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw';
+
+// Uploaded images come with AVIF/WebP variants at several widths; others are shown as they are
+const ResponsiveImage = ({ image, sources, sizes = '100vw', alt, className }) => {
+  const id = image.startsWith('/api/images/') ? image.slice('/api/images/'.length) : null;
+  const variants = id && sources ? sources[id] : null;
+  if (!variants) {
+    return <img src={imageSrc(image)} alt={alt} className={className} loading="lazy" decoding="async" />;
+  }
+  const withBackend = (srcset) => srcset.split(', ').map((entry) => `${BACKEND_URL}${entry}`).join(', ');
+  return (
+    <picture>
+      {Object.entries(variants.srcset).map(([type, srcset]) => (
+        <source key={type} type={type} srcSet={withBackend(srcset)} sizes={sizes} />
+      ))}
+      <img
+        src={imageSrc(image)}
+        width={variants.width}
+        height={variants.height}
+        alt={alt}
+        className={className}
+        loading="lazy"
+        decoding="async"
+      />
+    </picture>
+  );
+};
+
+// The API reports when we last wrote; echoing it keeps our next reads on up-to-date
+// database servers, whichever backend process answers them
+axios.interceptors.response.use((response) => {
+  const lastWrite = response.headers['x-last-write'];
+  if (lastWrite) axios.defaults.headers.common['X-Last-Write'] = lastWrite;
+  return response;
+});
+
 // Auth Context
 const AuthContext = createContext();
 
@@ -701,8 +745,10 @@ const EquipmentCard = ({ equipment, setCurrentView }) => {
   return (
     <div className="bg-white rounded-lg shadow-md overflow-hidden hover:shadow-lg transition-shadow duration-300">
       {equipment.images && equipment.images.length > 0 && (
-        <img
-          src={equipment.images[0].startsWith('data:') ? equipment.images[0] : `data:image/jpeg;base64,${equipment.images[0]}`}
+        <ResponsiveImage
+          image={equipment.images[0]}
+          sources={equipment.image_sources}
+          sizes={GRID_IMAGE_SIZES}
           alt={equipment.title}
           className="w-full h-48 object-cover"
         />
@@ -837,8 +883,9 @@ const EquipmentDetail = ({ setCurrentView }) => {
         <div className="bg-white rounded-lg shadow-md overflow-hidden">
           {equipment.images && equipment.images.length > 0 && (
             <div className="relative">
-              <img
-                src={equipment.images[0].startsWith('data:') ? equipment.images[0] : `data:image/jpeg;base64,${equipment.images[0]}`}
+              <ResponsiveImage
+                image={equipment.images[0]}
+                sources={equipment.image_sources}
                 alt={equipment.title}
                 className="w-full h-64 object-cover"
               />
@@ -1066,8 +1113,10 @@ const MyEquipment = ({ setCurrentView }) => {
             {equipment.map((item) => (
               <div key={item.id} className="bg-white rounded-lg shadow-md overflow-hidden">
                 {item.images && item.images.length > 0 && (
-                  <img
-                    src={item.images[0].startsWith('data:') ? item.images[0] : `data:image/jpeg;base64,${item.images[0]}`}
+                  <ResponsiveImage
+                    image={item.images[0]}
+                    sources={item.image_sources}
+                    sizes={GRID_IMAGE_SIZES}
                     alt={item.title}
                     className="w-full h-48 object-cover"
                   />
@@ -1136,24 +1185,23 @@ const AddEquipment = ({ setCurrentView }) => {
     { value: 'other', label: 'Sonstiges' }
   ];
 
+  // Selected files stay files; they are uploaded as multipart once the listing exists
+  const imagesRef = useRef(images);
+  imagesRef.current = images;
+  useEffect(() => () => imagesRef.current.forEach(image => URL.revokeObjectURL(image.preview)), []);
+
   const handleImageUpload = (e) => {
     const files = Array.from(e.target.files);
+    e.target.value = '';
     if (files.length + images.length > 10) {
       setError('Maximum 10 images allowed');
       return;
     }
-
-    files.forEach(file => {
-      const reader = new FileReader();
-      reader.onload = (event) => {
-        const fullDataUrl = event.target.result; // Keep the full data URL
-        setImages(prev => [...prev, fullDataUrl]);
-      };
-      reader.readAsDataURL(file);
-    });
+    setImages(prev => [...prev, ...files.map(file => ({ file, preview: URL.createObjectURL(file) }))]);
   };
 
   const removeImage = (index) => {
+    URL.revokeObjectURL(images[index].preview);
     setImages(prev => prev.filter((_, i) => i !== index));
   };
 
@@ -1166,18 +1214,26 @@ const AddEquipment = ({ setCurrentView }) => {
       const equipmentData = {
         ...formData,
         price_per_day: parseFloat(formData.price_per_day),
-        max_rental_days: formData.max_rental_days ? parseInt(formData.max_rental_days) : null,
-        images: images
+        max_rental_days: formData.max_rental_days ? parseInt(formData.max_rental_days) : null
       };
 
       const response = await axios.post(`${API}/equipment`, equipmentData);
-      
-      if (response.status === 200) {
-        setSuccess(true);
-        setTimeout(() => {
-          setCurrentView('my-equipment');
-        }, 2000);
+
+      if (images.length > 0) {
+        const upload = new FormData();
+        images.forEach(image => upload.append('images', image.file, image.file.name));
+        try {
+          await axios.post(`${API}/equipment/${response.data.id}/images`, upload);
+        } catch (error) {
+          setError(`Listing created, but the images could not be uploaded: ${error.response?.data?.detail || error.message}`);
+          return;
+        }
       }
+
+      setSuccess(true);
+      setTimeout(() => {
+        setCurrentView('my-equipment');
+      }, 2000);
     } catch (error) {
       setError(error.response?.data?.detail || 'Failed to create equipment listing');
     } finally {
@@ -1314,7 +1370,7 @@ const AddEquipment = ({ setCurrentView }) => {
               <input
                 type="file"
                 multiple
-                accept="image/*"
+                accept="image/jpeg,image/png,image/webp"
                 onChange={handleImageUpload}
                 className="w-full px-3 py-2 border border-gray-300 rounded-lg focus:outline-none focus:ring-2 focus:ring-blue-500"
               />
@@ -1324,7 +1380,7 @@ const AddEquipment = ({ setCurrentView }) => {
                   {images.map((image, index) => (
                     <div key={index} className="relative">
                       <img
-                        src={image.startsWith('data:') ? image : `data:image/jpeg;base64,${image}`}
+                        src={image.preview}
                         alt={`Upload ${index + 1}`}
                         className="w-full h-24 object-cover rounded-lg"
                       />
@@ -65,12 +65,13 @@ fi
 
 # Check Backend API
 print_status "Checking Backend API..."
-if docker exec toala_backend curl -f http://localhost:8001/docs >/dev/null 2>&1; then
+# Liveness, as the container healthcheck sees it
+if docker exec toala_backend curl -f http://localhost:8001/healthz >/dev/null 2>&1; then
     print_success "Backend API is responding"
 else
     print_warning "Backend API check failed, trying alternative..."
-    # Try without curl
-    if docker exec toala_backend python -c "import requests; requests.get('http://localhost:8001/docs')" >/dev/null 2>&1; then
+    # Try without curl; urlopen raises on any error status
+    if docker exec toala_backend python -c "import urllib.request; urllib.request.urlopen('http://localhost:8001/healthz', timeout=5)" >/dev/null 2>&1; then
         print_success "Backend API is responding (alternative check)"
     else
         print_error "Backend API is not responding"
@@ -78,6 +79,13 @@ else
     fi
 fi
 
+# Readiness (MongoDB, indexes, pool, event loop) is reported, but only the load balancer acts on it
+if docker exec toala_backend python -c "import urllib.request; urllib.request.urlopen('http://localhost:8001/readyz', timeout=5)" >/dev/null 2>&1; then
+    print_success "Backend API is ready for traffic"
+else
+    print_warning "Backend API is alive but not ready; see http://localhost:8001/readyz for the failing check"
+fi
+
 # Check Frontend
 print_status "Checking Frontend..."
 if docker exec toala_frontend curl -f http://localhost/ >/dev/null 2>&1; then
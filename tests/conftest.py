@@ -0,0 +1,61 @@
+"""Fixtures for running the API in-process on the in-memory backend.
+
+The environment is set before ``server`` is first imported, since the
+module reads its configuration at import time.
+"""
+import os
+
+os.environ["DATA_BACKEND"] = "memory"
+os.environ["RATE_LIMIT_ENABLED"] = "false"
+os.environ.setdefault("JWT_SECRET", "test-secret-that-is-long-enough-for-hs256")
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from repositories import InMemoryRepositories
+
+
+@pytest.fixture
+def repos():
+    return InMemoryRepositories()
+
+
+@pytest.fixture
+def client(repos):
+    app = server.create_app()
+    app.dependency_overrides[server.get_repositories] = lambda: repos
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def register(client):
+    """Register a user and return ``(auth headers, user)``."""
+    def register_user(name: str, location: str = "Wien"):
+        response = client.post("/api/auth/register", json={
+            "email": f"{name.lower()}@example.com",
+            "name": name,
+            "password": "secret",
+            "location": location,
+        })
+        assert response.status_code == 200, response.text
+        body = response.json()
+        return {"Authorization": f"Bearer {body['access_token']}"}, body["user"]
+    return register_user
+
+
+@pytest.fixture
+def create_equipment(client):
+    def create(headers, title: str = "Bohrmaschine", price_per_day: float = 10.0, **fields):
+        response = client.post("/api/equipment", headers=headers, json={
+            "title": title,
+            "description": f"{title} zum Ausleihen",
+            "category": "power_tools",
+            "price_per_day": price_per_day,
+            "location": "Wien",
+            **fields,
+        })
+        assert response.status_code == 200, response.text
+        return response.json()
+    return create
@@ -0,0 +1,80 @@
+"""Token signing keys and revocations shared between processes."""
+import asyncio
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from auth import DEFAULT_KID, InvalidToken, KeyRing, RevocationList, TokenService
+
+USER = {"id": "olga", "name": "Olga"}
+
+
+def service(keys, active_kid, revocations=None):
+    return TokenService(KeyRing(keys, active_kid), revocations or RevocationList(None, enabled=False))
+
+
+def test_tokens_survive_key_rotation():
+    old = service({"k1": b"first"}, "k1")
+    token = old.issue(USER)
+
+    rotated = service({"k1": b"first", "k2": b"second"}, "k2")
+    assert rotated.verify(token)["sub"] == "olga"
+    assert jwt.get_unverified_header(rotated.issue(USER))["kid"] == "k2"
+
+    # Once the old key is removed, its tokens stop verifying
+    retired = service({"k2": b"second"}, "k2")
+    with pytest.raises(InvalidToken):
+        retired.verify(token)
+
+
+def test_tokens_without_kid_use_the_default_key():
+    legacy = jwt.encode({"sub": "olga", "exp": datetime.utcnow() + timedelta(hours=1)}, "secret", algorithm="HS256")
+    assert service({DEFAULT_KID: b"secret"}, DEFAULT_KID).verify(legacy)["sub"] == "olga"
+    with pytest.raises(InvalidToken):
+        service({"k2": b"secret"}, "k2").verify(legacy)
+
+
+def test_active_kid_must_be_configured():
+    with pytest.raises(ValueError):
+        KeyRing({"k1": b"first"}, "k2")
+
+
+def test_revocations_reach_other_instances_out_of_timestamp_order():
+    db = AsyncMongoMockClient()["toala_test"]
+    writer, reader = RevocationList(db), RevocationList(db)
+    tokens = service({"k1": b"first"}, "k1", reader)
+    late, early = tokens.issue(USER), tokens.issue(USER)
+
+    async def scenario():
+        await writer.revoke_token(jwt.decode(late, options={"verify_signature": False}))
+        await reader.refresh()
+        # Another worker, whose clock is a little behind, records a logout afterwards
+        claims = jwt.decode(early, options={"verify_signature": False})
+        await db.token_revocations.insert_one({
+            "jti": claims["jti"], "expires_at": datetime.utcfromtimestamp(claims["exp"]),
+            "created_at": datetime.utcnow() - timedelta(seconds=5),
+        })
+        await reader.refresh()
+
+    asyncio.run(scenario())
+    for token in (late, early):
+        with pytest.raises(InvalidToken):
+            tokens.verify(token)
+
+
+def test_revoking_a_user_invalidates_older_token_versions():
+    db = AsyncMongoMockClient()["toala_test"]
+    writer, reader = RevocationList(db), RevocationList(db)
+    tokens = service({"k1": b"first"}, "k1", reader)
+    token = tokens.issue(USER)
+
+    async def scenario():
+        await writer.revoke_user("olga", 1, datetime.utcnow() + timedelta(hours=1))
+        await reader.refresh()
+
+    asyncio.run(scenario())
+    with pytest.raises(InvalidToken):
+        tokens.verify(token)
+    assert tokens.verify(tokens.issue(dict(USER, token_version=1)))["sub"] == "olga"
@@ -0,0 +1,90 @@
+"""Bulk equipment import and export, and the line parsers behind them."""
+import asyncio
+import json
+
+from streaming import iter_csv_rows, iter_lines, iter_ndjson_rows
+
+
+async def chunked(data: bytes, size: int = 7):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def collect(rows):
+    async def gather():
+        return [row async for row in rows]
+    return asyncio.run(gather())
+
+
+def test_bad_lines_are_errors_not_exceptions():
+    data = b'short\n' + b"x" * 50 + b'\n\xff\xfe\nlast\r\n'
+    lines = collect(iter_lines(chunked(data), max_line_bytes=20))
+    assert lines == [
+        ("short", None),
+        (None, "Line is longer than 20 bytes"),
+        (None, "Line is not valid UTF-8 (byte 0)"),
+        ("last", None),
+    ]
+
+
+def test_over_long_final_line_is_reported():
+    assert collect(iter_lines(chunked(b"ok\n" + b"x" * 50), max_line_bytes=20)) == [
+        ("ok", None), (None, "Line is longer than 20 bytes"),
+    ]
+
+
+def test_ndjson_rows_keep_line_numbers_around_bad_lines():
+    data = b'{"a": 1}\n\xff\n\n[1]\n{"b": 2}\n'
+    assert collect(iter_ndjson_rows(chunked(data))) == [
+        (1, {"a": 1}, None),
+        (2, None, "Line is not valid UTF-8 (byte 0)"),
+        (4, None, "Each line must be a JSON object"),
+        (5, {"b": 2}, None),
+    ]
+
+
+def test_csv_quoted_values_may_span_lines():
+    data = b'title,description,images\r\nBohrer,"Zwei\r\nZeilen, mit ""Zitat""",a.jpg|b.jpg\r\nSaege,,\r\n'
+    assert collect(iter_csv_rows(chunked(data), list_fields=["images"])) == [
+        (2, {"title": "Bohrer", "description": 'Zwei\nZeilen, mit "Zitat"', "images": ["a.jpg", "b.jpg"]}, None),
+        (4, {"title": "Saege"}, None),
+    ]
+
+
+def test_csv_errors_are_per_row():
+    data = b'title,price_per_day\nBohrer\nSaege,5" lang\nHammer,"offen\n'
+    assert collect(iter_csv_rows(chunked(data))) == [
+        (2, None, "Expected 2 columns, got 1"),
+        (3, {"title": "Saege", "price_per_day": '5" lang'}, None),
+        (4, None, "Invalid CSV: quoted value is not closed"),
+    ]
+
+
+def test_csv_export_can_be_imported_again(client, register, create_equipment):
+    owner, _ = register("Olga")
+    create_equipment(owner, title="Bohrer", description="Erste Zeile\nZweite, mit Komma")
+    create_equipment(owner, title="Saege", price_per_day=7.5)
+
+    exported = client.get("/api/equipment/export?format=csv", headers=owner)
+    assert exported.status_code == 200
+    imported = client.post("/api/equipment/bulk", headers={**owner, "Content-Type": "text/csv"},
+                           content=exported.content)
+
+    assert imported.json() == {"inserted": 2, "failed": 0, "errors": []}
+    listings = client.get("/api/my-equipment", headers=owner).json()
+    assert sorted(item["description"] for item in listings).count("Erste Zeile\nZweite, mit Komma") == 2
+
+
+def test_ndjson_import_reports_bad_rows_and_keeps_going(client, register):
+    owner, _ = register("Olga")
+    good = {"title": "Bohrer", "description": "Akku", "category": "power_tools", "price_per_day": 10,
+            "location": "Wien"}
+    body = b"\n".join([json.dumps(good).encode(), b"\xff\xfe", b'{"title": "ohne Rest"}', json.dumps(good).encode()])
+
+    response = client.post("/api/equipment/bulk", headers=owner, content=body)
+
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["inserted"], result["failed"]) == (2, 2)
+    assert [error["line"] for error in result["errors"]] == [2, 3]
+    assert "UTF-8" in result["errors"][0]["error"]
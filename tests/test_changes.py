@@ -0,0 +1,121 @@
+"""Change events from change streams and polling, and how hooks match them."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from changes import DELETE, INSERT, UPDATE, ChangeEvent, ChangeFeed, ChangeHooks, event_from_change
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_update_event_lists_top_level_fields():
+    at = datetime(2026, 5, 1, 12)
+    event = event_from_change({
+        "operationType": "update",
+        "ns": {"db": "toala", "coll": "equipment"},
+        "documentKey": {"_id": "mongo-id"},
+        "fullDocument": {"id": "drill", "title": "Bohrer"},
+        "updateDescription": {"updatedFields": {"title": "Bohrer", "image_sources.abc": {}},
+                              "removedFields": ["deleted_at"]},
+        "wallTime": at,
+    })
+    assert (event.collection, event.operation, event.document_id, event.at) == ("equipment", UPDATE, "drill", at)
+    assert event.fields == frozenset(["title", "image_sources", "deleted_at"])
+
+
+def test_insert_and_replace_events():
+    insert = event_from_change({"operationType": "insert", "ns": {"coll": "equipment"}, "documentKey": {"_id": 1},
+                                "fullDocument": {"id": "drill"}})
+    replace = event_from_change({"operationType": "replace", "ns": {"coll": "equipment"}, "documentKey": {"_id": 1},
+                                 "fullDocument": {"id": "drill"}})
+    assert (insert.operation, insert.fields, insert.document) == (INSERT, None, {"id": "drill"})
+    # A replaced document may differ in any field
+    assert (replace.operation, replace.fields) == (UPDATE, None)
+
+
+def test_delete_event_identifies_the_document_as_well_as_it_can():
+    change = {"operationType": "delete", "ns": {"coll": "equipment"}, "documentKey": {"_id": "mongo-id"}}
+    assert event_from_change(change).document_id == "mongo-id"
+    event = event_from_change({**change, "fullDocumentBeforeChange": {"id": "drill"}})
+    assert (event.operation, event.document_id, event.document) == (DELETE, "drill", None)
+
+
+def test_untracked_operations_are_ignored():
+    assert event_from_change({"operationType": "invalidate"}) is None
+    assert event_from_change({"operationType": "drop", "ns": {"coll": "equipment"}}) is None
+
+
+def test_unknown_fields_match_only_subscribers_that_accept_them():
+    hooks, seen = ChangeHooks(), []
+
+    @hooks.subscribe("equipment", operations=[UPDATE], fields=["title"], unknown_fields=False)
+    async def strict(event):
+        seen.append(("strict", event.document_id))
+
+    @hooks.subscribe("equipment", operations=[UPDATE], fields=["deleted_at"])
+    async def lenient(event):
+        seen.append(("lenient", event.document_id))
+
+    run(hooks.dispatch([
+        ChangeEvent("equipment", UPDATE, "edited", frozenset(["title"])),
+        ChangeEvent("equipment", UPDATE, "polled"),
+        ChangeEvent("equipment", UPDATE, "priced", frozenset(["price_per_day"])),
+    ]))
+    assert seen == [("strict", "edited"), ("lenient", "polled")]
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["toala_test"]
+
+
+def feed(db, events, **options):
+    hooks = ChangeHooks(local=False)
+
+    @hooks.subscribe("equipment", batch=True)
+    async def record(batch):
+        events.append([(event.operation, event.document_id) for event in batch])
+
+    return ChangeFeed(db, hooks, ["equipment"], batch_size=2, settle_seconds=0, **options)
+
+
+def test_polling_dispatches_in_batches_and_checkpoints(db):
+    start = (datetime.utcnow() - timedelta(minutes=10)).replace(microsecond=0)
+    run(db.change_feed_state.insert_one({"_id": "changes:poll:equipment", "at": start, "last_id": ""}))
+    run(db.equipment.insert_many([
+        # Created before the checkpoint and edited since: an update
+        {"id": "a", "created_at": start - timedelta(days=1), "updated_at": start + timedelta(minutes=1)},
+        {"id": "b", "created_at": start + timedelta(minutes=2), "updated_at": start + timedelta(minutes=2)},
+        {"id": "c", "created_at": start + timedelta(minutes=2), "updated_at": start + timedelta(minutes=2)},
+        # Not changed since the checkpoint
+        {"id": "d", "created_at": start - timedelta(days=1), "updated_at": start - timedelta(minutes=1)},
+    ]))
+    events = []
+    change_feed = feed(db, events)
+
+    assert run(change_feed._poll_collection("equipment")) is True
+    assert events == [[(UPDATE, "a"), (INSERT, "b")], [(INSERT, "c")]]
+    state = run(db.change_feed_state.find_one({"_id": "changes:poll:equipment"}))
+    assert (state["at"], state["last_id"]) == (start + timedelta(minutes=2), "c")
+
+    # Nothing new: nothing dispatched again
+    assert run(change_feed._poll_collection("equipment")) is True
+    assert len(events) == 2
+    assert change_feed.dispatched == 3
+
+
+def test_polling_stops_when_the_lease_is_taken(db):
+    start = (datetime.utcnow() - timedelta(minutes=10)).replace(microsecond=0)
+    run(db.change_feed_state.insert_many([
+        {"_id": "changes:poll:equipment", "at": start, "last_id": ""},
+        {"_id": "changes:lease", "owner": "other:1", "expires_at": datetime.utcnow() + timedelta(seconds=30)},
+    ]))
+    run(db.equipment.insert_one({"id": "a", "updated_at": start + timedelta(minutes=1)}))
+    events = []
+
+    assert run(feed(db, events)._poll_collection("equipment")) is False
+    assert events == []
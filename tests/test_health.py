@@ -0,0 +1,121 @@
+"""Liveness and readiness probes."""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from health import LoopLagMonitor, ReadinessProbe, prometheus_text
+
+
+class FakeAdmin:
+    def __init__(self):
+        self.fail = False
+
+    async def command(self, name):
+        if self.fail:
+            raise ConnectionError("no primary")
+        return {"ok": 1}
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.client = SimpleNamespace(admin=FakeAdmin())
+        self.pool = {"in_use": 1, "waiting": 0, "open": 2, "max_pool_size": 10, "saturation": 0.1}
+
+    def pool_stats(self):
+        return dict(self.pool)
+
+
+class FakeRepositories:
+    def __init__(self):
+        self.missing = []
+
+    async def missing_indexes(self):
+        return list(self.missing)
+
+
+def probe(**options):
+    db, repositories, monitor = FakeDatabase(), FakeRepositories(), LoopLagMonitor()
+    return ReadinessProbe(db, repositories, monitor, **options), db, repositories, monitor
+
+
+def checks(probe, times=1):
+    async def run():
+        return [await probe.check() for _ in range(times)]
+    return asyncio.run(run())
+
+
+def test_healthy_worker_is_ready():
+    readiness, *_ = probe()
+    [(ready, result)] = checks(readiness)
+    assert ready
+    assert result["mongo"]["ok"] and result["indexes"] == {"ok": True, "missing": []}
+    assert result["window"] == {"ok": True, "failed": 0, "of": 1}
+
+
+def test_a_single_failed_ping_does_not_flap_readiness():
+    readiness, db, *_ = probe(window=3)
+    checks(readiness, times=2)
+    db.client.admin.fail = True
+
+    [(first, result), (second, _)] = checks(readiness, times=2)
+
+    assert first is True and not result["mongo"]["ok"]
+    assert second is False
+    db.client.admin.fail = False
+    assert [ready for ready, _ in checks(readiness, times=2)] == [False, True]
+
+
+def test_unready_from_the_first_check_when_nothing_passed_yet():
+    readiness, _, repositories, _ = probe()
+    repositories.missing = ["equipment.owner_id_1"]
+    [(ready, result)] = checks(readiness)
+    assert ready is False
+    assert result["indexes"] == {"ok": False, "missing": ["equipment.owner_id_1"]}
+
+
+def test_saturated_pool_with_queued_operations_fails():
+    readiness, db, *_ = probe(window=1)
+    db.pool.update(in_use=10, saturation=1.0)
+    assert checks(readiness)[0][0] is True
+    db.pool["waiting"] = 4
+    assert checks(readiness)[0][0] is False
+
+
+def test_loop_lag_is_judged_on_the_median_of_recent_samples():
+    readiness, _, _, monitor = probe(use_mongo=False, window=1, lag_samples=5, max_loop_lag=0.5)
+    for lag in (0.01, 0.02, 2.0, 0.01, 0.03):
+        monitor._recent.append(lag)
+    [(ready, result)] = checks(readiness)
+    assert ready and result["event_loop"]["lag_ms"] == 20.0
+
+    for lag in (1.0, 1.2, 0.9):
+        monitor._recent.append(lag)
+    assert checks(readiness)[0][0] is False
+
+
+def test_lag_monitor_measures_a_blocked_loop():
+    monitor = LoopLagMonitor(interval=0.01, block_threshold=0.05)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.03)
+        time.sleep(0.1)
+        await asyncio.sleep(0.03)
+        await monitor.stop()
+
+    asyncio.run(run())
+    assert monitor.blocked >= 1
+    assert monitor.stats()["max_lag_seconds"] >= 0.05
+
+
+def test_prometheus_text_declares_each_metric_once():
+    text = prometheus_text([
+        ("lag", "gauge", {"quantile": "0.5"}, 0.1),
+        ("lag", "gauge", {"quantile": "0.99"}, 0.3),
+        ("blocked", "counter", {}, 2),
+    ])
+    assert text == '# TYPE lag gauge\nlag{quantile="0.5"} 0.1\nlag{quantile="0.99"} 0.3\n# TYPE blocked counter\nblocked 2\n'
+
+
+def test_liveness_route(client):
+    assert client.get("/healthz").json() == {"status": "ok"}
@@ -0,0 +1,162 @@
+"""Idempotency-Key middleware and stores."""
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from idempotency import (
+    IdempotencyInProgress, IdempotencyMiddleware, IdempotencyStore, MongoIdempotencyStore, request_fingerprint,
+)
+
+PATH = "/api/requests"
+
+
+class CountingApp:
+    """Creates a numbered resource per call, optionally slowly, and records what it received."""
+
+    def __init__(self, delay: float = 0, status: int = 200):
+        self.calls = 0
+        self.delay = delay
+        self.status = status
+        self.received = []
+
+    async def __call__(self, scope, receive, send):
+        self.calls += 1
+        number = self.calls
+        self.received.append(await receive())
+        await asyncio.sleep(self.delay)
+        body = json.dumps({"id": number}).encode()
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": [(b"content-type", b"application/json"), (b"x-request", b"internal")]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def request(body=b'{"n": 1}', key="key-1", token="olga-token"):
+    scope = {"type": "http", "method": "POST", "path": PATH,
+             "headers": [(b"idempotency-key", key.encode()), (b"authorization", f"Bearer {token}".encode())]}
+    messages = [{"type": "http.request", "body": body[:4], "more_body": True},
+                {"type": "http.request", "body": body[4:], "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+    return scope, receive
+
+
+async def call(middleware, body=b'{"n": 1}', key="key-1"):
+    scope, receive = request(body, key)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware(scope, receive, send)
+    headers = dict(sent[0]["headers"])
+    return sent[0]["status"], headers, json.loads(b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+def middleware(app, store=None):
+    return IdempotencyMiddleware(app, store or IdempotencyStore(), identify={"olga-token": "olga"}.get, paths=[PATH])
+
+
+def test_repeated_key_replays_the_first_response():
+    app = CountingApp()
+    guarded = middleware(app)
+
+    async def scenario():
+        return await call(guarded), await call(guarded)
+
+    (status, headers, body), (replay_status, replay_headers, replay_body) = asyncio.run(scenario())
+    assert app.calls == 1
+    assert (status, body) == (replay_status, replay_body) == (200, {"id": 1})
+    assert replay_headers[b"idempotent-replayed"] == b"true"
+    assert b"x-request" not in replay_headers
+    assert app.received[0]["body"] == b'{"n": 1}'
+
+
+def test_key_reused_with_a_different_body_is_rejected():
+    app = CountingApp()
+    guarded = middleware(app)
+
+    async def scenario():
+        await call(guarded)
+        return await call(guarded, body=b'{"n": 2}')
+
+    status, _, body = asyncio.run(scenario())
+    assert status == 422
+    assert "different request" in body["detail"]
+    assert app.calls == 1
+
+
+def test_concurrent_duplicates_run_once():
+    app = CountingApp(delay=0.05)
+    guarded = middleware(app)
+
+    async def scenario():
+        return await asyncio.gather(*(call(guarded) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert app.calls == 1
+    assert [body for _, _, body in results] == [{"id": 1}] * 3
+
+
+def test_server_errors_are_not_stored():
+    app = CountingApp(status=503)
+    guarded = middleware(app)
+
+    async def scenario():
+        return await call(guarded), await call(guarded)
+
+    asyncio.run(scenario())
+    assert app.calls == 2
+
+
+def test_app_sees_disconnect_after_the_body():
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(await receive())
+        seen.append(await receive())
+        await send({"type": "http.response.start", "status": 201, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    asyncio.run(call(middleware(app)))
+    assert [message["type"] for message in seen] == ["http.request", "http.disconnect"]
+    assert seen[0]["body"] == b'{"n": 1}'
+
+
+@pytest.mark.parametrize("make_store", [
+    lambda: IdempotencyStore(lock_seconds=30),
+    lambda: MongoIdempotencyStore(AsyncMongoMockClient()["toala_test"], lock_seconds=30),
+])
+def test_stale_lock_is_taken_over(make_store):
+    store = make_store()
+    fingerprint = request_fingerprint("POST", PATH, b"{}")
+
+    async def scenario():
+        assert await store.begin("olga:key", fingerprint) is None
+        # The worker holding the lock died; once lock_seconds have passed, a retry may run again
+        stale = datetime.utcnow() - timedelta(seconds=31)
+        if isinstance(store, MongoIdempotencyStore):
+            await store.collection.update_one({"_id": "olga:key"}, {"$set": {"locked_at": stale}})
+        else:
+            store._records["olga:key"]["locked_at"] = stale
+            store._inflight.pop("olga:key")
+        return await store.begin("olga:key", fingerprint)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_fresh_lock_makes_a_duplicate_wait_then_give_up():
+    store = IdempotencyStore(wait_timeout=0.05)
+    fingerprint = request_fingerprint("POST", PATH, b"{}")
+
+    async def scenario():
+        await store.begin("olga:key", fingerprint)
+        await store.begin("olga:key", fingerprint)
+
+    with pytest.raises(IdempotencyInProgress):
+        asyncio.run(scenario())
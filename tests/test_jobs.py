@@ -0,0 +1,216 @@
+"""JobQueue claiming, retries, leases and periodic scheduling, against mongomock."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from jobs import JobQueue, JobStatus
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def queue():
+    queue = JobQueue(AsyncMongoMockClient()["toala_test"], poll_interval=0.01, backoff_base=0)
+    run(queue.ensure_indexes())
+    return queue
+
+
+def test_failed_attempts_are_retried_until_success(queue):
+    calls = []
+
+    @queue.register("flaky")
+    async def flaky(payload):
+        calls.append(payload["n"])
+        if len(calls) < 3:
+            raise RuntimeError("temporarily broken")
+        return {"ok": True}
+
+    async def scenario():
+        job_id = await queue.enqueue("flaky", {"n": 1})
+        await queue.run_until_idle()
+        return await queue.get(job_id)
+
+    job = run(scenario())
+    assert calls == [1, 1, 1]
+    assert job["status"] == JobStatus.succeeded.value
+    assert job["attempts"] == 3
+    assert job["result"] == {"ok": True}
+    assert job["last_error"] is None
+
+
+def test_job_fails_after_max_attempts(queue):
+    @queue.register("broken", max_attempts=2)
+    async def broken(payload):
+        raise ValueError("always")
+
+    async def scenario():
+        job_id = await queue.enqueue("broken")
+        await queue.run_until_idle()
+        return await queue.get(job_id)
+
+    job = run(scenario())
+    assert job["status"] == JobStatus.failed.value
+    assert job["attempts"] == 2
+    assert "always" in job["last_error"]
+
+
+def test_backoff_grows_and_is_capped():
+    queue = JobQueue(None, backoff_base=2, backoff_max=10)
+    assert [queue.backoff(attempt) for attempt in range(1, 6)] == [2, 4, 8, 10, 10]
+
+
+def test_expired_lease_is_claimed_again(queue):
+    @queue.register("work")
+    async def work(payload):
+        return "done"
+
+    async def scenario():
+        job_id = await queue.enqueue("work")
+        # A worker claimed it and died: running, with a lease that ran out
+        await queue.collection.update_one({"id": job_id}, {"$set": {
+            "status": JobStatus.running.value,
+            "attempts": 1,
+            "lease_expires_at": datetime.utcnow() - timedelta(seconds=1),
+        }})
+        await queue.run_until_idle()
+        return await queue.get(job_id)
+
+    job = run(scenario())
+    assert job["status"] == JobStatus.succeeded.value
+    assert job["attempts"] == 2
+
+
+def test_running_job_keeps_its_lease(queue):
+    queue.lease_seconds = 0.3
+    other = JobQueue(queue.db, lease_seconds=0.3)
+    started = []
+
+    @queue.register("slow")
+    async def slow(payload):
+        started.append(True)
+        await asyncio.sleep(1.0)
+        return "done"
+
+    other.register("slow")(slow)
+
+    async def scenario():
+        job_id = await queue.enqueue("slow")
+        runner = asyncio.create_task(queue.run_until_idle())
+        # Well past the original lease, the heartbeat has kept renewing it
+        await asyncio.sleep(0.7)
+        stolen = await other._claim("slow")
+        await runner
+        return stolen, await queue.get(job_id)
+
+    stolen, job = run(scenario())
+    assert stolen is None
+    assert started == [True]
+    assert job["status"] == JobStatus.succeeded.value
+    assert job["attempts"] == 1
+
+
+def test_stale_worker_cannot_overwrite_newer_attempt(queue):
+    @queue.register("work")
+    async def work(payload):
+        return "late"
+
+    async def scenario():
+        job_id = await queue.enqueue("work")
+        job = await queue._claim("work")
+        queue._running["work"] += 1
+        # Another worker took over after the lease expired, and finished first
+        await queue.collection.update_one({"id": job_id}, {"$set": {
+            "attempts": 2, "status": JobStatus.succeeded.value, "result": "newer",
+        }})
+        await queue._execute(job)
+        return await queue.get(job_id)
+
+    job = run(scenario())
+    assert job["result"] == "newer"
+    assert job["attempts"] == 2
+
+
+def test_periodic_runs_are_scheduled_once(queue):
+    @queue.register("tick", every=60)
+    async def tick(payload):
+        return None
+
+    async def scenario():
+        await queue.schedule_periodic()
+        await queue.schedule_periodic()
+        return await queue.collection.count_documents({"type": "tick"})
+
+    assert run(scenario()) == 1
+
+
+def test_enqueue_with_existing_id_is_a_no_op(queue):
+    @queue.register("work")
+    async def work(payload):
+        return None
+
+    async def scenario():
+        first = await queue.enqueue("work", {"n": 1}, job_id="work-1")
+        second = await queue.enqueue("work", {"n": 2}, job_id="work-1")
+        return first, second, await queue.collection.find({"id": "work-1"}, {"_id": 0}).to_list(None)
+
+    first, second, jobs = run(scenario())
+    assert first == second == "work-1"
+    assert [job["payload"] for job in jobs] == [{"n": 1}]
+
+
+def test_unknown_job_type_is_rejected(queue):
+    with pytest.raises(ValueError):
+        run(queue.enqueue("missing"))
+
+
+def test_cancelled_job_is_handed_back(queue):
+    @queue.register("slow")
+    async def slow(payload):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        job_id = await queue.enqueue("slow")
+        job = await queue._claim("slow")
+        queue._running["slow"] += 1
+        task = asyncio.create_task(queue._execute(job))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await queue.get(job_id)
+
+    job = run(scenario())
+    assert queue._running["slow"] == 0
+    assert job["status"] == JobStatus.queued.value
+    assert job["attempts"] == 0
+    assert job["lease_expires_at"] is None
+
+
+def test_failed_outcome_write_does_not_stop_the_worker(queue, monkeypatch, caplog):
+    done = []
+
+    @queue.register("work")
+    async def work(payload):
+        done.append(payload["n"])
+
+    async def scenario():
+        await queue.enqueue("work", {"n": 1})
+        await queue.enqueue("work", {"n": 2})
+        collection = queue.collection
+        update_one = collection.update_one
+
+        async def flaky_update_one(filter, update, **kwargs):
+            if "$inc" not in update and update["$set"].get("status") == JobStatus.succeeded.value and len(done) == 1:
+                raise RuntimeError("primary stepped down")
+            return await update_one(filter, update, **kwargs)
+
+        monkeypatch.setattr(type(collection), "update_one", lambda self, *a, **k: flaky_update_one(*a, **k))
+        await queue.run_until_idle()
+
+    run(scenario())
+    assert sorted(done) == [1, 2]
+    assert "Recording the outcome of job" in caplog.text
@@ -0,0 +1,51 @@
+"""Message recipients are the other party of the request, never a client-chosen user."""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def request_between(client, register, create_equipment):
+    owner, owner_user = register("Olga")
+    renter, renter_user = register("Rudi")
+    equipment = create_equipment(owner)
+    start = datetime.utcnow() + timedelta(days=1)
+    response = client.post("/api/requests", headers=renter, json={
+        "equipment_id": equipment["id"],
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=1)).isoformat(),
+        "message": "Hallo",
+    })
+    return owner, owner_user, renter, renter_user, response.json()
+
+
+def test_recipient_is_derived_from_the_request(client, request_between):
+    owner, owner_user, renter, renter_user, request = request_between
+
+    from_renter = client.post("/api/messages", headers=renter, json={"request_id": request["id"], "content": "Hi"})
+    from_owner = client.post("/api/messages", headers=owner, json={"request_id": request["id"], "content": "Hallo"})
+
+    assert from_renter.status_code == 200
+    assert (from_renter.json()["recipient_id"], from_renter.json()["recipient_name"]) == (owner_user["id"], "Olga")
+    assert (from_owner.json()["recipient_id"], from_owner.json()["recipient_name"]) == (renter_user["id"], "Rudi")
+
+
+def test_other_recipients_are_rejected(client, register, repos, request_between):
+    owner, owner_user, renter, renter_user, request = request_between
+    _, stranger = register("Sepp")
+
+    response = client.post("/api/messages", headers=renter, json={
+        "request_id": request["id"], "recipient_id": stranger["id"], "content": "Spam",
+    })
+
+    assert response.status_code == 400
+    assert repos.messages.by_id == {}
+
+
+def test_outsiders_cannot_message(client, register, request_between):
+    *_, request = request_between
+    stranger, _ = register("Sepp")
+
+    response = client.post("/api/messages", headers=stranger, json={"request_id": request["id"], "content": "Hi"})
+
+    assert response.status_code == 403
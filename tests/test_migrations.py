@@ -0,0 +1,132 @@
+"""Online schema migrations: checkpoints, the runner lease and throttling, against mongomock."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import migrations
+from migrations import LOCK_ID, MIGRATIONS, Migration, MigrationRunner
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class Counting:
+    """A transform that sets ``migrated`` and can be told to fail on one document."""
+
+    def __init__(self, fail_on=None):
+        self.seen = []
+        self.fail_on = fail_on
+
+    def __call__(self, document):
+        if document["n"] == self.fail_on:
+            raise RuntimeError("interrupted")
+        self.seen.append(document["n"])
+        return {"$set": {"migrated": True}}
+
+
+@pytest.fixture
+def db():
+    db = AsyncMongoMockClient()["toala_test"]
+    run(db.items.insert_many([{"_id": n, "n": n} for n in range(10)]))
+    return db
+
+
+def migration(transform, version=1):
+    return Migration(version, f"items.migrated.{version}", "items", {"migrated": {"$exists": False}}, transform)
+
+
+def runner(db, transform, **options):
+    return MigrationRunner(db, [migration(transform)], batch_size=3, throttle=0, **options)
+
+
+def test_interrupted_migration_resumes_from_its_checkpoint(db):
+    first = Counting(fail_on=7)
+    with pytest.raises(RuntimeError):
+        run(runner(db, first).run())
+    assert first.seen == [0, 1, 2, 3, 4, 5, 6]
+
+    checkpoint = run(db.schema_version.find_one({"_id": "migration:1"}))
+    assert (checkpoint["last_id"], checkpoint["migrated"]) == (5, 6)
+    assert run(db.schema_version.find_one({"_id": LOCK_ID})) is None
+
+    second = Counting()
+    [result] = run(runner(db, second).run())
+    # Only documents after the checkpoint are read again; 6 was updated but not yet checkpointed
+    assert second.seen == [6, 7, 8, 9]
+    assert result == {"version": 1, "name": "items.migrated.1", "migrated": 10}
+    assert run(db.items.count_documents({"migrated": True})) == 10
+
+
+def test_applied_migration_is_not_run_again(db):
+    transform = Counting()
+    run(runner(db, transform).run())
+    run(db.items.insert_one({"_id": 10, "n": 10}))
+
+    assert run(runner(db, transform).run()) == []
+    assert transform.seen == list(range(10))
+    assert run(runner(db, transform).current_version()) == 1
+
+
+def test_lock_held_by_another_process_skips_the_run(db):
+    run(db.schema_version.insert_one({"_id": LOCK_ID, "owner": "other:1",
+                                      "expires_at": datetime.utcnow() + timedelta(seconds=60)}))
+    transform = Counting()
+
+    assert run(runner(db, transform).run()) == []
+    assert transform.seen == []
+    assert run(db.schema_version.find_one({"_id": LOCK_ID}))["owner"] == "other:1"
+
+
+def test_expired_lock_is_taken_over(db):
+    run(db.schema_version.insert_one({"_id": LOCK_ID, "owner": "crashed:1",
+                                      "expires_at": datetime.utcnow() - timedelta(seconds=1)}))
+    transform = Counting()
+
+    [result] = run(runner(db, transform).run())
+    assert result["migrated"] == 10
+    assert run(db.schema_version.find_one({"_id": LOCK_ID})) is None
+
+
+def test_losing_the_lock_mid_run_stops_the_migration(db):
+    class Stealing(Counting):
+        def __call__(self, document):
+            if document["n"] == 1:
+                # Another runner took over after this one's lease expired
+                asyncio.get_event_loop().create_task(db.schema_version.update_one(
+                    {"_id": LOCK_ID}, {"$set": {"owner": "other:1",
+                                                "expires_at": datetime.utcnow() + timedelta(seconds=60)}}))
+            return super().__call__(document)
+
+    with pytest.raises(RuntimeError, match="Lost the migration lock"):
+        run(runner(db, Stealing()).run())
+    assert run(runner(db, Counting()).current_version()) == 0
+
+
+def test_throttle_sleeps_in_proportion_to_batch_time(db, monkeypatch):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    clock = iter(range(0, 1000, 2))
+    monkeypatch.setattr(migrations.asyncio, "sleep", sleep)
+    monkeypatch.setattr(migrations.time, "perf_counter", lambda: next(clock))
+
+    run(MigrationRunner(db, [migration(Counting())], batch_size=5, throttle=0.5).run())
+    assert sleeps == [1.0, 1.0]
+
+
+def test_status_lists_pending_migrations_with_progress(db):
+    runner_ = MigrationRunner(db, [migration(Counting(), 1), migration(Counting(), 2)], batch_size=3, throttle=0)
+    run(runner_.run(target=1))
+    status = run(runner_.status())
+    assert status["version"] == 1 and status["latest"] == 2
+    assert [pending["version"] for pending in status["pending"]] == [2]
+
+
+def test_shipped_migrations_have_increasing_versions():
+    versions = [migration.version for migration in MIGRATIONS]
+    assert versions == sorted(set(versions))
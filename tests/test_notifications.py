@@ -0,0 +1,81 @@
+"""Notification digests, against mongomock."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from jobs import JobQueue
+from notifications import SEND_DIGEST_JOB, Notifier
+
+
+class Outbox:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, recipient, subject, body):
+        self.sent.append((recipient["id"], subject))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def notifier():
+    db = AsyncMongoMockClient()["toala_test"]
+    notifier = Notifier(db, JobQueue(db, backoff_base=0), Outbox(), digest_window=60, sends_per_second=0)
+
+    async def setup():
+        await notifier.ensure_indexes()
+        await notifier.job_queue.ensure_indexes()
+        await db.users.insert_one({"id": "olga", "email": "olga@example.com", "name": "Olga"})
+
+    run(setup())
+    return notifier
+
+
+def age_events(notifier, seconds):
+    return notifier.events.update_many({}, {"$set": {"created_at": datetime.utcnow() - timedelta(seconds=seconds)}})
+
+
+def test_events_expire_after_the_retention_period(notifier):
+    notifier.notify("olga", "request", "Neue Anfrage")
+    run(notifier.flush())
+
+    event = run(notifier.events.find_one({}))
+    assert event["expires_at"] - event["created_at"] == timedelta(days=30)
+    indexes = run(notifier.events.index_information())
+    assert any(index.get("expireAfterSeconds") == 0 and index["key"] == [("expires_at", 1)]
+               for index in indexes.values())
+
+
+def test_claimed_events_are_sent_even_if_queueing_failed(notifier, monkeypatch):
+    queue = notifier.job_queue
+    enqueue = queue.enqueue
+
+    async def broken_enqueue(*args, **kwargs):
+        raise RuntimeError("queue unavailable")
+
+    async def scenario():
+        notifier.notify("olga", "request", "Neue Anfrage")
+        notifier.notify("olga", "message", "Neue Nachricht")
+        await notifier.flush()
+        await age_events(notifier, 120)
+
+        monkeypatch.setattr(queue, "enqueue", broken_enqueue)
+        assert await notifier.schedule_digests() == 1
+        await queue.run_until_idle()
+        assert notifier.transport.sent == []
+
+        # A later pass, once the claim is older than the digest window, queues the digest again
+        monkeypatch.setattr(queue, "enqueue", enqueue)
+        await notifier.events.update_many({}, {"$set": {"claimed_at": datetime.utcnow() - timedelta(seconds=120)}})
+        await notifier.schedule_digests()
+        await notifier.schedule_digests()
+        await queue.run_until_idle()
+        return await queue.collection.count_documents({"type": SEND_DIGEST_JOB})
+
+    assert run(scenario()) == 1
+    assert notifier.transport.sent == [("olga", "You have 2 new updates on Toala")]
+    assert run(notifier.events.count_documents({"sent_at": None})) == 0
@@ -0,0 +1,118 @@
+"""Embedded user names: propagation on rename and the verify/repair job, against mongomock."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from owners import VERIFY_STATE_ID, OwnerNames
+from repositories import MotorRepositories
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def db():
+    db = AsyncMongoMockClient()["toala_test"]
+    long_ago = datetime.utcnow() - timedelta(days=30)
+    run(db.users.insert_many([
+        {"id": "anna", "name": "Anna"},
+        {"id": "ben", "name": "Ben"},
+    ]))
+    run(db.equipment.insert_many([
+        {"id": "drill", "owner_id": "anna", "owner_name": "Anna", "updated_at": long_ago},
+        {"id": "saw", "owner_id": "anna", "owner_name": "Anna", "updated_at": long_ago},
+        {"id": "ladder", "owner_id": "ben", "owner_name": "Ben", "updated_at": long_ago},
+    ]))
+    run(db.rental_requests.insert_many([
+        {"id": "r1", "owner_id": "anna", "owner_name": "Anna", "requester_id": "ben", "requester_name": "Ben",
+         "updated_at": long_ago},
+    ]))
+    return db
+
+
+@pytest.fixture
+def owner_names(db):
+    return OwnerNames(db, MotorRepositories(db))
+
+
+def names(db, collection, field):
+    return {document["id"]: document.get(field) for document in run(db[collection].find({}).to_list(None))}
+
+
+def rename(db, user_id, name, at=None):
+    run(db.users.update_one({"id": user_id}, {"$set": {"name": name, "name_updated_at": at or datetime.utcnow()}}))
+
+
+def test_propagate_rewrites_every_embedded_copy(db, owner_names):
+    rename(db, "anna", "Anna K.")
+    rename(db, "ben", "Benjamin")
+
+    assert run(owner_names.propagate("anna")) == {"equipment": 2, "rental_requests": 1}
+    assert run(owner_names.propagate("ben")) == {"equipment": 1, "rental_requests": 1}
+    # Repeated syncs are no-ops
+    assert run(owner_names.propagate("anna")) == {"equipment": 0, "rental_requests": 0}
+
+    assert names(db, "equipment", "owner_name") == {"drill": "Anna K.", "saw": "Anna K.", "ladder": "Benjamin"}
+    assert names(db, "rental_requests", "owner_name") == {"r1": "Anna K."}
+    assert names(db, "rental_requests", "requester_name") == {"r1": "Benjamin"}
+
+
+def test_propagate_ignores_unknown_users(owner_names):
+    assert run(owner_names.propagate("nobody")) == {"equipment": 0, "rental_requests": 0}
+
+
+def test_verify_reports_drift_and_orphans_and_repairs(db, owner_names):
+    rename(db, "anna", "Anna K.")
+    run(db.equipment.insert_one({"id": "gone", "owner_id": "deleted", "owner_name": "Old",
+                                 "updated_at": datetime.utcnow()}))
+
+    report = run(owner_names.verify())
+    assert report["since"] is None
+    assert report["equipment.owner_name"] == {"documents": 2, "users": 1, "orphaned": 1}
+    assert report["rental_requests.owner_name"] == {"documents": 1, "users": 1, "orphaned": 0}
+    assert report["rental_requests.requester_name"] == {"documents": 0, "users": 0, "orphaned": 0}
+    assert report["repaired_users"] == 0
+    assert names(db, "equipment", "owner_name")["drill"] == "Anna"
+
+    report = run(owner_names.verify(repair=True, full=True))
+    assert report["repaired_users"] == 1
+    assert names(db, "equipment", "owner_name") == {"drill": "Anna K.", "saw": "Anna K.", "ladder": "Ben",
+                                                    "gone": "Old"}
+
+
+def test_verify_only_checks_what_changed_since_the_last_run(db, owner_names):
+    run(owner_names.verify())
+    checked_at = run(db.owner_names_state.find_one({"_id": VERIFY_STATE_ID}))["checked_at"]
+    # Move the previous run well into the past, beyond the overlap window
+    earlier = checked_at - timedelta(days=1)
+    run(db.owner_names_state.update_one({"_id": VERIFY_STATE_ID}, {"$set": {"checked_at": earlier}}))
+
+    # Drift from before the last run is not looked at again
+    run(db.users.update_one({"id": "ben"}, {"$set": {"name": "Benjamin"}}))
+    # A rename whose sync job never ran, and a listing written with a stale name
+    rename(db, "anna", "Anna K.")
+    run(db.equipment.insert_one({"id": "hammer", "owner_id": "ben", "owner_name": "Ben",
+                                 "updated_at": datetime.utcnow()}))
+
+    report = run(owner_names.verify(repair=True))
+    assert report["since"] == earlier - timedelta(seconds=owner_names.overlap)
+    assert report["equipment.owner_name"] == {"documents": 3, "users": 2, "orphaned": 0}
+    assert report["rental_requests.owner_name"]["documents"] == 1
+    assert report["rental_requests.requester_name"]["documents"] == 0
+    assert names(db, "equipment", "owner_name")["drill"] == "Anna K."
+    assert names(db, "rental_requests", "requester_name") == {"r1": "Benjamin"}
+
+    later = run(db.owner_names_state.find_one({"_id": VERIFY_STATE_ID}))["checked_at"]
+    assert later > earlier
+
+
+def test_rename_is_timestamped_for_verify(client, repos, register):
+    headers, user = register("Anna")
+    assert "name_updated_at" not in run(repos.users.get(user["id"]))
+
+    response = client.patch("/api/auth/me", headers=headers, json={"name": "Anna K."})
+    assert response.status_code == 200, response.text
+    assert run(repos.users.get(user["id"]))["name_updated_at"] is not None
@@ -0,0 +1,85 @@
+"""Rental prices, discounts, deposits and rental-period rules."""
+from datetime import datetime
+
+import pytest
+
+from pricing import price_quotes
+
+DRILL = {"price_per_day": 10.0, "weekly_discount": 0.1, "monthly_discount": 0.25, "min_rental_days": 1}
+
+
+def quote(start, end, **fields):
+    return price_quotes([({**DRILL, **fields}, start, end)])[0]
+
+
+def test_same_day_rental_is_one_day():
+    result = quote(datetime(2026, 5, 4, 9), datetime(2026, 5, 4, 17))
+    assert (result["days"], result["total"], result["valid"]) == (1, 10.0, True)
+
+
+@pytest.mark.parametrize("start, end, days", [
+    # Days are calendar dates, so an overnight rental shorter than 24 hours spans two
+    (datetime(2026, 5, 4, 18), datetime(2026, 5, 5, 10), 2),
+    (datetime(2026, 5, 4, 23, 59), datetime(2026, 5, 5, 0, 1), 2),
+    (datetime(2026, 5, 4, 0, 0), datetime(2026, 5, 5, 23, 59), 2),
+    (datetime(2026, 5, 4, 10), datetime(2026, 5, 6, 10), 3),
+])
+def test_days_count_calendar_dates(start, end, days):
+    assert quote(start, end)["days"] == days
+
+
+def test_end_before_start_is_invalid():
+    result = quote(datetime(2026, 5, 5), datetime(2026, 5, 4))
+    assert result["valid"] is False
+    assert result["error"] == "end_date must not be before start_date"
+
+
+def test_minimum_and_maximum_rental_days():
+    start = datetime(2026, 5, 4)
+    assert quote(start, datetime(2026, 5, 5), min_rental_days=3)["error"] == \
+        "Rental is shorter than the minimum rental period"
+    assert quote(start, datetime(2026, 5, 6), min_rental_days=3)["valid"]
+    assert quote(start, datetime(2026, 5, 9), max_rental_days=5)["error"] == \
+        "Rental is longer than the maximum rental period"
+    assert quote(start, datetime(2026, 5, 8), max_rental_days=5)["valid"]
+
+
+@pytest.mark.parametrize("last_day, days, rate, total", [
+    (datetime(2026, 5, 9), 6, 0.0, 60.0),
+    (datetime(2026, 5, 10), 7, 0.1, 63.0),
+    (datetime(2026, 6, 1), 29, 0.1, 261.0),
+    (datetime(2026, 6, 2), 30, 0.25, 225.0),
+])
+def test_weekly_and_monthly_discounts(last_day, days, rate, total):
+    result = quote(datetime(2026, 5, 4), last_day)
+    assert (result["days"], result["discount_rate"], result["total"]) == (days, rate, total)
+    assert result["subtotal"] - result["discount"] == pytest.approx(total)
+
+
+def test_deposit_is_the_larger_of_fixed_and_rate():
+    start, end = datetime(2026, 5, 4), datetime(2026, 5, 5)
+    assert quote(start, end, deposit=50, deposit_rate=0.5)["deposit"] == 50.0
+    assert quote(start, end, deposit=5, deposit_rate=0.5)["deposit"] == 10.0
+
+
+def test_missing_and_unavailable_equipment():
+    start, end = datetime(2026, 5, 4), datetime(2026, 5, 5)
+    missing, unavailable = price_quotes([(None, start, end), ({**DRILL, "is_available": False}, start, end)])
+    assert missing["error"] == "Equipment not found"
+    assert unavailable["error"] == "Equipment is not available"
+
+
+def test_request_total_uses_the_quote(client, register, create_equipment):
+    owner, _ = register("Olga")
+    renter, _ = register("Rudi")
+    equipment = create_equipment(owner, price_per_day=12.5)
+
+    response = client.post("/api/requests", headers=renter, json={
+        "equipment_id": equipment["id"],
+        "start_date": "2030-05-04T18:00:00",
+        "end_date": "2030-05-05T10:00:00",
+        "message": "Über Nacht",
+    })
+
+    assert response.status_code == 200
+    assert response.json()["total_price"] == 25.0
@@ -0,0 +1,142 @@
+"""Repository calls per route, counted by the in-memory backend's QueryLog.
+
+Each route should cost a fixed number of queries however many documents it
+returns; a count that grows with the data is an N+1 regression.
+"""
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def queries_for(client, repos, method, path, **kwargs):
+    repos.queries.reset()
+    response = client.request(method, path, **kwargs)
+    assert response.status_code == 200, response.text
+    return Counter(repos.queries.counts)
+
+
+@pytest.fixture
+def rental(client, register, create_equipment):
+    """An owner with one listing and a renter with a pending request for it."""
+    owner, owner_user = register("Olga")
+    renter, renter_user = register("Rudi")
+    equipment = create_equipment(owner)
+    start = datetime.utcnow() + timedelta(days=1)
+    response = client.post("/api/requests", headers=renter, json={
+        "equipment_id": equipment["id"],
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=2)).isoformat(),
+        "message": "Brauche ich am Wochenende",
+    })
+    assert response.status_code == 200, response.text
+    return {"owner": owner, "renter": renter, "owner_user": owner_user, "renter_user": renter_user,
+            "equipment": equipment, "request": response.json()}
+
+
+def test_browse_is_one_search(client, repos, register, create_equipment):
+    owner, _ = register("Olga")
+    for index in range(5):
+        create_equipment(owner, title=f"Geraet {index}")
+
+    assert queries_for(client, repos, "GET", "/api/equipment") == Counter({"equipment.search": 1})
+
+
+def test_detail_is_one_get(client, repos, rental):
+    path = f"/api/equipment/{rental['equipment']['id']}"
+    assert queries_for(client, repos, "GET", path) == Counter({"equipment.get": 1})
+
+
+def test_create_request(client, repos, register, create_equipment):
+    owner, _ = register("Olga")
+    renter, _ = register("Rudi")
+    equipment = create_equipment(owner)
+    start = datetime.utcnow() + timedelta(days=1)
+
+    counts = queries_for(client, repos, "POST", "/api/requests", headers=renter, json={
+        "equipment_id": equipment["id"],
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=1)).isoformat(),
+        "message": "Hallo",
+    })
+
+    # Names are embedded in the listing, so no user lookup
+    assert counts == Counter({"equipment.get": 1, "rental_requests.insert": 1})
+
+
+def test_request_lists(client, repos, rental):
+    assert queries_for(client, repos, "GET", "/api/requests/received", headers=rental["owner"]) == Counter({
+        "rental_requests.iter_for_owner": 1, "equipment.titles": 1,
+    })
+    assert queries_for(client, repos, "GET", "/api/requests/sent", headers=rental["renter"]) == Counter({
+        "rental_requests.iter_for_requester": 1, "equipment.titles": 1,
+    })
+
+
+def test_status_change_is_one_conditional_update(client, repos, rental):
+    path = f"/api/requests/{rental['request']['id']}/status?status=approved"
+    counts = queries_for(client, repos, "PUT", path, headers=rental["owner"])
+    assert counts == Counter({"rental_requests.transition": 1})
+
+
+def test_messages(client, repos, rental):
+    request = rental["request"]
+    counts = queries_for(client, repos, "POST", "/api/messages", headers=rental["renter"], json={
+        "recipient_id": request["owner_id"], "request_id": request["id"], "content": "Passt Samstag?",
+    })
+    # The recipient's name comes from the request's embedded names
+    assert counts == Counter({"rental_requests.get": 1, "messages.insert": 1})
+
+    counts = queries_for(client, repos, "GET", f"/api/messages/{request['id']}", headers=rental["owner"])
+    assert counts == Counter({"rental_requests.get": 1, "messages.iter_for_request": 1, "users.names": 1})
+
+
+def test_token_auth_needs_no_user_lookup(client, repos, rental):
+    counts = queries_for(client, repos, "GET", "/api/my-equipment", headers=rental["owner"])
+    assert counts == Counter({"equipment.iter_by_owner": 1})
+
+
+@pytest.mark.parametrize("listings", [1, 20])
+def test_request_list_cost_does_not_grow_with_results(client, repos, register, create_equipment, listings):
+    owner, _ = register("Olga")
+    renter, _ = register("Rudi")
+    start = datetime.utcnow() + timedelta(days=1)
+    for index in range(listings):
+        equipment = create_equipment(owner, title=f"Geraet {index}")
+        response = client.post("/api/requests", headers=renter, json={
+            "equipment_id": equipment["id"],
+            "start_date": start.isoformat(),
+            "end_date": (start + timedelta(days=1)).isoformat(),
+            "message": "Hallo",
+        })
+        assert response.status_code == 200
+
+    repos.queries.reset()
+    response = client.get("/api/requests/received", headers=owner)
+
+    assert len(response.json()) == listings
+    assert repos.queries.total() == 2
+
+
+def test_browse_benchmark(client, repos, register, create_equipment):
+    # A smoke benchmark: a full browse page over many listings stays one query per page and fast
+    owner, _ = register("Olga")
+    for index in range(200):
+        create_equipment(owner, title=f"Geraet {index}", price_per_day=5 + index % 50)
+
+    started = time.perf_counter()
+    for skip in range(0, 200, 20):
+        assert len(client.get(f"/api/equipment?skip={skip}&limit=20").json()) == 20
+    elapsed = time.perf_counter() - started
+
+    assert repos.queries.counts["equipment.search"] == 10
+    assert elapsed < 5
+
+
+def test_services_without_mongo_are_unavailable(client, rental):
+    headers = rental["owner"]
+    assert client.get("/api/analytics/owner", headers=headers).status_code == 503
+    assert client.post("/api/analytics/owner/rebuild", headers=headers).status_code == 503
+    assert client.get("/api/jobs/stats", headers=headers).status_code == 503
+    assert client.get("/api/jobs/unknown", headers=headers).status_code == 404
@@ -0,0 +1,91 @@
+"""Browse ranking scores and sort order."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from ranking import NEW_LISTING_SCORE, EquipmentRanker, ranking_scores
+from repositories import SEARCH_SORTS
+
+NOW = datetime(2026, 5, 4, 12)
+
+
+def listing(item_id, price=10.0, category="power_tools", created_days_ago=30, **fields):
+    return {"id": item_id, "category": category, "price_per_day": price,
+            "created_at": NOW - timedelta(days=created_days_ago), **fields}
+
+
+def stats(requests, accepted=0, declined=0, days_ago=1):
+    return {"requests": requests, "accepted": accepted, "declined": declined,
+            "last_request": NOW - timedelta(days=days_ago)}
+
+
+def ordered(scores):
+    return sorted(scores, key=lambda item_id: -scores[item_id])
+
+
+def test_popular_well_reviewed_listings_rank_first():
+    equipment = [listing("busy"), listing("quiet"), listing("declined")]
+    scores = ranking_scores(equipment, {
+        "busy": stats(20, accepted=15, declined=1),
+        "quiet": stats(2, accepted=1),
+        "declined": stats(20, accepted=1, declined=15),
+    }, NOW)
+    # Request volume weighs more than approval, but at equal volume approval decides
+    assert ordered(scores) == ["busy", "declined", "quiet"]
+    assert all(0 <= score <= 1 for score in scores.values())
+
+
+def test_recent_requests_outrank_old_ones():
+    scores = ranking_scores([listing("fresh"), listing("stale")], {
+        "fresh": stats(5, accepted=3, days_ago=1),
+        "stale": stats(5, accepted=3, days_ago=60),
+    }, NOW)
+    assert scores["fresh"] > scores["stale"]
+
+
+def test_cheaper_than_category_median_scores_higher():
+    equipment = [listing("cheap", price=5), listing("median", price=10), listing("dear", price=40),
+                 listing("other", price=1000, category="automotive")]
+    scores = ranking_scores(equipment, {}, NOW)
+    assert scores["cheap"] > scores["median"] > scores["dear"]
+
+
+def test_brand_new_listing_gets_the_new_listing_score():
+    scores = ranking_scores([listing("new", created_days_ago=0)], {}, NOW)
+    assert scores["new"] == pytest.approx(NEW_LISTING_SCORE)
+
+
+def test_refresh_skips_deleted_listings():
+    db = AsyncMongoMockClient()["toala_test"]
+    ranker = EquipmentRanker(db)
+
+    async def scenario():
+        await db.equipment.insert_many([
+            listing("live", price=10), listing("gone", price=1, deleted_at=datetime.utcnow(), score=0.3),
+        ])
+        result = await ranker.refresh()
+        return result, {item["id"]: item.get("score") async for item in db.equipment.find()}
+
+    result, scores = asyncio.run(scenario())
+    assert result["equipment"] == 1
+    assert scores["gone"] == 0.3
+    # Alone in its category now, so priced exactly at the median
+    assert scores["live"] > 0
+
+
+def test_price_sort_has_a_tiebreaker():
+    assert SEARCH_SORTS["price"][-1] == ("id", 1)
+
+
+@pytest.mark.parametrize("sort", ["price", "score"])
+def test_pages_over_equal_sort_keys_cover_every_listing_once(client, register, create_equipment, sort):
+    owner, _ = register("Olga")
+    ids = {create_equipment(owner, title=f"Geraet {index}", price_per_day=10)["id"] for index in range(25)}
+
+    pages = [client.get(f"/api/equipment?sort={sort}&skip={skip}&limit=10").json() for skip in (0, 10, 20)]
+    seen = [item["id"] for page in pages for item in page]
+
+    assert len(seen) == len(set(seen)) == 25
+    assert set(seen) == ids
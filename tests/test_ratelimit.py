@@ -0,0 +1,96 @@
+"""Token-bucket rules, proxy header trust and all-or-nothing consumption."""
+import asyncio
+
+from ratelimit import InMemoryBackend, RateLimiter, RateLimitRule
+
+
+def scope(path="/api/equipment", method="GET", peer="203.0.113.5", headers=()):
+    return {"type": "http", "method": method, "path": path, "client": (peer, 4711), "headers": list(headers)}
+
+
+def test_real_ip_header_is_ignored_by_default():
+    limiter = RateLimiter([])
+    assert limiter.client_ip(scope(headers=[(b"x-real-ip", b"198.51.100.1")])) == "203.0.113.5"
+
+
+def test_real_ip_header_is_used_only_from_trusted_proxies():
+    limiter = RateLimiter([], trusted_proxies=["172.16.0.0/12"])
+    header = [(b"x-real-ip", b"198.51.100.1")]
+    assert limiter.client_ip(scope(peer="172.18.0.3", headers=header)) == "198.51.100.1"
+    assert limiter.client_ip(scope(peer="203.0.113.5", headers=header)) == "203.0.113.5"
+
+
+def test_rotating_real_ip_does_not_escape_the_ip_bucket():
+    limiter = RateLimiter([RateLimitRule("ip", rate=0.001, burst=2)])
+
+    async def scenario():
+        return [
+            await limiter.check(scope(headers=[(b"x-real-ip", f"198.51.100.{n}".encode())]))
+            for n in range(3)
+        ]
+
+    first, second, third = asyncio.run(scenario())
+    assert first is None and second is None
+    assert third > 0
+
+
+def test_denied_request_takes_no_tokens_from_other_rules():
+    broad = RateLimitRule("ip", rate=0.001, burst=3, path_prefix="/api/")
+    narrow = RateLimitRule("login", rate=0.001, burst=1, path_prefix="/api/auth/login")
+    limiter = RateLimiter([narrow, broad])
+
+    async def scenario():
+        login = [await limiter.check(scope("/api/auth/login", "POST")) for _ in range(3)]
+        browse = [await limiter.check(scope()) for _ in range(3)]
+        return login, browse
+
+    login, browse = asyncio.run(scenario())
+    assert login[0] is None and login[1] > 0 and login[2] > 0
+    # Only the one login that went through used the shared IP budget
+    assert browse[:2] == [None, None] and browse[2] > 0
+    assert limiter.stats() == {"login": {"allowed": 1, "limited": 2}, "ip": {"allowed": 3, "limited": 1}}
+
+
+def bearer(token):
+    return [(b"authorization", f"Bearer {token}".encode())]
+
+
+def test_user_rules_key_only_on_verified_subjects():
+    tokens = {"good-token": "olga"}
+    limiter = RateLimiter([RateLimitRule("user", rate=0.001, burst=1, scope="user")], identify=tokens.get)
+
+    async def scenario():
+        return [
+            await limiter.check(scope(headers=bearer("good-token"))),
+            # Forged tokens for other subjects fall back to the caller's IP bucket
+            await limiter.check(scope(headers=bearer("forged-for-rudi"))),
+            await limiter.check(scope(headers=bearer("forged-for-rita"))),
+        ]
+
+    verified, first_forged, second_forged = asyncio.run(scenario())
+    assert verified is None and first_forged is None
+    assert second_forged > 0
+    keys = set().union(*(buckets for buckets, _ in limiter.backend._shards))
+    assert keys == {"user:user:olga", "user:ip:203.0.113.5"}
+
+
+def test_prune_uses_each_buckets_own_rule(monkeypatch):
+    backend = InMemoryBackend(shards=1, max_keys_per_shard=2)
+    clock = [1000.0]
+    monkeypatch.setattr("ratelimit.time.monotonic", lambda: clock[0])
+    login = ("login:ip:a", 10 / 60, 10)
+    fast = ("total:route", 20.0, 40)
+
+    async def scenario():
+        for _ in range(10):
+            await backend.consume_all([login, fast])
+        clock[0] += 5
+        # A third key pushes the shard over its limit; the fast bucket is full again, the login one is not
+        await backend.consume_all([("other:ip:b", 20.0, 40)])
+        return await backend.consume_all([login])
+
+    denied, retry_after = asyncio.run(scenario())
+    buckets = backend._shards[0][0]
+    assert "total:route" not in buckets
+    assert "login:ip:a" in buckets
+    assert denied == [0] and retry_after > 0
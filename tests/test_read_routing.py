@@ -0,0 +1,48 @@
+"""Read-your-writes routing must hold across worker processes."""
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from database import LAST_WRITE_COOKIE, ReadYourWritesMiddleware, RecentWrites
+
+
+def worker_app():
+    """One API worker process: its own RecentWrites, nothing shared with the others."""
+    recent_writes = RecentWrites(window_seconds=100)
+    app = FastAPI()
+
+    @app.post("/api/write")
+    async def write():
+        recent_writes.mark()
+        return {}
+
+    @app.get("/api/read")
+    async def read():
+        return {"primary": recent_writes.active()}
+
+    app.add_middleware(ReadYourWritesMiddleware, recent_writes=recent_writes)
+    return app
+
+
+def test_reads_after_a_write_stay_on_the_primary_on_another_worker():
+    first, second = TestClient(worker_app()), TestClient(worker_app())
+
+    response = first.post("/api/write")
+    assert LAST_WRITE_COOKIE in response.cookies
+    assert second.get("/api/read").json() == {"primary": False}
+
+    second.cookies.set(LAST_WRITE_COOKIE, response.cookies[LAST_WRITE_COOKIE])
+    assert second.get("/api/read").json() == {"primary": True}
+
+
+def test_last_write_header_works_without_cookies():
+    first, second = TestClient(worker_app()), TestClient(worker_app())
+
+    last_write = first.post("/api/write").headers["x-last-write"]
+
+    assert second.get("/api/read", headers={"X-Last-Write": last_write}).json() == {"primary": True}
+
+
+def test_old_writes_read_from_replicas():
+    client = TestClient(worker_app())
+    assert client.get("/api/read", headers={"X-Last-Write": "1000.0"}).json() == {"primary": False}
+    assert client.get("/api/read", headers={"X-Last-Write": "garbage"}).json() == {"primary": False}
@@ -0,0 +1,34 @@
+"""Recommendation rebuilds, against mongomock."""
+import asyncio
+from datetime import datetime
+
+from mongomock_motor import AsyncMongoMockClient
+
+from recommendations import Recommender
+
+
+def test_rebuild_leaves_out_deleted_listings():
+    recommender = Recommender(AsyncMongoMockClient()["toala_test"])
+    db = recommender.db
+
+    async def scenario():
+        await db.equipment.insert_many([
+            {"id": "drill", "title": "Akku Bohrmaschine", "description": "Bohrer", "category": "power_tools"},
+            {"id": "hammer", "title": "Bohrhammer", "description": "Bohrer", "category": "power_tools"},
+            {"id": "old", "title": "Alte Bohrmaschine", "description": "Bohrer", "category": "power_tools",
+             "deleted_at": datetime.utcnow()},
+        ])
+        await db.rental_requests.insert_many([
+            {"requester_id": renter, "equipment_id": item}
+            for renter in ("rudi", "rita") for item in ("drill", "hammer", "old")
+        ])
+        result = await recommender.rebuild()
+        return result, await recommender.get("drill"), await recommender.get("old"), await db.equipment_pairs.distinct("a")
+
+    result, drill, old, paired = asyncio.run(scenario())
+    assert result == {"equipment": 2, "pairs": 2}
+    assert [neighbor["equipment_id"] for neighbor in drill["similar"]] == ["hammer"]
+    assert [neighbor["equipment_id"] for neighbor in drill["also_rented"]] == ["hammer"]
+    assert drill["renters"] == 2
+    assert old is None
+    assert sorted(paired) == ["drill", "hammer"]
@@ -0,0 +1,123 @@
+"""Rental request creation and status changes."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def listing(register, create_equipment):
+    owner, owner_user = register("Olga")
+    renter, renter_user = register("Rudi")
+    return owner, renter, create_equipment(owner)
+
+
+def request_body(equipment):
+    start = datetime.utcnow() + timedelta(days=1)
+    return {
+        "equipment_id": equipment["id"],
+        "start_date": start.isoformat(),
+        "end_date": (start + timedelta(days=2)).isoformat(),
+        "message": "Hallo",
+    }
+
+
+def test_failed_analytics_rollup_does_not_fail_the_request(client, repos, listing, monkeypatch):
+    owner, renter, equipment = listing
+    rebuilds = []
+
+    async def broken_rollup(*args):
+        raise RuntimeError("rollup write failed")
+
+    async def enqueue(job_type, payload=None, **kwargs):
+        rebuilds.append((job_type, payload))
+        return "job"
+
+    monkeypatch.setattr(server.analytics, "record_transition", broken_rollup)
+    monkeypatch.setattr(server.job_queue, "enqueue", enqueue)
+
+    created = client.post("/api/requests", headers=renter, json=request_body(equipment))
+    assert created.status_code == 200
+    approved = client.put(f"/api/requests/{created.json()['id']}/status?status=approved", headers=owner)
+    assert approved.status_code == 200
+
+    assert len(repos.rental_requests.by_id) == 1
+    assert rebuilds == [(server.REBUILD_JOB, {"owner_id": equipment["owner_id"]})] * 2
+
+
+def change_status(client, headers, request_id, status, **params):
+    query = "&".join([f"status={status}"] + [f"{name}={value}" for name, value in params.items()])
+    return client.put(f"/api/requests/{request_id}/status?{query}", headers=headers)
+
+
+@pytest.fixture
+def pending(client, listing):
+    owner, renter, equipment = listing
+    request = client.post("/api/requests", headers=renter, json=request_body(equipment)).json()
+    return owner, renter, request
+
+
+def test_allowed_transitions_bump_the_version(client, pending):
+    owner, _, request = pending
+
+    approved = change_status(client, owner, request["id"], "approved")
+    completed = change_status(client, owner, request["id"], "completed", version=1)
+
+    assert approved.json() == {"message": "Request status updated to approved", "status": "approved", "version": 1}
+    assert completed.json() == {"message": "Request status updated to completed", "status": "completed", "version": 2}
+
+
+def test_invalid_transition_is_a_conflict(client, repos, pending):
+    owner, _, request = pending
+    change_status(client, owner, request["id"], "declined")
+
+    response = change_status(client, owner, request["id"], "approved")
+
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Cannot change status from declined to approved"
+    assert repos.rental_requests.by_id[request["id"]]["status"] == "declined"
+
+
+def test_skipping_a_state_is_a_conflict(client, pending):
+    owner, _, request = pending
+
+    response = change_status(client, owner, request["id"], "completed")
+
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Cannot change status from pending to completed"
+
+
+def test_stale_version_is_a_conflict(client, pending):
+    owner, _, request = pending
+
+    response = change_status(client, owner, request["id"], "approved", version=3)
+
+    assert response.status_code == 409
+    assert "modified by someone else" in response.json()["detail"]
+
+
+def test_only_the_owner_changes_status(client, pending):
+    _, renter, request = pending
+    assert change_status(client, renter, request["id"], "approved").status_code == 403
+    assert change_status(client, renter, "missing", "approved").status_code == 404
+
+
+def test_retried_transition_with_idempotency_key_is_replayed(client, pending):
+    owner, _, request = pending
+    headers = {**owner, "Idempotency-Key": "approve-1"}
+
+    first = change_status(client, headers, request["id"], "approved")
+    retry = change_status(client, headers, request["id"], "approved")
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == {"message": "Request status updated to approved", "status": "approved", "version": 1}
+
+
+def test_concurrent_decisions_apply_once(client, repos, pending):
+    owner, _, request = pending
+
+    results = [change_status(client, owner, request["id"], status, version=0) for status in ("approved", "declined")]
+
+    assert [response.status_code for response in results] == [200, 409]
+    assert repos.rental_requests.by_id[request["id"]]["version"] == 1
@@ -0,0 +1,97 @@
+"""Archiving finished rental requests and their messages, against mongomock."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from retention import Archiver
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+OLD = datetime.utcnow() - timedelta(days=400)
+
+
+@pytest.fixture
+def archiver():
+    archiver = Archiver(AsyncMongoMockClient()["toala_test"], batch_size=2, pause_seconds=0)
+
+    async def seed():
+        for index, status in enumerate(["completed", "declined", "completed", "approved"]):
+            request_id = f"req-{index}"
+            await archiver.db.rental_requests.insert_one({
+                "id": request_id, "owner_id": "olga", "requester_id": "rudi", "equipment_id": "drill",
+                "status": status, "created_at": OLD, "updated_at": OLD,
+            })
+            await archiver.db.messages.insert_one({
+                "id": f"msg-{index}", "request_id": request_id, "content": "Hallo", "timestamp": OLD,
+            })
+
+    run(seed())
+    return archiver
+
+
+def test_finished_requests_move_to_the_archive(archiver):
+    async def scenario():
+        result = await archiver.run()
+        hot = await archiver.db.rental_requests.distinct("id")
+        messages = await archiver.db.messages.distinct("id")
+        return result, hot, messages, await archiver.get("req-0")
+
+    result, hot, messages, record = run(scenario())
+    assert result == {"requests": 3, "messages": 3}
+    assert hot == ["req-3"] and messages == ["msg-3"]
+    assert record["request"]["status"] == "completed"
+    assert [message["id"] for message in record["messages"]] == ["msg-0"]
+
+
+class RacingArchive:
+    """Archive collection that lets the app write while an archive batch is in flight."""
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.rental_requests_archive
+
+    async def bulk_write(self, requests, **kwargs):
+        result = await self.collection.bulk_write(requests, **kwargs)
+        await self.db.messages.insert_one({
+            "id": "msg-late", "request_id": "req-0", "content": "Noch eine Frage", "timestamp": datetime.utcnow(),
+        })
+        await self.db.rental_requests.update_one({"id": "req-1"}, {"$set": {"updated_at": datetime.utcnow()}})
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def test_writes_during_a_run_are_not_lost(archiver, monkeypatch):
+    racing = RacingArchive(archiver.db)
+    monkeypatch.setattr(Archiver, "archive", property(lambda self: racing))
+
+    async def scenario():
+        result = await archiver.run()
+        hot = await archiver.db.rental_requests.distinct("id")
+        messages = await archiver.db.messages.distinct("id")
+        archived = await archiver.db.rental_requests_archive.distinct("_id")
+        return result, hot, messages, archived
+
+    result, hot, messages, archived = run(scenario())
+    # req-1 was touched after it was read, so it stays hot with its messages and no archive copy
+    assert sorted(hot) == ["req-1", "req-3"]
+    assert sorted(archived) == ["req-0", "req-2"]
+    assert result == {"requests": 2, "messages": 2}
+    # The message that arrived after req-0 was read is not deleted unseen
+    assert sorted(messages) == ["msg-1", "msg-3", "msg-late"]
+
+
+def test_repeated_run_refreshes_the_archive_record(archiver):
+    async def scenario():
+        # An interrupted run left an outdated archive record behind
+        await archiver.db.rental_requests_archive.insert_one({"_id": "req-0", "status": "approved"})
+        await archiver.run()
+        return await archiver.db.rental_requests_archive.find_one({"_id": "req-0"})
+
+    assert run(scenario())["status"] == "completed"
@@ -0,0 +1,166 @@
+"""Streaming multipart image uploads."""
+import asyncio
+import io
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from PIL import Image
+
+import server
+import uploads
+from uploads import UploadTooLarge, UnsupportedImageType, read_image_parts
+
+
+def png(size=(40, 30)) -> bytes:
+    output = io.BytesIO()
+    # Noise so the encoded file is not tiny
+    Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)).save(output, "PNG")
+    return output.getvalue()
+
+
+class StreamedRequest:
+    """Just enough of a Starlette request for read_image_parts."""
+
+    def __init__(self, body: bytes, boundary: str = "xyz", chunk_bytes: int = 64 * 1024):
+        self.headers = {"content-type": f"multipart/form-data; boundary={boundary}"}
+        self.body = body
+        self.chunk_bytes = chunk_bytes
+
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_bytes):
+            yield self.body[start:start + self.chunk_bytes]
+
+
+def multipart(data: bytes, content_type: str = "image/png", boundary: str = "xyz") -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="photo.png"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+
+
+def test_small_parts_stay_in_memory():
+    data = png()
+    [upload] = asyncio.run(read_image_parts(StreamedRequest(multipart(data))))
+    assert upload.size == len(data)
+    assert upload.source() == data
+    upload.close()
+
+
+def test_large_parts_are_spooled_to_disk(monkeypatch):
+    monkeypatch.setattr(uploads, "SPOOL_MEMORY_BYTES", 1024)
+    data = png((200, 200))
+    [upload] = asyncio.run(read_image_parts(StreamedRequest(multipart(data), chunk_bytes=1000)))
+
+    path = upload.source()
+    assert isinstance(path, str)
+    with open(path, "rb") as spooled:
+        assert spooled.read() == data
+    assert uploads.process_image(path, "image/png", formats=())["width"] == 200
+
+    upload.close()
+    assert not os.path.exists(path)
+
+
+def test_refused_upload_removes_its_spool(monkeypatch, tmp_path):
+    monkeypatch.setattr(uploads, "SPOOL_MEMORY_BYTES", 1024)
+    monkeypatch.setattr(uploads.tempfile, "tempdir", str(tmp_path))
+    body = multipart(png((200, 200)))
+
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(read_image_parts(StreamedRequest(body, chunk_bytes=1000), max_file_bytes=20 * 1024))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_mislabelled_part_is_refused():
+    with pytest.raises(UnsupportedImageType):
+        asyncio.run(read_image_parts(StreamedRequest(multipart(png(), content_type="image/jpeg"))))
+
+
+def test_equipment_images_upload(client, register, create_equipment):
+    owner, _ = register("Olga")
+    equipment = create_equipment(owner)
+
+    response = client.post(f"/api/equipment/{equipment['id']}/images", headers=owner,
+                           files={"images": ("photo.png", png(), "image/png")})
+
+    assert response.status_code == 200, response.text
+    [url] = response.json()["images"]
+    assert client.get(url).status_code == 200
+
+
+def upload_image(client, headers, equipment_id):
+    response = client.post(f"/api/equipment/{equipment_id}/images", headers=headers,
+                           files={"images": ("photo.png", png(), "image/png")})
+    assert response.status_code == 200, response.text
+    return response.json()["images"][-1]
+
+
+def test_listings_cannot_use_someone_elses_images(client, register, create_equipment):
+    owner, _ = register("Olga")
+    other, _ = register("Mallory")
+    url = upload_image(client, owner, create_equipment(owner)["id"])
+    listing = create_equipment(other)
+
+    response = client.post("/api/equipment", headers=other, json={
+        "title": "Leiter", "description": "Leiter", "category": "power_tools", "price_per_day": 5,
+        "location": "Wien", "images": [url],
+    })
+    assert response.status_code == 400
+    response = client.patch(f"/api/equipment/{listing['id']}", headers=other, json={"images": [url]})
+    assert response.status_code == 400
+
+    row = '{"title": "Leiter", "description": "Leiter", "category": "power_tools", "price_per_day": 5, ' \
+          f'"location": "Wien", "images": ["{url}", "https://example.com/own.jpg"]}}\n'
+    result = client.post("/api/equipment/bulk", headers=other, content=row.encode()).json()
+    assert (result["inserted"], result["failed"]) == (0, 1)
+    assert "uploaded by the listing owner" in result["errors"][0]["error"]
+
+    # External URLs are fine
+    response = client.patch(f"/api/equipment/{listing['id']}", headers=other,
+                            json={"images": ["https://example.com/own.jpg"]})
+    assert response.status_code == 200, response.text
+
+
+def test_removing_a_foreign_image_keeps_the_file(client, repos, register, create_equipment):
+    owner, _ = register("Olga")
+    other, mallory = register("Mallory")
+    url = upload_image(client, owner, create_equipment(owner)["id"])
+    # A listing saved before image ownership was checked
+    listing = create_equipment(other)
+    asyncio.run(repos.equipment.update(listing["id"], mallory["id"], {"images": [url]}))
+
+    image_id = url.rsplit("/", 1)[1]
+    response = client.delete(f"/api/equipment/{listing['id']}/images/{image_id}", headers=other)
+    assert response.status_code == 200, response.text
+    assert response.json()["images"] == []
+    assert client.get(url).status_code == 200
+
+
+def test_removing_an_own_image_deletes_the_file(client, register, create_equipment):
+    owner, _ = register("Olga")
+    equipment = create_equipment(owner)
+    url = upload_image(client, owner, equipment["id"])
+
+    response = client.delete(f"/api/equipment/{equipment['id']}/images/{url.rsplit('/', 1)[1]}", headers=owner)
+    assert response.status_code == 200, response.text
+    assert client.get(url).status_code == 404
+
+
+def test_purge_only_deletes_the_listing_owners_images(client, register, create_equipment):
+    owner, _ = register("Olga")
+    other, mallory = register("Mallory")
+    own_url = upload_image(client, other, create_equipment(other)["id"])
+    foreign_url = upload_image(client, owner, create_equipment(owner)["id"])
+    # Deleted long ago, and saved before image ownership was checked
+    listing = server.Equipment(owner_id=mallory["id"], owner_name="Mallory", title="Leiter", description="Leiter",
+                               category="power_tools", price_per_day=5, location="Wien",
+                               images=[own_url, foreign_url]).dict()
+    listing.update(deleted_at=datetime.utcnow() - timedelta(days=server.EQUIPMENT_PURGE_DAYS + 1),
+                   is_available=False)
+    asyncio.run(server.repositories.equipment.insert(listing))
+
+    assert asyncio.run(server.purge_deleted_equipment({})) == {"purged": 1, "files": 1}
+    assert client.get(own_url).status_code == 404
+    assert client.get(foreign_url).status_code == 200